@@ -0,0 +1,13 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Performance benchmarks for mozsvc components.
+
+Each module in this package is a standalone benchmark that can be run
+with "python -m", for example:
+
+    python -m mozsvc.benchmarks.mcclient --help
+
+"""
@@ -0,0 +1,334 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for MemcachedClient under gevent concurrency.
+
+This drives a random mix of get, set, get_multi and cas operations against a
+memcached server from many concurrent greenlets, once for each combination
+of the given client backends, connection-pool sizes and value sizes.  For
+each run it reports the throughput, the latency percentiles of each
+operation, the time spent waiting to check out a connection from the pool,
+and the number of distinct connections used (i.e. the connection churn).
+Run it like this:
+
+    python -m mozsvc.benchmarks.mcclient --pool-sizes 1,4,16 > results.json
+
+By default every available backend is tested, so this also compares the
+umemcache extension with the pure-python backends.
+
+The results are written to stdout as JSON so they can be compared between
+releases, with a human-readable summary of each run written to stderr.
+
+If no server is given then a StandInMemcachedServer is started in a child
+process.  That's good for comparing changes to the client code, but says
+little about how a real memcached deployment will behave.
+
+"""
+
+import os
+import sys
+import math
+import time
+import json
+import random
+import argparse
+import contextlib
+import multiprocessing
+
+import gevent
+import gevent.monkey
+
+from mozsvc.exceptions import BackendError
+from mozsvc.storage import mcclient
+from mozsvc.storage.mcclient import MemcachedClient
+
+
+DEFAULT_POOL_SIZES = "1,4,16"
+DEFAULT_VALUE_SIZES = "100,10000,100000"
+DEFAULT_OPERATIONS = "get,set,get_multi,cas"
+DEFAULT_CONCURRENCY = 50
+DEFAULT_DURATION = 2
+DEFAULT_NUM_KEYS = 1000
+DEFAULT_MULTI_SIZE = 10
+
+# The percentiles to report for each set of timings.
+PERCENTILES = (50, 99)
+
+# Number of keys to store in each request when populating the server.
+POPULATE_BATCH_SIZE = 100
+
+
+def run_benchmark(server, pool_size, value_size, client_class=None,
+                  pool_timeout=60, concurrency=DEFAULT_CONCURRENCY,
+                  duration=DEFAULT_DURATION, operations=None,
+                  num_keys=DEFAULT_NUM_KEYS, multi_size=DEFAULT_MULTI_SIZE,
+                  backend=None):
+    """Run a single benchmark configuration, returning a dict of results.
+
+    This creates a client for the given server using the given backend,
+    stores "num_keys" values of "value_size" random bytes, and then runs
+    "concurrency" greenlets that each perform randomly-chosen operations
+    for "duration" seconds.
+
+    For the greenlets to actually run concurrently, either the socket module
+    must be monkey-patched by gevent or the client class must be natively
+    gevent-friendly.  All times in the results are in milliseconds.
+    """
+    if client_class is None:
+        client_class = MemcachedClient
+    if operations is None:
+        operations = DEFAULT_OPERATIONS.split(",")
+    client = client_class(server, key_prefix="mcbench:",
+                          pool_size=pool_size, pool_timeout=pool_timeout,
+                          codec="raw", backend=backend)
+    workload = _Workload(client, num_keys, value_size, multi_size)
+    workload.populate()
+    recorder = _PoolRecorder(client)
+    latencies = dict((op, []) for op in operations)
+    errors = [0]
+    deadline = time.time() + duration
+
+    def worker():
+        rnd = random.Random()
+        while time.time() < deadline:
+            op = rnd.choice(operations)
+            start = time.time()
+            try:
+                workload.run(op, rnd)
+            except BackendError:
+                errors[0] += 1
+            else:
+                latencies[op].append(time.time() - start)
+
+    start = time.time()
+    greenlets = [gevent.spawn(worker) for _ in xrange(concurrency)]
+    gevent.joinall(greenlets, raise_error=True)
+    elapsed = time.time() - start
+    completed = sum(len(timings) for timings in latencies.itervalues())
+    all_latencies = []
+    for timings in latencies.itervalues():
+        all_latencies.extend(timings)
+    return {
+        "client": client_class.__name__,
+        "backend": client.backend,
+        "pool_size": pool_size,
+        "pool_timeout": pool_timeout,
+        "value_size": value_size,
+        "concurrency": concurrency,
+        "duration": elapsed,
+        "operations": completed,
+        "errors": errors[0],
+        "throughput": completed / elapsed,
+        "latency": dict((op, _summarize(timings))
+                        for op, timings in latencies.iteritems()),
+        "latency_all": _summarize(all_latencies),
+        "pool_wait": _summarize(recorder.wait_times),
+        "connections": len(recorder.connections),
+    }
+
+
+class _Workload(object):
+    """The set of keys and values on which the benchmark operates."""
+
+    def __init__(self, client, num_keys, value_size, multi_size):
+        self.client = client
+        self.keys = ["key%d" % (i,) for i in xrange(num_keys)]
+        self.value = os.urandom(value_size)
+        self.multi_size = min(multi_size, num_keys)
+
+    def populate(self):
+        for i in xrange(0, len(self.keys), POPULATE_BATCH_SIZE):
+            keys = self.keys[i:i + POPULATE_BATCH_SIZE]
+            self.client.set_multi(dict((key, self.value) for key in keys))
+
+    def run(self, op, rnd):
+        getattr(self, "do_" + op)(rnd)
+
+    def do_get(self, rnd):
+        self.client.get(rnd.choice(self.keys))
+
+    def do_set(self, rnd):
+        self.client.set(rnd.choice(self.keys), self.value)
+
+    def do_get_multi(self, rnd):
+        self.client.get_multi(rnd.sample(self.keys, self.multi_size))
+
+    def do_cas(self, rnd):
+        key = rnd.choice(self.keys)
+        _, casid = self.client.gets(key)
+        self.client.cas(key, self.value, casid)
+
+
+class _PoolRecorder(object):
+    """Instrument a client's connection pools to record their behaviour.
+
+    This wraps the reserve() method of each pool to record how long each
+    checkout takes, which includes the time to create any new connection,
+    and to remember every distinct connection that is handed out.
+    """
+
+    def __init__(self, client):
+        self.wait_times = []
+        self.connections = set()
+        for pool in client.pools.itervalues():
+            pool.reserve = self._wrap_reserve(pool.reserve)
+
+    def _wrap_reserve(self, reserve):
+        @contextlib.contextmanager
+        def recording_reserve():
+            start = time.time()
+            with reserve() as conn:
+                self.wait_times.append(time.time() - start)
+                self.connections.add(conn)
+                yield conn
+        return recording_reserve
+
+
+def _summarize(timings):
+    """Summarize a list of timings in seconds, as milliseconds."""
+    summary = {"count": len(timings)}
+    if not timings:
+        return summary
+    timings = sorted(timings)
+    summary["mean"] = sum(timings) * 1000 / len(timings)
+    summary["max"] = timings[-1] * 1000
+    for percentile in PERCENTILES:
+        # Use the nearest-rank method.
+        rank = int(math.ceil(percentile / 100.0 * len(timings)))
+        summary["p%d" % (percentile,)] = timings[max(rank - 1, 0)] * 1000
+    return summary
+
+
+def _serve_standin(conn, latency):
+    """Run a StandInMemcachedServer, sending its address over a pipe."""
+    # Imported here so that the benchmark doesn't depend on the test
+    # dependencies unless it's actually using the stand-in server.
+    from mozsvc.tests.support import StandInMemcachedServer
+    server = StandInMemcachedServer(latency=latency)
+    conn.send(server.address)
+    conn.close()
+    server.serve_forever()
+
+
+def start_standin_server(latency=0):
+    """Start a StandInMemcachedServer in a child process.
+
+    This returns a tuple giving the address of the server, and the process
+    object which can be used to terminate it.
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve_standin,
+                                      args=(child_conn, latency))
+    process.daemon = True
+    process.start()
+    address = parent_conn.recv()
+    parent_conn.close()
+    return address, process
+
+
+def _int_list(value):
+    try:
+        return [int(item) for item in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma-separated integers")
+
+
+def _get_available_backends():
+    backends = list(mcclient.BACKENDS)
+    if mcclient.umemcache is None:
+        backends.remove("umemcache")
+    return backends
+
+
+def main(args=None):
+    """Run the benchmarks as specified on the command-line."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark MemcachedClient under gevent concurrency.")
+    parser.add_argument("--server",
+                        help="memcached server to use (default: start a "
+                             "local stand-in server)")
+    parser.add_argument("--server-latency", type=float, default=0,
+                        help="latency to inject into the stand-in server")
+    parser.add_argument("--backends",
+                        default=",".join(_get_available_backends()),
+                        help="comma-separated client backends to test")
+    parser.add_argument("--pool-sizes", type=_int_list,
+                        default=_int_list(DEFAULT_POOL_SIZES),
+                        help="comma-separated pool sizes to test")
+    parser.add_argument("--pool-timeout", type=int, default=60,
+                        help="age at which to recycle connections")
+    parser.add_argument("--value-sizes", type=_int_list,
+                        default=_int_list(DEFAULT_VALUE_SIZES),
+                        help="comma-separated value sizes to test")
+    parser.add_argument("--operations", default=DEFAULT_OPERATIONS,
+                        help="comma-separated operations to perform")
+    parser.add_argument("--concurrency", type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help="number of concurrent greenlets")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+                        help="number of seconds for which to run each test")
+    parser.add_argument("--num-keys", type=int, default=DEFAULT_NUM_KEYS,
+                        help="number of distinct keys to use")
+    parser.add_argument("--multi-size", type=int, default=DEFAULT_MULTI_SIZE,
+                        help="number of keys to fetch in each get_multi")
+    opts = parser.parse_args(args)
+
+    operations = opts.operations.split(",")
+    for op in operations:
+        if not hasattr(_Workload, "do_" + op):
+            parser.error("unknown operation: %r" % (op,))
+    backends = opts.backends.split(",")
+    for backend in backends:
+        if backend not in _get_available_backends():
+            parser.error("unavailable backend: %r" % (backend,))
+
+    server = opts.server
+    server_process = None
+    if server is None:
+        server, server_process = start_standin_server(opts.server_latency)
+    # The stand-in server must run in an unpatched process, so we can
+    # only patch the socket module once it has been started.
+    gevent.monkey.patch_all()
+    results = []
+    try:
+        for backend in backends:
+            for pool_size in opts.pool_sizes:
+                for value_size in opts.value_sizes:
+                    result = run_benchmark(server, pool_size, value_size,
+                                           MemcachedClient, opts.pool_timeout,
+                                           opts.concurrency, opts.duration,
+                                           operations, opts.num_keys,
+                                           opts.multi_size, backend)
+                    results.append(result)
+                    print>>sys.stderr, _format_summary(result)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+
+    output = {
+        "server": opts.server or "standin",
+        "server_latency": opts.server_latency,
+        "operations": operations,
+        "results": results,
+    }
+    json.dump(output, sys.stdout, indent=2, sort_keys=True)
+    print
+    return 0
+
+
+def _format_summary(result):
+    latency = result["latency_all"]
+    pool_wait = result["pool_wait"]
+    return ("backend=%(backend)s pool_size=%(pool_size)d "
+            "value_size=%(value_size)d: "
+            "%(throughput).0f ops/s, %(errors)d errors, "
+            "%(connections)d connections" % result +
+            ", p50=%.2fms p99=%.2fms" % (latency.get("p50", 0),
+                                         latency.get("p99", 0)) +
+            ", pool wait p99=%.2fms" % (pool_wait.get("p99", 0),))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
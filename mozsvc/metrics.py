@@ -16,8 +16,10 @@ functions.
 
 import re
 import json
+import bisect
 import timeit
 import logging
+import threading
 import functools
 
 import pyramid.threadlocal
@@ -188,6 +190,77 @@ class metrics_timer(object):
         return timed_func
 
 
+class LatencyHistogram(object):
+    """Histogram of latencies, with logarithmically-sized buckets.
+
+    This class keeps a compact summary of a stream of latency measurements,
+    in seconds, suitable for reporting percentiles without storing every
+    measurement.  The upper bound of each bucket is double that of the one
+    before it, starting at "min_latency" seconds; any measurement larger
+    than the last bound is counted in a final overflow bucket.  Percentiles
+    are reported as the upper bound of the bucket in which they fall, and
+    so may be over-estimated by up to a factor of two.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, min_latency=0.0001, num_buckets=20):
+        self.bounds = [min_latency * 2 ** i for i in xrange(num_buckets)]
+        self.counts = [0] * (num_buckets + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """Record a single latency measurement, in seconds."""
+        idx = bisect.bisect_left(self.bounds, latency)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.total += latency
+            if latency > self.max:
+                self.max = latency
+
+    def get_stats(self):
+        """Get a dict summarizing the recorded latencies.
+
+        This gives the "count", "total", "mean" and "max" of the latencies,
+        estimates of their 50th, 90th and 99th percentiles as "p50", "p90"
+        and "p99", and the count in each bucket as a list of (bound, count)
+        pairs for the non-empty buckets.  The bound for the overflow bucket
+        is None.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            stats = {
+                "count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else 0,
+                "max": self.max,
+            }
+        bounds = self.bounds + [None]
+        for percentile in self.PERCENTILES:
+            stats["p%d" % (percentile,)] = self._get_percentile(counts,
+                                                                percentile)
+        stats["buckets"] = [(bound, count)
+                            for (bound, count) in zip(bounds, counts)
+                            if count]
+        return stats
+
+    def _get_percentile(self, counts, percentile):
+        rank = sum(counts) * percentile / 100.0
+        seen = 0
+        for idx, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                if idx < len(self.bounds):
+                    return self.bounds[idx]
+                # It's in the overflow bucket, so the max is the best bound.
+                return self.max
+        return 0
+
+
 def new_request_listener(event):
     """NewRequest event-listener that adds request metrics."""
     initialize_request_metrics(event.request)
@@ -30,6 +30,11 @@ from collections import defaultdict
 
 from tokenlib.utils import HKDF
 
+from mozsvc.util import LRUCache
+
+
+DEFAULT_DERIVED_CACHE_SIZE = 1000
+
 
 class Secrets(object):
     """Load node-specific secrets from a file.
@@ -133,18 +138,38 @@ class DerivedSecrets(object):
     Options:
 
     - **secrets**: a list of hex-encoded master secrets to use.
+    - **cache_size**: the number of nodes for which to remember the
+      derived secrets, to avoid re-deriving them on every call.
+
+    Node names often come from the Host header of incoming requests, so
+    the cache is bounded and discards the least-recently-used nodes.
 
     """
 
     # Namespace prefix for HKDF "info" parameter.
     HKDF_INFO_NODE_SECRET = b"services.mozilla.com/mozsvc/v1/node_secret/"
 
-    def __init__(self, master_secrets):
+    def __init__(self, master_secrets, cache_size=DEFAULT_DERIVED_CACHE_SIZE):
         if isinstance(master_secrets, basestring):
             master_secrets = master_secrets.split()
         self._master_secrets = master_secrets
+        cache_size = int(cache_size)
+        if cache_size > 0:
+            self._cache = LRUCache(cache_size)
+        else:
+            self._cache = None
 
     def get(self, node):
+        if self._cache is None:
+            return self._derive(node)
+        node_secrets = self._cache.get(node)
+        if node_secrets is None:
+            node_secrets = self._derive(node)
+            self._cache.set(node, node_secrets)
+        # Return a copy, so that callers can't modify the cached list.
+        return list(node_secrets)
+
+    def _derive(self, node):
         hkdf_params = {
             "salt": None,
             "info": self.HKDF_INFO_NODE_SECRET + node,
@@ -0,0 +1,235 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Gevent-native memcached client with shared, pipelined connections.
+
+This module provides the "pipelined" backend for MemcachedClient, which
+speaks the memcached text protocol directly over gevent sockets rather than
+going through the blocking umemcache extension.  Instead of checking out a
+connection for the exclusive use of each operation, many greenlets share a
+small fixed set of connections to each server.  Each command is written to
+its connection as soon as it is issued, and a background greenlet reads the
+replies in order and hands them back to the waiting greenlets.  This lets
+a handful of connections serve any number of concurrent requests, with no
+pool contention and with requests from different greenlets pipelined
+together on the wire.
+"""
+
+import socket
+import itertools
+import contextlib
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
+import gevent.socket
+
+from mozsvc.util import monotonic_time
+from mozsvc.storage import mcprotocol
+from mozsvc.storage.mcclient import MemcachedClient
+
+
+DEFAULT_PORT = mcprotocol.DEFAULT_PORT
+DEFAULT_CONNECTIONS_PER_SERVER = 1
+DEFAULT_IO_TIMEOUT = mcprotocol.DEFAULT_IO_TIMEOUT
+
+
+class AsyncMemcachedClient(MemcachedClient):
+    """Memcached client using shared, pipelined gevent connections.
+
+    This is a MemcachedClient using the "pipelined" backend by default.
+    Each method blocks only the calling greenlet, so concurrency comes from
+    calling it from many greenlets at once.
+
+    The "pool_size" argument gives the number of connections to open to
+    each server, and "pool_timeout" the age after which idle connections
+    will be recycled.  Requests that receive no reply within "io_timeout"
+    seconds will fail with a BackendError.
+    """
+
+    def __init__(self, *args, **kwds):
+        if kwds.get("backend") is None:
+            kwds["backend"] = "pipelined"
+        super(AsyncMemcachedClient, self).__init__(*args, **kwds)
+
+
+class PipelinedConnectionPool(object):
+    """Fixed-size set of shared PipelinedConnection objects for a server.
+
+    This class provides the same reserve() interface as MCClientPool, but
+    the connections it returns are not reserved for exclusive use.  They are
+    handed out round-robin and shared by all callers, re-created if they
+    become disconnected, and recycled when idle if older than "timeout".
+    """
+
+    def __init__(self, server, size=None, timeout=60,
+                 io_timeout=DEFAULT_IO_TIMEOUT):
+        self.server = server
+        self.size = size or DEFAULT_CONNECTIONS_PER_SERVER
+        self.timeout = timeout
+        self.io_timeout = io_timeout
+        self._connections = [None] * self.size
+        self._counter = itertools.count()
+        # Counters for reporting purposes.
+        self.checkouts = 0
+        self.connections_created = 0
+        self.connections_recycled = 0
+
+    @contextlib.contextmanager
+    def reserve(self):
+        """Context-manager to obtain a connection from the pool."""
+        self.checkouts += 1
+        yield self._get_connection()
+
+    def get_stats(self):
+        """Get a dict of counters describing the pool's activity."""
+        connected = [conn for conn in self._connections
+                     if conn is not None and conn.is_connected()]
+        return {
+            "checkouts": self.checkouts,
+            "connections": len(connected),
+            "connections_created": self.connections_created,
+            "connections_recycled": self.connections_recycled,
+        }
+
+    def warm(self):
+        """Open all of the pool's connections ahead of time."""
+        for _ in xrange(self.size):
+            self._get_connection().connect()
+
+    def close(self):
+        """Close all of the pool's connections."""
+        for idx, conn in enumerate(self._connections):
+            if conn is not None:
+                conn.disconnect()
+                self._connections[idx] = None
+
+    def _get_connection(self):
+        idx = next(self._counter) % self.size
+        conn = self._connections[idx]
+        if conn is not None:
+            if not conn.is_connected():
+                conn = None
+            elif conn.created + self.timeout <= monotonic_time():
+                if conn.is_idle():
+                    conn.disconnect()
+                    conn = None
+                    self.connections_recycled += 1
+        if conn is None:
+            # The new connection will connect lazily when first used,
+            # so there's no chance of another greenlet running in between
+            # our check of the slot and our replacement of it.
+            conn = PipelinedConnection(self.server, self.io_timeout)
+            self._connections[idx] = conn
+            self.connections_created += 1
+        return conn
+
+
+class PipelinedConnection(mcprotocol.BaseConnection):
+    """Connection to a memcached server that can be shared between greenlets.
+
+    Commands are written to the socket as soon as they are issued, and the
+    issuing greenlet then waits for its reply.  A background greenlet reads
+    replies off the socket and delivers them to the waiting greenlets in the
+    order in which their commands were sent.
+
+    If anything goes wrong with the connection, every pending command fails
+    with an error and the connection must be discarded.
+    """
+
+    def __init__(self, server, timeout=DEFAULT_IO_TIMEOUT):
+        self.server = server
+        self.timeout = timeout
+        self.created = monotonic_time()
+        self._address = mcprotocol.parse_server(server)
+        self._sock = None
+        self._closed = False
+        self._reader = None
+        self._write_lock = gevent.lock.Semaphore()
+        # Queue of (parser, result) pairs, in order of commands sent.
+        self._pending = gevent.queue.Queue()
+
+    def connect(self):
+        """Connect the socket, if not already connected."""
+        if self._closed:
+            raise socket.error("connection has been closed")
+        if self._sock is None:
+            sock = gevent.socket.create_connection(self._address,
+                                                   self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Replies are waited for with an explicit timeout, so the
+            # reader itself can block indefinitely.
+            sock.settimeout(None)
+            self._sock = sock
+            self._reader = gevent.spawn(self._read_replies, sock)
+
+    def is_connected(self):
+        return not self._closed
+
+    def is_idle(self):
+        return self._pending.empty()
+
+    def disconnect(self, err=None):
+        """Close the connection, failing any pending commands."""
+        if self._closed:
+            return
+        self._closed = True
+        if err is None:
+            err = socket.error("connection closed")
+        if self._reader is not None:
+            if self._reader is not gevent.getcurrent():
+                self._reader.kill(block=False)
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        while not self._pending.empty():
+            parser, result = self._pending.get_nowait()
+            if result is not None:
+                result.set_exception(err)
+
+    def _execute(self, requests):
+        results = []
+        with self._write_lock:
+            self.connect()
+            for (_, parser) in requests:
+                if parser is None:
+                    results.append(None)
+                else:
+                    result = gevent.event.AsyncResult()
+                    self._pending.put((parser, result))
+                    results.append(result)
+            try:
+                self._sock.sendall("".join(cmd for (cmd, _) in requests))
+            except EnvironmentError as err:
+                self.disconnect(err)
+                raise
+        replies = []
+        for result in results:
+            if result is None:
+                replies.append(None)
+                continue
+            try:
+                replies.append(result.get(timeout=self.timeout))
+            except gevent.Timeout:
+                err = socket.timeout("timed out waiting for memcached")
+                self.disconnect(err)
+                raise err
+        return replies
+
+    def _read_replies(self, sock):
+        """Loop reading replies and delivering them to waiting greenlets."""
+        reader = mcprotocol.ReplyReader(sock)
+        result = None
+        try:
+            while True:
+                parser, result = self._pending.get()
+                reply = parser(reader)
+                result.set(reply)
+                result = None
+        except (EnvironmentError, RuntimeError) as err:
+            if result is not None:
+                result.set_exception(err)
+            self.disconnect(err)
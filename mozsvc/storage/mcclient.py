@@ -10,26 +10,154 @@ for serialization, error reporting and connection pooling.
 """
 
 import sys
+import zlib
+import math
 import time
+import heapq
+import bisect
+import random
+import struct
+import uuid
+import marshal
+import weakref
+import threading
 import logging
-import warnings
+import functools
 import traceback
 import contextlib
 import Queue
+from hashlib import md5
 try:
     import simplejson as json
 except ImportError:
     import json
 
-import umemcache
+try:
+    import umemcache
+except ImportError:
+    umemcache = None
 
-from mozsvc.exceptions import BackendError
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import gevent
+    import gevent.event
+    import gevent.monkey
+except ImportError:
+    gevent = None
+
+from mozsvc.util import LRUCache, SpaceSavingCounter, monotonic_time
+from mozsvc.metrics import annotate_request, LatencyHistogram
+from mozsvc.exceptions import BackendError, BackendTimeoutError
+from mozsvc.storage import mcprotocol
 
 
 logger = logging.getLogger("mozsvc.storage.mcclient")
 
 DEFAULT_MAX_KEY_SIZE = 250
 DEFAULT_MAX_VALUE_SIZE = 20 * 1024 * 1024
+DEFAULT_SERVER = "127.0.0.1:11211"
+DEFAULT_LOCAL_CACHE_TTL = 5
+DEFAULT_RECOMPUTE_LOCK_TTL = 30
+DEFAULT_RECOMPUTE_LOCK_WAIT = 2
+RECOMPUTE_POLL_INTERVAL = 0.05
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_TIMEOUT = 10
+DEFAULT_ITER_BATCH_SIZE = 100
+DEFAULT_NAMESPACE_CACHE_SIZE = 1000
+DEFAULT_NAMESPACE_CACHE_TTL = 1
+# New namespaces start at a random generation below this value.
+MAX_INITIAL_GENERATION = 2 ** 31
+# Memcached treats expiry times longer than this as absolute timestamps.
+MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+DEFAULT_HOT_KEY_CAPACITY = 100
+DEFAULT_HOT_KEY_LOG_COUNT = 10
+DEFAULT_WRITE_BEHIND_INTERVAL = 1
+BACKENDS = ("umemcache", "python", "pipelined")
+
+# The memcached flags stored with each value identify how it was encoded.
+# The low-order bits identify the codec used to serialize it, with zero
+# meaning JSON for compatibility with values stored by older versions.
+# Higher-order bits mark any additional transformations of the data.
+CODEC_FLAGS_MASK = 0xFF
+FLAG_JSON = 0
+FLAG_MARSHAL = 1
+FLAG_RAW = 2
+FLAG_MSGPACK = 3
+FLAG_COMPRESSED = 1 << 8
+FLAG_CHUNKED = 1 << 9
+
+# Registry of value codecs, indexed by both name and flag value.
+# Each entry is a (name, flag, dumps, loads) tuple.
+_CODECS_BY_NAME = {}
+_CODECS_BY_FLAG = {}
+
+
+def register_codec(name, flag, dumps, loads):
+    """Register a codec for serializing values into memcached.
+
+    Each codec is identified by a unique name, for use in configuration,
+    and by a unique flag value between 0 and 255, which is stored alongside
+    each encoded value so that it can be decoded with the matching codec.
+    """
+    if flag & ~CODEC_FLAGS_MASK:
+        raise ValueError("codec flag out of range: %r" % (flag,))
+    existing = _CODECS_BY_FLAG.get(flag)
+    if existing is not None and existing[0] != name:
+        raise ValueError("codec flag already in use: %r" % (flag,))
+    codec = (name, flag, dumps, loads)
+    _CODECS_BY_NAME[name] = codec
+    _CODECS_BY_FLAG[flag] = codec
+
+
+def _dumps_raw(value):
+    if not isinstance(value, str):
+        raise ValueError("raw codec can only store bytestrings")
+    return value
+
+
+def _loads_raw(data):
+    return data
+
+
+register_codec("json", FLAG_JSON, json.dumps, json.loads)
+register_codec("marshal", FLAG_MARSHAL, marshal.dumps, marshal.loads)
+register_codec("raw", FLAG_RAW, _dumps_raw, _loads_raw)
+if msgpack is not None:
+    register_codec("msgpack", FLAG_MSGPACK, msgpack.packb, msgpack.unpackb)
+
+
+def _timed(op):
+    """Decorator to record the latency of a MemcachedClient operation.
+
+    Each call is recorded in the client's latency histogram for the given
+    operation, and the current request is annotated with the number of
+    calls and the total time spent, as "mc.<op>.count" and "mc.<op>.time".
+    """
+    count_key = "mc.%s.count" % (op,)
+    time_key = "mc.%s.time" % (op,)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_method(self, *args, **kwds):
+            start_time = monotonic_time()
+            try:
+                return func(self, *args, **kwds)
+            finally:
+                latency = monotonic_time() - start_time
+                histogram = self.op_latencies.get(op)
+                if histogram is None:
+                    histogram = self.op_latencies.setdefault(
+                        op, LatencyHistogram())
+                histogram.record(latency)
+                annotate_request(None, count_key, 1)
+                annotate_request(None, time_key, latency)
+        return timed_method
+
+    return decorator
 
 
 class MemcachedClient(object):
@@ -38,58 +166,449 @@ class MemcachedClient(object):
     This class provides the basic methods of the pylibmc Client class, but
     wraps them with some extra functionality:
 
-        * all values are transparently serialized via JSON instead of pickle.
-        * connections are taken from an underlying pool.
+        * all values are transparently serialized via JSON instead of pickle,
+          or via some other registered codec.
+        * large values can be transparently compressed with zlib.
+        * keys can be spread over multiple servers via consistent hashing.
+        * connections are taken from an underlying pool for each server.
         * errors are converted into BackendError instances.
+        * a circuit-breaker fails fast when a server is known to be down.
+        * keys can optionally be replicated to several servers.
+        * large values are transparently split into multiple chunks.
         * cas() transparently falls back to add() when appropriate.
+        * an optional in-process cache can serve repeated reads of hot keys.
+        * concurrent gets can optionally be batched into a single request.
+        * namespaces of keys can be invalidated in a single operation.
+        * the most heavily-used keys can be found by sampling operations.
+        * best-effort writes can be buffered and sent in the background.
+        * latencies are recorded per operation and per server.
+
+    The in-process cache is enabled by passing a "local_cache_size", and
+    holds decoded values for at most "local_cache_ttl" seconds.  Writes made
+    through this client invalidate the corresponding entries, but writes
+    from other processes will not be seen until the entry expires.  Values
+    served from this cache are shared between callers and must not be
+    modified in place.
+
+    New values are serialized using the codec named by the "codec" argument,
+    which defaults to JSON.  Values are decoded using whichever codec was used
+    to store them, so clients with different codecs can share the same keys.
+    If "compress_threshold" is given then encoded values larger than that
+    many bytes will be compressed before storing.
+
+    After "breaker_threshold" consecutive connection errors on a server, its
+    circuit-breaker will open and requests to that server will immediately
+    fail with BackendError for the next "breaker_timeout" seconds.  After
+    that, a single trial request is let through to test whether the server
+    has recovered.  Set "breaker_threshold" to zero to disable this.
+
+    If "replicas" is greater than one then each key is stored on that many
+    distinct servers, taken in order around the hash ring.  Writes are sent
+    to all replicas concurrently and succeed if any replica was reachable,
+    while reads go to the first replica and fail over to the next ones on
+    BackendError.  This is intended for small but critical data such as
+    nonces; it does not guarantee that the replicas stay consistent.  Writes
+    are only truly concurrent if the socket module is patched by gevent.
+
+    If "chunk_size" is given, encoded values larger than that many bytes are
+    split into chunks that are stored under separate keys, and the value's
+    own key holds a small manifest listing the chunks along with a checksum
+    of the complete data.
+    Every write uses fresh chunk keys, so readers never see a mix of chunks
+    from different writes, and if any chunk is missing or the checksum does
+    not match then the value is treated as missing.  Chunks left over from
+    previous writes are not deleted, but will be evicted by memcached as it
+    runs out of space.  Chunking is off by default, because older clients
+    would read the manifests as ordinary values; enable it only once every
+    client sharing the keys supports it.  Memcached rejects items over 1MB
+    by default, so a "chunk_size" of 1000000 is a reasonable choice.
+
+    The "pool_lifo", "pool_prewarm", "pool_reap_interval" and
+    "pool_checkout_timeout" arguments are passed through to each
+    MCClientPool; see that class for details.  Since pre-warmed connections
+    cannot be shared between processes, the client should be created after
+    any forking of worker processes.
 
+    If "batch_gets" is true then calls to get() are passed through a
+    BatchingLoader, so that gets made by different greenlets at the same
+    time are combined into a single get_multi, and greenlets getting the
+    same key share a single result.  This requires gevent.
+
+    Keys may be given as (namespace, key) tuples to place them in a named
+    namespace, all of whose keys can be invalidated at once by calling
+    invalidate_namespace().  Each namespace has a generation counter stored
+    in memcached, and the current generation is made part of the storage
+    key, so that bumping the counter makes all the old keys unreachable.
+    Generations are cached in-process for "namespace_cache_ttl" seconds,
+    so other processes may take that long to see an invalidation.
+
+    If "hot_key_sample_rate" is given then that fraction of the keys read
+    from or written to memcached are sampled by a HotKeySampler, to find
+    the most heavily-used keys; see get_hot_keys().  The sampler tracks up
+    to "hot_key_capacity" keys for each type of operation, and if
+    "hot_key_log_interval" is given it logs the hottest keys that often.
+
+    If "write_behind_size" is given then writes made with set_later() and
+    incr_later() are held in a WriteBehindBuffer of that many keys, and
+    sent to memcached in batches from a background thread every
+    "write_behind_interval" seconds.  This is intended for non-critical
+    data such as last-seen timestamps, where occasionally losing a write
+    is preferable to making the request wait for it.
+
+    The latency of each operation is recorded in a LatencyHistogram for
+    that type of operation, and the time spent using each connection in a
+    histogram for its server; see get_latency_stats().  The current request
+    is also annotated with the number of each type of operation performed
+    and the time spent on them, e.g. "mc.get.count" and "mc.get.time".
+
+    The "backend" argument selects how to talk to memcached:
+
+        * "umemcache" uses the umemcache C extension.  This is the default
+          if umemcache is installed.
+        * "python" uses pure-python mcprotocol.Connection objects, which
+          can be used in place of umemcache, for example on interpreters
+          where it can't be built.  This is the default otherwise.
+        * "pipelined" uses connections that are shared by many greenlets,
+          with commands from all of them pipelined together on the wire;
+          see mozsvc.storage.mcasync.  This requires gevent.
+
+    The pure-python backends give up on requests that receive no reply
+    within "io_timeout" seconds.  Since pipelined connections are never
+    reserved for exclusive use, the "pool_lifo", "pool_reap_interval" and
+    "pool_checkout_timeout" arguments have no effect on that backend.
     """
 
     def __init__(self, server=None, key_prefix="", pool_size=None,
                  pool_timeout=60, max_key_size=None, max_value_size=None,
+                 servers=None, local_cache_size=None,
+                 local_cache_ttl=DEFAULT_LOCAL_CACHE_TTL, codec="json",
+                 compress_threshold=None,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+                 breaker_timeout=DEFAULT_BREAKER_TIMEOUT, replicas=1,
+                 chunk_size=None, pool_lifo=False,
+                 pool_prewarm=False, pool_reap_interval=None,
+                 pool_checkout_timeout=None, batch_gets=False,
+                 namespace_cache_ttl=DEFAULT_NAMESPACE_CACHE_TTL,
+                 hot_key_sample_rate=None,
+                 hot_key_capacity=DEFAULT_HOT_KEY_CAPACITY,
+                 hot_key_log_interval=None, write_behind_size=None,
+                 write_behind_interval=DEFAULT_WRITE_BEHIND_INTERVAL,
+                 backend=None, io_timeout=mcprotocol.DEFAULT_IO_TIMEOUT,
                  **kwds):
-        if "servers" in kwds:
-            msg = "MemcachedClient supports only a single server; please "\
-                  "use the 'server' argument rather than 'servers'"
-            warnings.warn(msg, DeprecationWarning, stacklevel=1)
-            if server is None:
-                server = kwds.pop("servers")
-                if not isinstance(server, basestring):
-                    server = server[0]
-        if server is None:
-            server = "127.0.0.1:11211"
+        if servers is None:
+            servers = server
+        elif server is not None:
+            raise ValueError("can't use both 'server' and 'servers'")
+        if servers is None:
+            servers = [DEFAULT_SERVER]
+        elif isinstance(servers, basestring):
+            servers = servers.split()
+        if not servers:
+            raise ValueError("no memcached servers specified")
+        self.servers = list(servers)
         self.key_prefix = key_prefix
-        self.pool = MCClientPool(server, pool_size, pool_timeout)
+        self.pools = {}
+        self.breakers = {}
+        self.op_latencies = {}
+        self.server_latencies = {}
+        if backend is None:
+            backend = "umemcache" if umemcache is not None else "python"
+        if backend not in BACKENDS:
+            raise ValueError("unknown memcached backend: %r" % (backend,))
+        if backend == "umemcache" and umemcache is None:
+            raise ValueError("the umemcache backend requires umemcache")
+        if backend == "pipelined":
+            if gevent is None:
+                raise ValueError("the pipelined backend requires gevent")
+            # Our sockets always cooperate with gevent, so we can always
+            # fan out requests to multiple servers in separate greenlets.
+            self._use_greenlets = True
+        self.backend = backend
+        self.io_timeout = float(io_timeout)
+        if pool_reap_interval is not None:
+            pool_reap_interval = float(pool_reap_interval)
+        if pool_checkout_timeout is not None:
+            pool_checkout_timeout = float(pool_checkout_timeout)
+        self._pool_options = {
+            "lifo": pool_lifo,
+            "reap_interval": pool_reap_interval,
+            "checkout_timeout": pool_checkout_timeout,
+        }
+        for server in self.servers:
+            self.pools[server] = self._create_pool(server, pool_size,
+                                                   pool_timeout)
+            self.server_latencies[server] = LatencyHistogram()
+            if breaker_threshold and int(breaker_threshold) > 0:
+                self.breakers[server] = CircuitBreaker(int(breaker_threshold),
+                                                       float(breaker_timeout),
+                                                       name=server)
+        self.ring = ConsistentHashRing(self.servers)
+        replicas = int(replicas)
+        if replicas < 1:
+            raise ValueError("replicas must be at least one")
+        self.replicas = min(replicas, len(set(self.servers)))
         self.max_key_size = max_key_size or DEFAULT_MAX_KEY_SIZE
         self.max_value_size = max_value_size or DEFAULT_MAX_VALUE_SIZE
+        try:
+            self.codec = _CODECS_BY_NAME[codec]
+        except KeyError:
+            raise ValueError("unknown codec: %r" % (codec,))
+        if compress_threshold is not None:
+            compress_threshold = int(compress_threshold)
+        self.compress_threshold = compress_threshold
+        self.chunk_size = int(chunk_size) if chunk_size else None
+        if local_cache_size:
+            self.local_cache = LRUCache(int(local_cache_size),
+                                        float(local_cache_ttl))
+        else:
+            self.local_cache = None
+        # Tokens for the fetches that may fill the local cache, by key.
+        self._local_cache_fills = {}
+        self._local_cache_lock = threading.Lock()
+        if namespace_cache_ttl and float(namespace_cache_ttl) > 0:
+            self.namespace_cache = LRUCache(DEFAULT_NAMESPACE_CACHE_SIZE,
+                                            float(namespace_cache_ttl))
+        else:
+            self.namespace_cache = None
+        if hot_key_sample_rate and float(hot_key_sample_rate) > 0:
+            if hot_key_log_interval is not None:
+                hot_key_log_interval = float(hot_key_log_interval)
+            self.hot_keys = HotKeySampler(float(hot_key_sample_rate),
+                                          int(hot_key_capacity),
+                                          hot_key_log_interval)
+        else:
+            self.hot_keys = None
+        if write_behind_size and int(write_behind_size) > 0:
+            self.write_buffer = WriteBehindBuffer(self,
+                                                  int(write_behind_size),
+                                                  float(write_behind_interval))
+        else:
+            self.write_buffer = None
+        if batch_gets:
+            if gevent is None:
+                raise ValueError("batch_gets requires gevent")
+            self.loader = BatchingLoader(self)
+        else:
+            self.loader = None
+        if pool_prewarm:
+            self.warm()
+
+    # Whether to fan out requests to multiple servers in greenlets.
+    # If None, greenlets will be used if the socket module is patched.
+    _use_greenlets = None
+
+    def _create_pool(self, server, pool_size, pool_timeout):
+        """Create the connection pool for the given server."""
+        if self.backend == "pipelined":
+            # Imported here since mcasync depends on this module.
+            from mozsvc.storage.mcasync import PipelinedConnectionPool
+            return PipelinedConnectionPool(server, pool_size, pool_timeout,
+                                           self.io_timeout)
+        if self.backend == "python":
+            factory = functools.partial(mcprotocol.Connection,
+                                        timeout=self.io_timeout)
+        else:
+            factory = umemcache.Client
+        return MCClientPool(server, pool_size, pool_timeout, factory=factory,
+                            **self._pool_options)
+
+    def warm(self):
+        """Open connections to each server ahead of time.
+
+        Any errors are logged rather than raised, so that the application
+        can still start up if some servers are unavailable.
+        """
+        for server, pool in self.pools.iteritems():
+            try:
+                pool.warm()
+            except (EnvironmentError, RuntimeError):
+                logger.error("could not pre-warm connections to %s", server)
+                logger.error(traceback.format_exc())
+
+    def close(self):
+        """Close all idle connections, and stop any background threads.
+
+        Any writes in the write-behind buffer are flushed first.
+        """
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+        for pool in self.pools.itervalues():
+            pool.close()
+
+    @property
+    def pool(self):
+        """The connection pool, for clients with only a single server."""
+        if len(self.servers) != 1:
+            raise AttributeError("client has multiple pools, use .pools")
+        return self.pools[self.servers[0]]
+
+    def _get_server(self, key):
+        """Get the address of the server responsible for an encoded key."""
+        if len(self.servers) == 1:
+            return self.servers[0]
+        return self.ring.get_server(key)
+
+    def _get_servers(self, key):
+        """Get the addresses of all servers holding replicas of an encoded key.
+
+        The first server in the list is the primary for the key, and the
+        others are tried in order if it is not available.
+        """
+        if self.replicas == 1:
+            return [self._get_server(key)]
+        return self.ring.get_servers(key, self.replicas)
+
+    def _call_with_failover(self, key, func):
+        """Call func(mc) with a connection to the first available replica.
+
+        This returns a tuple giving the address of the server that was used,
+        and the result of the function.
+        """
+        servers = self._get_servers(key)
+        for server in servers[:-1]:
+            try:
+                with self._connect(server) as mc:
+                    return server, func(mc)
+            except BackendError:
+                # The error has already been logged, so just try the next.
+                pass
+        with self._connect(servers[-1]) as mc:
+            return servers[-1], func(mc)
+
+    def _call_on_replicas(self, key, func, veto_status=None):
+        """Call func(mc) with a connection to each replica, concurrently.
+
+        This returns the result from the first replica that could be reached,
+        and raises BackendError only if none of them could be.  If given,
+        veto_status is returned instead if any reachable replica returned it.
+        Conditional writes use this to report failure if any replica refused
+        them, since the first replica may have lost the data that caused the
+        refusal.
+        """
+        servers = self._get_servers(key)
+        if len(servers) == 1:
+            with self._connect(servers[0]) as mc:
+                return func(mc)
+
+        def call_on_server(server):
+            with self._connect(server) as mc:
+                return func(mc)
+
+        outcomes = _call_concurrently(call_on_server,
+                                      [(s,) for s in servers],
+                                      self._use_greenlets)
+        res = _first_success(outcomes)
+        if veto_status is not None:
+            if any(ok and r == veto_status for (ok, r) in outcomes):
+                return veto_status
+        return res
+
+    def get_pool_stats(self):
+        """Get the activity counters of each server's connection pool.
+
+        This returns a dict mapping each server address to a dict of metrics
+        from its connection pool, suitable for reporting or logging.
+        """
+        stats = {}
+        for server, pool in self.pools.iteritems():
+            stats[server] = pool.get_stats()
+        return stats
+
+    def get_hot_keys(self, n=DEFAULT_HOT_KEY_LOG_COUNT):
+        """Get estimates of the most heavily-used keys, by operation type.
+
+        This returns a dict mapping "get" and "set" to a list of the top
+        n storage-level keys for that type of operation, as reported by
+        HotKeySampler.get_hot_keys().  If sampling is not enabled then
+        the dict will be empty.
+        """
+        if self.hot_keys is None:
+            return {}
+        return self.hot_keys.get_hot_keys(n)
+
+    def get_latency_stats(self):
+        """Get summaries of the latencies of operations and of each server.
+
+        This returns a dict with an "operations" entry mapping each type of
+        operation to its latency stats, and a "servers" entry mapping each
+        server address to the latency stats for requests made to it.  See
+        LatencyHistogram.get_stats() for details of the stats.
+        """
+        return {
+            "operations": dict((op, histogram.get_stats())
+                               for (op, histogram)
+                               in self.op_latencies.items()),
+            "servers": dict((server, histogram.get_stats())
+                            for (server, histogram)
+                            in self.server_latencies.iteritems()),
+        }
+
+    def get_breaker_stats(self):
+        """Get the state and counters of each server's circuit-breaker.
+
+        This returns a dict mapping each server address to a dict of metrics
+        from its circuit-breaker, suitable for reporting or logging.
+        """
+        stats = {}
+        for server, breaker in self.breakers.iteritems():
+            stats[server] = breaker.get_stats()
+        return stats
 
     @contextlib.contextmanager
-    def _connect(self):
-        """Context mananager for getting a connection to memcached."""
+    def _connect(self, server):
+        """Context mananager for getting a connection to a memcached server."""
+        breaker = self.breakers.get(server)
+        if breaker is not None:
+            retry_after = breaker.check()
+            if retry_after is not None:
+                annotate_request(None, "mc.breaker.rejected", 1)
+                raise BackendError("circuit-breaker is open", server=server,
+                                   retry_after=retry_after)
         # We could get an error while trying to create a new connection,
         # or when trying to use an existing connection.  This outer
         # try-except handles the logging for both cases.
         try:
-            with self.pool.reserve() as mc:
+            with self.pools[server].reserve() as mc:
                 # If we get an error while using the client object,
                 # disconnect so that it will be removed from the pool.
+                start_time = monotonic_time()
                 try:
                     yield mc
                 except (EnvironmentError, RuntimeError) as err:
                     if mc is not None:
                         mc.disconnect()
                     raise
+                finally:
+                    latency = monotonic_time() - start_time
+                    self.server_latencies[server].record(latency)
         except (EnvironmentError, RuntimeError) as err:
+            if breaker is not None:
+                breaker.record_failure()
             err = traceback.format_exc()
             logger.error(err)
-            raise BackendError(str(err))
+            raise BackendError(str(err), server=server)
+        except BaseException:
+            # Other errors, such as invalid keys or pool checkout timeouts,
+            # say nothing about the server's health.  But if this was the
+            # breaker's trial request, another must be allowed through.
+            if breaker is not None:
+                breaker.release()
+            raise
+        else:
+            if breaker is not None:
+                breaker.record_success()
 
     def _encode_key(self, key):
         """Encode an app-level key into the final form used for storage.
 
-        The default implementation simply adds any configured prefix;
-        subclasses are free to override or extend this functionality.
+        The default implementation adds the current generation of the key's
+        namespace, if it has one, and any configured prefix; subclasses are
+        free to override or extend this functionality.
         """
+        if isinstance(key, tuple):
+            namespace, key = key
+            generation = self._get_generation(namespace)
+            key = "ns:%s:%d:%s" % (namespace, generation, key)
         key = self.key_prefix + key
         if len(key) > self.max_key_size:
             raise ValueError("value too long")
@@ -104,117 +623,1339 @@ class MemcachedClient(object):
         assert key.startswith(self.key_prefix)
         return key[len(self.key_prefix):]
 
+    def _get_generation_key(self, namespace):
+        """Get the storage-level key for a namespace's generation counter."""
+        return "%snsgen:%s" % (self.key_prefix, namespace)
+
+    def _get_generation(self, namespace):
+        """Get the current generation of the given namespace.
+
+        If the namespace has no generation counter in memcached, then one
+        is created starting at a random generation.  That way, if a counter
+        is evicted, it's unlikely to return to a generation used previously.
+        """
+        gen_key = self._get_generation_key(namespace)
+        if self.namespace_cache is not None:
+            generation = self.namespace_cache.get(gen_key)
+            if generation is not None:
+                return generation
+        _, res = self._call_with_failover(gen_key, lambda mc: mc.get(gen_key))
+        if res is not None:
+            generation = int(res[0])
+        else:
+            generation = random.randint(0, MAX_INITIAL_GENERATION)
+            data = str(generation)
+            res = self._call_on_replicas(
+                gen_key, lambda mc: mc.add(gen_key, data, 0, FLAG_RAW),
+                "NOT_STORED")
+            if res != "STORED":
+                # Someone else created it first, so use theirs.
+                _, res = self._call_with_failover(
+                    gen_key, lambda mc: mc.get(gen_key))
+                if res is not None:
+                    generation = int(res[0])
+        if self.namespace_cache is not None:
+            self.namespace_cache.set(gen_key, generation)
+        return generation
+
+    def invalidate_namespace(self, namespace):
+        """Invalidate all keys in the given namespace, in a single operation.
+
+        This increments the namespace's generation counter, so that all
+        keys stored under previous generations become unreachable and will
+        eventually be evicted by memcached.
+        """
+        gen_key = self._get_generation_key(namespace)
+        if self.namespace_cache is not None:
+            self.namespace_cache.pop(gen_key)
+        res = self._call_on_replicas(gen_key, lambda mc: mc.incr(gen_key, 1))
+        if res == "NOT_FOUND":
+            # There is no counter, so start a new one.  This process may
+            # have cached the old generation, so we can't just leave it.
+            self._get_generation(namespace)
+        elif self.namespace_cache is not None:
+            self.namespace_cache.set(gen_key, int(res))
+
     def _encode_value(self, value):
         """Encode an app-level value into the form for final storage.
 
         This method returns the encoded value and any flag bits that
         should be set when storing into memcache to identify the encoding.
-        The default implementation json-encodes all values; subclasses
-        are free to override or extend this functionality.
+        The default implementation serializes values with the configured
+        codec, compressing them if they are large; subclasses are free to
+        override or extend this functionality.
         """
-        value = json.dumps(value)
+        name, flags, dumps, loads = self.codec
+        value = dumps(value)
+        threshold = self.compress_threshold
+        if threshold is not None and len(value) > threshold:
+            compressed_value = zlib.compress(value)
+            # Don't bother if it doesn't actually make it any smaller.
+            if len(compressed_value) < len(value):
+                value = compressed_value
+                flags |= FLAG_COMPRESSED
         if len(value) > self.max_value_size:
             raise ValueError("value too long")
-        return value, 0
+        return value, flags
 
     def _decode_value(self, value, flags):
         """Decode a storage-level value into the form expected by the app.
 
         This method takes the encoded value and any flag bits that were
         set in memcache, and returns the decoded app-level value.
-        The default implementation json-decodes all values; subclasses
-        are free to override or extend this functionality.
+        The default implementation decompresses the value if necessary and
+        decodes it with the codec identified by the flags; subclasses are
+        free to override or extend this functionality.
         """
-        value = json.loads(value)
-        return value
+        if flags & FLAG_COMPRESSED:
+            value = zlib.decompress(value)
+        try:
+            codec = _CODECS_BY_FLAG[flags & CODEC_FLAGS_MASK]
+        except KeyError:
+            raise ValueError("unknown value encoding flags: %r" % (flags,))
+        return codec[3](value)
 
+    @_timed("get")
     def get(self, key):
         """Get the value stored under the given key."""
+        app_key = key
         key = self._encode_key(key)
-        with self._connect() as mc:
-            res = mc.get(key)
+        if self.local_cache is not None:
+            value = self.local_cache.get(key)
+            if value is not None:
+                return value
+        if self.loader is not None:
+            # Check the key now, so that it can't spoil the whole batch.
+            mcprotocol.check_key(key)
+            return self.loader.get(app_key, key)
+        if self.local_cache is None:
+            return self._get_uncached(key)
+        fill = self._start_local_cache_fill([key])
+        value = None
+        try:
+            value = self._get_uncached(key)
+        finally:
+            self._finish_local_cache_fill(fill, {key: value})
+        return value
+
+    def _get_uncached(self, key):
+        """Get the value stored under the given encoded key from memcached."""
+        _, res = self._call_with_failover(key, lambda mc: mc.get(key))
+        if res is not None and res[1] & FLAG_CHUNKED:
+            res = self._load_chunked_values({key: res[0]}).get(key)
+        if self.hot_keys is not None:
+            self.hot_keys.record("get", key, res and len(res[0]))
         if res is None:
             return None
         data, flags = res
         return self._decode_value(data, flags)
 
+    @_timed("gets")
     def gets(self, key):
         """Get the current value and casid for the given key."""
         key = self._encode_key(key)
-        with self._connect() as mc:
-            res = mc.gets(key)
+        _, res = self._call_with_failover(key, lambda mc: mc.gets(key))
         if res is None:
             return None, None
         data, flags, casid = res
+        if flags & FLAG_CHUNKED:
+            res = self._load_chunked_values({key: data}).get(key)
+            if res is None:
+                return None, None
+            data, flags = res
+        if self.hot_keys is not None:
+            self.hot_keys.record("get", key, len(data))
         data = self._decode_value(data, flags)
         return data, casid
 
+    @_timed("get_multi")
     def get_multi(self, keys):
-        """Get the values stored under the given keys in a single request."""
-        with self._connect() as mc:
-            encoded_keys = [self._encode_key(key) for key in keys]
-            encoded_items = mc.get_multi(encoded_keys)
+        """Get the values stored under the given keys in a single request.
+
+        If the keys are spread over several servers then each server is
+        sent a single request, and the requests are made concurrently.
+        """
         items = {}
-        for key, res in encoded_items.iteritems():
-            assert res is not None
-            data, flags = res
-            items[self._decode_key(key)] = self._decode_value(data, flags)
+        app_keys = {}
+        encoded_keys = []
+        for key in keys:
+            encoded_key = self._encode_key(key)
+            app_keys[encoded_key] = key
+            if self.local_cache is not None:
+                value = self.local_cache.get(encoded_key)
+                if value is not None:
+                    items[key] = value
+                    continue
+            encoded_keys.append(encoded_key)
+        if self.local_cache is None or not encoded_keys:
+            values = self._get_multi_uncached(encoded_keys)
+        else:
+            fill = self._start_local_cache_fill(encoded_keys)
+            values = {}
+            try:
+                values = self._get_multi_uncached(encoded_keys)
+            finally:
+                self._finish_local_cache_fill(fill, values)
+        for encoded_key, value in values.iteritems():
+            items[app_keys[encoded_key]] = value
+        return items
+
+    def _get_multi_uncached(self, encoded_keys):
+        """Get the values for some encoded keys from memcached.
+
+        This returns a dict mapping each encoded key to its decoded value,
+        omitting keys that have no value.
+        """
+        results = self._get_multi_encoded(encoded_keys)
+        manifests = {}
+        for encoded_key, (data, flags) in results.items():
+            if flags & FLAG_CHUNKED:
+                manifests[encoded_key] = data
+                del results[encoded_key]
+        if manifests:
+            results.update(self._load_chunked_values(manifests))
+        if self.hot_keys is not None:
+            for encoded_key in encoded_keys:
+                res = results.get(encoded_key)
+                self.hot_keys.record("get", encoded_key, res and len(res[0]))
+        values = {}
+        for encoded_key, (data, flags) in results.iteritems():
+            values[encoded_key] = self._decode_value(data, flags)
+        return values
+
+    def iter_multi(self, keys, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        """Generate (key, value) pairs for the values stored under some keys.
+
+        This is a streaming version of get_multi for very large sets of keys.
+        The keys, which may be given as any iterable, are fetched in batches
+        of "batch_size" using get_multi, and the items from each batch are
+        yielded as soon as it arrives.  Keys with no value are skipped.  Only
+        a couple of batches are held in memory at once, and connections are
+        only held while fetching a batch.
+
+        If network operations can be performed in greenlets, then the next
+        batch is fetched in the background while the caller consumes the
+        items from the current one.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        use_greenlets = self._use_greenlets
+        if use_greenlets is None:
+            use_greenlets = _can_use_greenlets()
+        batches = _iter_batches(keys, batch_size)
+        if not use_greenlets:
+            for batch in batches:
+                for item in self.get_multi(batch).iteritems():
+                    yield item
+            return
+        # Errors are captured so that, if the caller stops early, gevent
+        # won't log them from the abandoned prefetch.
+        pending = None
+        for batch in batches:
+            prefetch = gevent.spawn(_capture_outcome, self.get_multi, batch)
+            if pending is not None:
+                for item in _get_outcome(pending.get()).iteritems():
+                    yield item
+            pending = prefetch
+        if pending is not None:
+            for item in _get_outcome(pending.get()).iteritems():
+                yield item
+
+    def _get_multi_encoded(self, encoded_keys):
+        """Get the raw (data, flags) items stored under some encoded keys.
+
+        The keys are grouped by server, and each server is sent a single
+        request, with the requests to different servers made concurrently.
+        """
+        items = {}
+        replicas_by_key = {}
+        for encoded_key in encoded_keys:
+            replicas_by_key[encoded_key] = self._get_servers(encoded_key)
+        # Request each key from its primary server.  If any server fails,
+        # retry its keys on their next replica until we run out of them.
+        while replicas_by_key:
+            keys_by_server = {}
+            for encoded_key, servers in replicas_by_key.iteritems():
+                keys_by_server.setdefault(servers[0], []).append(encoded_key)
+            arglist = keys_by_server.items()
+            outcomes = _call_concurrently(self._get_multi_from_server,
+                                          arglist, self._use_greenlets)
+            failed_replicas_by_key = {}
+            for (server, encoded_keys), (ok, result) in zip(arglist,
+                                                            outcomes):
+                if not ok:
+                    if not isinstance(result[1], BackendError):
+                        _reraise(result)
+                    for encoded_key in encoded_keys:
+                        servers = replicas_by_key[encoded_key][1:]
+                        if not servers:
+                            _reraise(result)
+                        failed_replicas_by_key[encoded_key] = servers
+                    continue
+                items.update(result)
+            replicas_by_key = failed_replicas_by_key
         return items
 
+    def _store_chunks(self, data, flags, time):
+        """Store a large encoded value as chunks, returning its manifest.
+
+        The returned manifest data and flags should be stored under the
+        value's own key.  If any of the chunks could not be stored then
+        None is returned instead.
+        """
+        version = uuid.uuid4().hex
+        commands = []
+        for index, offset in enumerate(xrange(0, len(data), self.chunk_size)):
+            chunk_key = self._get_chunk_key(version, index)
+            chunk = data[offset:offset + self.chunk_size]
+            cmd = mcprotocol.format_storage_command("set", chunk_key, chunk,
+                                                    0, time)
+            commands.append((chunk_key, chunk_key, cmd))
+        results = self._execute_multi(commands, "STORED")
+        if not all(results.itervalues()):
+            return None
+        checksum = zlib.crc32(data) & 0xFFFFFFFF
+        manifest = "%s %d %d %d %d" % (version, len(commands), len(data),
+                                       checksum, flags)
+        return manifest, FLAG_CHUNKED
+
+    def _load_chunked_values(self, manifests):
+        """Load the chunks for some values stored as chunk manifests.
+
+        This takes a dict mapping encoded keys to manifest data, fetches
+        all of their chunks in a single get_multi, and returns a dict mapping
+        each key to the reassembled (data, flags).  Any values that cannot be
+        completely reassembled are omitted, as if they were missing.
+        """
+        parsed_manifests = {}
+        all_chunk_keys = []
+        for encoded_key, manifest in manifests.iteritems():
+            try:
+                version, num_chunks, size, checksum, flags = manifest.split()
+                num_chunks = int(num_chunks)
+                chunk_keys = [self._get_chunk_key(version, index)
+                              for index in xrange(num_chunks)]
+                parsed_manifests[encoded_key] = (chunk_keys, int(size),
+                                                 int(checksum), int(flags))
+            except ValueError:
+                logger.error("invalid chunk manifest for %r", encoded_key)
+                continue
+            all_chunk_keys.extend(chunk_keys)
+        chunks = self._get_multi_encoded(all_chunk_keys)
+        results = {}
+        for encoded_key, manifest in parsed_manifests.iteritems():
+            chunk_keys, size, checksum, flags = manifest
+            # If any chunk has been evicted, the value is unusable.
+            if not all(chunk_key in chunks for chunk_key in chunk_keys):
+                continue
+            data = "".join(chunks[chunk_key][0] for chunk_key in chunk_keys)
+            if len(data) != size:
+                continue
+            if zlib.crc32(data) & 0xFFFFFFFF != checksum:
+                continue
+            results[encoded_key] = (data, flags)
+        return results
+
+    def _get_chunk_key(self, version, index):
+        """Get the storage-level key for a chunk of a large value."""
+        return "%schunk:%s:%d" % (self.key_prefix, version, index)
+
+    def _encode_for_storage(self, key, value, time):
+        """Encode a value, storing it as chunks if necessary.
+
+        This returns the data and flags to store under the value's encoded
+        key, or None if the value was too large and its chunks could not be
+        stored.
+        """
+        data, flags = self._encode_value(value)
+        if self.hot_keys is not None:
+            self.hot_keys.record("set", key, len(data))
+        if self.chunk_size is not None and len(data) > self.chunk_size:
+            return self._store_chunks(data, flags, time)
+        return data, flags
+
+    def _get_multi_from_server(self, server, encoded_keys):
+        """Get the values for some encoded keys from a single server."""
+        with self._connect(server) as mc:
+            return mc.get_multi(encoded_keys)
+
+    @_timed("set")
     def set(self, key, value, time=0):
         """Set the value stored under the given key."""
         key = self._encode_key(key)
-        data, flags = self._encode_value(value)
-        with self._connect() as mc:
-            res = mc.set(key, data, time, flags)
+        encoded = self._encode_for_storage(key, value, time)
+        if encoded is None:
+            return False
+        data, flags = encoded
+        with self._invalidating_local_cache([key]):
+            res = self._call_on_replicas(
+                key, lambda mc: mc.set(key, data, time, flags))
         if res != "STORED":
             return False
         return True
 
+    @_timed("add")
     def add(self, key, value, time=0):
-        """Add the given key to memcached if not already present."""
+        """Add the given key to memcached if not already present.
+
+        If keys are replicated then this fails if the key was present on any
+        of the reachable replicas, not just the first of them.
+        """
         key = self._encode_key(key)
-        data, flags = self._encode_value(value)
-        with self._connect() as mc:
-            res = mc.add(key, data, time, flags)
+        encoded = self._encode_for_storage(key, value, time)
+        if encoded is None:
+            return False
+        data, flags = encoded
+        with self._invalidating_local_cache([key]):
+            res = self._call_on_replicas(
+                key, lambda mc: mc.add(key, data, time, flags), "NOT_STORED")
         if res != "STORED":
             return False
         return True
 
+    @_timed("replace")
     def replace(self, key, value, time=0):
         """Replace the given key in memcached if it is already present."""
         key = self._encode_key(key)
-        data, flags = self._encode_value(value)
-        with self._connect() as mc:
-            res = mc.replace(key, data, time, flags)
+        encoded = self._encode_for_storage(key, value, time)
+        if encoded is None:
+            return False
+        data, flags = encoded
+        with self._invalidating_local_cache([key]):
+            res = self._call_on_replicas(
+                key, lambda mc: mc.replace(key, data, time, flags))
         if res != "STORED":
             return False
         return True
 
+    @_timed("cas")
     def cas(self, key, value, casid, time=0):
         """Set the value stored under the given key if casid matches."""
         key = self._encode_key(key)
-        data, flags = self._encode_value(value)
-        with self._connect() as mc:
+        encoded = self._encode_for_storage(key, value, time)
+        if encoded is None:
+            return False
+        data, flags = encoded
+        with self._invalidating_local_cache([key]):
             # Memcached's CAS only works properly on existing keys.
             # Fortunately ADD has the same semantics for missing keys.
             if casid is None:
-                res = mc.add(key, data, time, flags)
+                res = self._call_on_replicas(
+                    key, lambda mc: mc.add(key, data, time, flags),
+                    "NOT_STORED")
             else:
-                res = mc.cas(key, data, casid, time, flags)
+                # The casid is only meaningful to the server that issued it,
+                # so we must do the CAS on the same replica that gets() used.
+                # If it succeeds, copy the new value to the other replicas.
+                server, res = self._call_with_failover(
+                    key, lambda mc: mc.cas(key, data, casid, time, flags))
+                if res == "STORED" and self.replicas > 1:
+                    self._copy_to_replicas(key, data, time, flags, server)
         if res != "STORED":
             return False
         return True
 
+    def _copy_to_replicas(self, key, data, time, flags, source):
+        """Store a value on all replicas except the given source server.
+
+        This is done on a best-effort basis, ignoring any errors, so the
+        sets are sent with "noreply" to avoid waiting for the results.
+        """
+        def set_on_server(server):
+            with self._connect(server) as mc:
+                return mc.set(key, data, time, flags, True)
+
+        servers = [s for s in self._get_servers(key) if s != source]
+        _call_concurrently(set_on_server, [(s,) for s in servers],
+                           self._use_greenlets)
+
+    @_timed("delete")
     def delete(self, key):
         """Delete the value stored under the given key."""
         key = self._encode_key(key)
-        with self._connect() as mc:
-            res = mc.delete(key)
+        with self._invalidating_local_cache([key]):
+            res = self._call_on_replicas(key, lambda mc: mc.delete(key))
         if res != "DELETED":
             return False
         return True
 
+    @_timed("incr")
+    def incr(self, key, delta=1):
+        """Increment the integer stored under the given key.
+
+        The value must have been stored as a decimal integer, for example
+        by storing an int with the JSON codec.  This returns the new value,
+        or None if there was no value stored under the key.
+        """
+        return self._arith("incr", key, delta)
+
+    @_timed("decr")
+    def decr(self, key, delta=1):
+        """Decrement the integer stored under the given key.
+
+        Memcached will not decrement a value below zero.  This returns the
+        new value, or None if there was no value stored under the key.
+        """
+        return self._arith("decr", key, delta)
+
+    def _arith(self, command, key, delta):
+        """Send an incr or decr command, returning the new value.
+
+        If the stored value is not a number then this raises ValueError.
+        That's a problem with the application's data rather than with the
+        server, so it doesn't count against the server's circuit breaker.
+        """
+        key = self._encode_key(key)
+        with self._invalidating_local_cache([key]):
+            res = self._call_on_replicas(
+                key, lambda mc: _call_arith(mc, command, key, delta))
+        if res == "NOT_FOUND":
+            return None
+        if res.startswith("CLIENT_ERROR"):
+            raise ValueError("cannot %s %r: %s" % (command, key, res))
+        return int(res)
+
+    def set_later(self, key, value, time=0):
+        """Set the value stored under the given key, in the background.
+
+        If write-behind is enabled, this adds the write to the buffer and
+        returns True, or returns False if it was dropped because the buffer
+        is full.  Reads will not see the new value until it is flushed.  If
+        write-behind is not enabled then this is the same as set().
+        """
+        if self.write_buffer is None:
+            return self.set(key, value, time)
+        return self.write_buffer.set(key, value, time)
+
+    def incr_later(self, key, delta=1):
+        """Increment the integer stored under the given key, in the background.
+
+        If write-behind is enabled, this adds the increment to the buffer and
+        returns True, or returns False if it was dropped because the buffer
+        is full.  If there's no value stored under the key when the increment
+        is flushed, then the value is initialized to the delta.  If
+        write-behind is not enabled then this increments the value straight
+        away, without initializing it, and returns the new value.
+        """
+        if self.write_buffer is None:
+            return self.incr(key, delta)
+        return self.write_buffer.incr(key, delta)
+
+    def get_or_compute(self, key, compute, ttl, stale_ttl=None, jitter=0,
+                       lock_ttl=DEFAULT_RECOMPUTE_LOCK_TTL,
+                       lock_wait=DEFAULT_RECOMPUTE_LOCK_WAIT):
+        """Get the value stored under the given key, computing it if needed.
+
+        This method implements the cache-aside pattern while avoiding a
+        "dogpile" of processes that all try to recompute a popular value at
+        the moment it expires.  If there is no fresh value stored under the
+        key, the function "compute" is called to produce a new one, which is
+        stored for "ttl" seconds.
+
+        Values are stored along with a "soft" expiry time, and are kept in
+        memcached for a further "stale_ttl" seconds after they become stale
+        (by default, for as long again as the ttl).  The first process to
+        find a stale value takes a lock and recomputes it, while any others
+        continue to use the stale value in the meantime.  If there's no value
+        at all and another process holds the lock, we wait up to "lock_wait"
+        seconds for it to store one before computing it ourselves.
+
+        If given, "jitter" is the maximum fraction by which to randomly reduce
+        the ttl, so that values computed together do not all expire together.
+        If compute() fails while recomputing a stale value then the error is
+        logged and the stale value is returned, leaving the next caller to
+        try again.  The time spent in memcached is capped at thirty days.
+
+        Values are stored wrapped in a dict, so they must be stored and read
+        only via this method, using a codec that can represent dicts.
+        """
+        if isinstance(key, tuple):
+            lock_key = (key[0], key[1] + ".recompute-lock")
+        else:
+            lock_key = key + ".recompute-lock"
+        stored = self.get(key)
+        if stored is not None:
+            if stored["expires"] > time.time():
+                return stored["value"]
+            # It's stale.  Recompute it only if nobody else is doing so.
+            if not self.add(lock_key, 1, lock_ttl):
+                return stored["value"]
+        elif not self.add(lock_key, 1, lock_ttl):
+            # It's missing and somebody else is computing it.
+            # Wait for a little while in the hope that they'll finish.
+            deadline = time.time() + lock_wait
+            while time.time() < deadline:
+                time.sleep(RECOMPUTE_POLL_INTERVAL)
+                stored = self.get(key)
+                if stored is not None:
+                    return stored["value"]
+            return compute()
+        # We have the lock, so compute and store the new value.
+        try:
+            try:
+                value = compute()
+            except Exception:
+                if stored is None:
+                    raise
+                logger.error("could not recompute %r, using stale value", key)
+                logger.error(traceback.format_exc())
+                return stored["value"]
+            if jitter:
+                ttl = ttl * (1 - random.random() * jitter)
+            if stale_ttl is None:
+                stale_ttl = ttl
+            stored = {"value": value, "expires": time.time() + ttl}
+            self.set(key, stored, min(int(ttl + stale_ttl),
+                                      MAX_RELATIVE_EXPIRY))
+            return value
+        finally:
+            self.delete(lock_key)
+
+    @_timed("set_multi")
+    def set_multi(self, items, time=0):
+        """Set the values stored under multiple keys in a single request.
+
+        The items must be given as a dict mapping keys to values.  This
+        method returns a dict mapping each key to a boolean indicating
+        whether it was successfully stored.
+        """
+        return self._store_multi("set", items, time)
+
+    @_timed("add_multi")
+    def add_multi(self, items, time=0):
+        """Add multiple keys to memcached if not already present.
+
+        The items must be given as a dict mapping keys to values.  This
+        method returns a dict mapping each key to a boolean indicating
+        whether it was successfully added.
+        """
+        return self._store_multi("add", items, time)
+
+    @_timed("delete_multi")
+    def delete_multi(self, keys):
+        """Delete the values stored under multiple keys in a single request.
+
+        This method returns a dict mapping each key to a boolean indicating
+        whether it was successfully deleted.
+        """
+        commands = []
+        for key in keys:
+            encoded_key = self._encode_key(key)
+            cmd = mcprotocol.format_delete_command(encoded_key)
+            commands.append((key, encoded_key, cmd))
+        return self._execute_multi(commands, "DELETED")
+
+    def _store_multi(self, command, items, time):
+        """Send a batch of storage commands of the given type."""
+        commands = []
+        failed_keys = []
+        for key, value in items.iteritems():
+            encoded_key = self._encode_key(key)
+            encoded = self._encode_for_storage(encoded_key, value, time)
+            if encoded is None:
+                failed_keys.append(key)
+                continue
+            data, flags = encoded
+            cmd = mcprotocol.format_storage_command(command, encoded_key,
+                                                    data, flags, time)
+            commands.append((key, encoded_key, cmd))
+        veto_status = "NOT_STORED" if command == "add" else None
+        results = self._execute_multi(commands, "STORED", veto_status)
+        for key in failed_keys:
+            results[key] = False
+        return results
+
+    def _execute_multi(self, commands, success_status, veto_status=None):
+        """Execute a batch of commands, pipelined to each server.
+
+        The commands must be given as a list of (key, encoded_key, command)
+        tuples.  They are grouped by server, and each group is sent to its
+        server as a single pipelined request, with the requests to different
+        servers made concurrently.  Returns a dict mapping each key to a
+        boolean indicating whether its command returned the success status.
+
+        If keys are replicated then each command is sent to every replica,
+        and its result is taken from the first replica that was reachable,
+        unless any reachable replica returned the veto status, in which case
+        it is taken to have failed.
+        """
+        keys_by_server = {}
+        commands_by_server = {}
+        replicas_by_key = {}
+        for key, encoded_key, cmd in commands:
+            replicas_by_key[key] = self._get_servers(encoded_key)
+            for server in replicas_by_key[key]:
+                keys_by_server.setdefault(server, []).append(key)
+                commands_by_server.setdefault(server, []).append(cmd)
+        servers = commands_by_server.keys()
+        encoded_keys = [encoded_key for (_, encoded_key, _) in commands]
+        with self._invalidating_local_cache(encoded_keys):
+            outcomes = _call_concurrently(self._pipeline_to_server,
+                                          [(s, commands_by_server[s])
+                                           for s in servers],
+                                          self._use_greenlets)
+        statuses_by_server = {}
+        error = None
+        for server, (ok, result) in zip(servers, outcomes):
+            if ok:
+                statuses = zip(keys_by_server[server], result)
+                statuses_by_server[server] = dict(statuses)
+            elif not isinstance(result[1], BackendError):
+                _reraise(result)
+            elif error is None:
+                error = result
+        results = {}
+        for key, replicas in replicas_by_key.iteritems():
+            statuses = [statuses_by_server[server][key]
+                        for server in replicas
+                        if server in statuses_by_server]
+            if not statuses:
+                _reraise(error)
+            if veto_status is not None and veto_status in statuses:
+                results[key] = False
+            else:
+                results[key] = (statuses[0] == success_status)
+        return results
+
+    @contextlib.contextmanager
+    def _invalidating_local_cache(self, keys):
+        """Context-manager to invalidate local cache entries around a write.
+
+        Entries are discarded both before and after the enclosed write, and
+        any fetches of the keys that are in progress meanwhile are prevented
+        from filling the cache.  Otherwise a get that read the old value
+        before the write could cache it after the write had completed.
+        Likewise, gets that start after the write will not join a batched
+        fetch that was already in flight.
+        """
+        self._invalidate_local_cache(keys)
+        try:
+            yield
+        finally:
+            self._invalidate_local_cache(keys)
+            if self.loader is not None:
+                self.loader.forget(keys)
+
+    def _invalidate_local_cache(self, keys):
+        """Discard any locally-cached values for the given encoded keys."""
+        if self.local_cache is not None:
+            with self._local_cache_lock:
+                for key in keys:
+                    self.local_cache.pop(key)
+                    self._local_cache_fills.pop(key, None)
+
+    def _start_local_cache_fill(self, keys):
+        """Note the start of a fetch whose results may fill the local cache.
+
+        This returns a token to pass to _finish_local_cache_fill() along with
+        the fetched values.  If any of the keys are written in the meantime,
+        their values will not be cached.
+        """
+        token = object()
+        with self._local_cache_lock:
+            for key in keys:
+                self._local_cache_fills[key] = token
+        return (token, keys)
+
+    def _finish_local_cache_fill(self, fill, values):
+        """Cache the values from a fetch, unless they've since been written."""
+        token, keys = fill
+        with self._local_cache_lock:
+            for key in keys:
+                if self._local_cache_fills.get(key) is token:
+                    del self._local_cache_fills[key]
+                    value = values.get(key)
+                    if value is not None:
+                        self.local_cache.set(key, value)
+
+    def _pipeline_to_server(self, server, commands):
+        """Send a batch of commands to a server as a single request."""
+        with self._connect(server) as mc:
+            return _pipeline(mc, commands)
+
+
+def _call_arith(mc, command, key, delta):
+    """Send an incr or decr command on the given connection.
+
+    The pure-python connection classes return a "CLIENT_ERROR" reply if
+    the stored value is not a number, but umemcache raises it as an error.
+    This converts the latter into the former, so that it doesn't look like
+    a connection failure to the caller.
+    """
+    try:
+        return getattr(mc, command)(key, delta)
+    except RuntimeError as e:
+        if isinstance(e, mcprotocol.ProtocolError):
+            raise
+        msg = str(e)
+        if "CLIENT_ERROR" not in msg:
+            raise
+        return msg[msg.index("CLIENT_ERROR"):]
+
+
+def _pipeline(mc, commands):
+    """Send a batch of commands over a connection, returning their replies.
+
+    Pure-python connection classes provide a pipeline() method for this.
+    umemcache has no API for pipelining multiple commands, but it exposes
+    its underlying socket and keeps no buffered state between requests, so
+    we can speak the protocol directly over the socket to do it ourselves.
+    """
+    pipeline = getattr(mc, "pipeline", None)
+    if pipeline is not None:
+        return pipeline(commands)
+    return mcprotocol.pipeline(mc.sock, commands)
+
+
+def _call_concurrently(func, arglist, use_greenlets=None):
+    """Call func(*args) for each item in arglist, concurrently if possible.
+
+    If use_greenlets is true, or if it is None and gevent has monkey-patched
+    the socket module, then each call is made in a separate greenlet so that
+    any network requests are performed concurrently.  Otherwise the calls
+    are made one at a time.
+
+    The outcomes are returned in a list in the same order as arglist.  Each
+    is a tuple (True, result) if the call succeeded, or (False, exc_info)
+    if it raised an error.
+    """
+    if use_greenlets is None:
+        use_greenlets = _can_use_greenlets()
+    if len(arglist) <= 1 or not use_greenlets:
+        return [_capture_outcome(func, *args) for args in arglist]
+    greenlets = [gevent.spawn(_capture_outcome, func, *args)
+                 for args in arglist]
+    gevent.joinall(greenlets)
+    return [greenlet.value for greenlet in greenlets]
+
+
+def _capture_outcome(func, *args):
+    """Call func(*args), returning (True, result) or (False, exc_info).
+
+    Trapping errors like this stops gevent from logging them as unhandled
+    when the call is made in a separate greenlet.
+    """
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, sys.exc_info()
+
+
+def _get_outcome(outcome):
+    """Get the result of an outcome captured by _capture_outcome()."""
+    ok, result = outcome
+    if not ok:
+        _reraise(result)
+    return result
+
+
+def _iter_batches(items, batch_size):
+    """Generate lists of up to batch_size items from the given iterable."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _first_success(outcomes):
+    """Get the first successful result from a list of captured outcomes.
+
+    Errors other than BackendError are re-raised immediately, since they
+    indicate a problem with the request rather than with the server.  If
+    every outcome is a BackendError then the first one is re-raised.
+    """
+    for ok, result in outcomes:
+        if not ok and not isinstance(result[1], BackendError):
+            _reraise(result)
+    for ok, result in outcomes:
+        if ok:
+            return result
+    _reraise(outcomes[0][1])
+
+
+def _reraise(exc_info):
+    """Re-raise an error captured by sys.exc_info()."""
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def _can_use_greenlets():
+    """Check whether we can perform network operations in greenlets."""
+    if gevent is None:
+        return False
+    return gevent.monkey.is_module_patched("socket")
+
+
+class BatchingLoader(object):
+    """Helper for combining concurrent gets into batched requests.
+
+    This class implements the "DataLoader" pattern for a MemcachedClient,
+    using gevent.  When a greenlet calls get(), the key is added to a pending
+    batch and the greenlet waits for the result.  The batch is sent as a
+    single get_multi once all the greenlets that are ready to run have had
+    a chance to add their own keys, i.e. at the end of the current tick of
+    the event loop.  If a key is already pending or being fetched, then
+    the greenlet simply waits for that existing result.  The client calls
+    forget() after writing to a key, so that later gets won't wait on a
+    fetch that may have read the old value.
+
+    All greenlets waiting on a batch will see any error it raises.  Since
+    it relies on gevent primitives, the loader must not be shared between
+    real threads.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._pending = {}
+        self._in_flight = {}
+        self._flush_scheduled = False
+        # Counters for reporting purposes.
+        self.gets = 0
+        self.batches = 0
+        self.deduplicated = 0
+
+    def get(self, key, encoded_key):
+        """Get the value stored under the given key, as part of a batch."""
+        self.gets += 1
+        result = None
+        if encoded_key in self._pending:
+            result = self._pending[encoded_key][1]
+        else:
+            result = self._in_flight.get(encoded_key)
+        if result is not None:
+            self.deduplicated += 1
+            annotate_request(None, "mc.loader.deduplicated", 1)
+        else:
+            result = gevent.event.AsyncResult()
+            self._pending[encoded_key] = (key, result)
+            if not self._flush_scheduled:
+                # Spawned greenlets start only after those already waiting
+                # to run, so this will give them a chance to join the batch.
+                self._flush_scheduled = True
+                gevent.spawn(self._flush)
+        return result.get()
+
+    def forget(self, encoded_keys):
+        """Stop later gets of the given keys from joining in-flight fetches.
+
+        Pending fetches haven't been sent yet, so they can still be joined.
+        """
+        for key in encoded_keys:
+            self._in_flight.pop(key, None)
+
+    def get_stats(self):
+        """Get a dict of counters describing the loader's activity."""
+        return {
+            "gets": self.gets,
+            "batches": self.batches,
+            "deduplicated": self.deduplicated,
+        }
+
+    def _flush(self):
+        """Fetch all pending keys with a single get_multi."""
+        self._flush_scheduled = False
+        batch = self._pending
+        self._pending = {}
+        for encoded_key, (_, result) in batch.iteritems():
+            self._in_flight[encoded_key] = result
+        self.batches += 1
+        try:
+            items = self.client.get_multi([key for (key, _) in
+                                           batch.itervalues()])
+        except Exception:
+            exc_info = sys.exc_info()
+            for _, result in batch.itervalues():
+                result.set_exception(exc_info[1], exc_info)
+        else:
+            for key, result in batch.itervalues():
+                result.set(items.get(key))
+        finally:
+            for encoded_key, (_, result) in batch.iteritems():
+                if self._in_flight.get(encoded_key) is result:
+                    del self._in_flight[encoded_key]
+
+
+class HotKeySampler(object):
+    """Sampler for finding the keys that a client uses most heavily.
+
+    A random "sample_rate" fraction of the keys passed to record() are
+    counted in a SpaceSavingCounter for their type of operation, along with
+    the size of the values involved.  Unsampled keys cost only a call to
+    random.random(), so sampling can be left enabled in production.
+
+    If "log_interval" is given then the hottest keys are logged at intervals
+    of that many seconds, after which the counts are reset so that each log
+    message describes a recent window of activity.  The check is made when
+    recording a sampled key, so no background thread is needed.
+    """
+
+    def __init__(self, sample_rate, capacity=DEFAULT_HOT_KEY_CAPACITY,
+                 log_interval=None, get_time=None):
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.log_interval = log_interval
+        self.get_time = get_time or monotonic_time
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._next_log_time = None
+        if log_interval is not None:
+            self._next_log_time = self.get_time() + log_interval
+
+    def record(self, op, key, size=None):
+        """Record an operation of the given type on the given key."""
+        if random.random() >= self.sample_rate:
+            return
+        with self._lock:
+            counter = self._counters.get(op)
+            if counter is None:
+                counter = SpaceSavingCounter(self.capacity)
+                self._counters[op] = counter
+            counter.add(key, size or 0)
+            if self._next_log_time is None:
+                return
+            now = self.get_time()
+            if now < self._next_log_time:
+                return
+            self._next_log_time = now + self.log_interval
+            hot_keys = self._get_hot_keys(DEFAULT_HOT_KEY_LOG_COUNT)
+            for counter in self._counters.itervalues():
+                counter.clear()
+        for op, keys in sorted(hot_keys.iteritems()):
+            logger.info("hot memcached keys for %s: %s", op,
+                        ", ".join("%s (count=%d, bytes=%d)" % item[:3]
+                                  for item in keys))
+
+    def get_hot_keys(self, n=DEFAULT_HOT_KEY_LOG_COUNT):
+        """Get estimates of the top n keys for each type of operation.
+
+        This returns a dict mapping each operation type to a list of
+        (key, count, bytes, error) tuples, hottest first.  The count and
+        bytes are estimates of the true totals, scaled up from the sampled
+        values, and the count may be over-estimated by up to the error.
+        """
+        with self._lock:
+            return self._get_hot_keys(n)
+
+    def _get_hot_keys(self, n):
+        scale = 1 / self.sample_rate
+        hot_keys = {}
+        for op, counter in self._counters.iteritems():
+            hot_keys[op] = [(key, int(count * scale), int(size * scale),
+                             int(error * scale))
+                            for (key, count, error, size) in counter.top(n)]
+        return hot_keys
+
+
+# Marker for buffered entries that have an increment but no value to set.
+_NO_VALUE = object()
+
+
+class WriteBehindBuffer(object):
+    """Bounded buffer of writes to be sent to memcached in the background.
+
+    Writes are held in the buffer by key, so that repeated writes to the
+    same key are coalesced: a set replaces any earlier buffered write to
+    the key, while increments are summed and applied after any buffered set.
+    A background thread flushes the buffer every "interval" seconds, sending
+    all the sets with each ttl in a single set_multi.
+
+    The buffer holds at most "max_size" keys.  When it is full, writes to
+    keys that are not already buffered are dropped, so that the writes that
+    were buffered first are the ones that get sent; the flush is also
+    brought forward.  Writes that fail when flushed are logged and counted,
+    but not retried.  The thread holds only a weak reference to the buffer,
+    and will exit once the buffer is closed or garbage-collected.
+    """
+
+    def __init__(self, client, max_size,
+                 interval=DEFAULT_WRITE_BEHIND_INTERVAL):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.client = client
+        self.max_size = max_size
+        self.interval = interval
+        self.closed = False
+        # Maps each key to a list of [value, delta, ttl].
+        self._items = {}
+        self._lock = threading.Lock()
+        # Counters for reporting purposes.
+        self.writes = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._wakeup = threading.Event()
+        flusher = threading.Thread(target=_run_flusher,
+                                   args=(weakref.ref(self), interval,
+                                         self._wakeup))
+        flusher.daemon = True
+        flusher.start()
+
+    def set(self, key, value, time=0):
+        """Buffer a set, returning False if it had to be dropped."""
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return False
+            entry[:] = [value, 0, time]
+        return True
+
+    def incr(self, key, delta=1):
+        """Buffer an increment, returning False if it had to be dropped."""
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return False
+            entry[1] += delta
+        return True
+
+    def _get_entry(self, key):
+        """Get the buffered entry for a key, or None if it must be dropped.
+
+        This must be called with the lock held.
+        """
+        self.writes += 1
+        entry = self._items.get(key)
+        if entry is not None:
+            self.coalesced += 1
+            return entry
+        if len(self._items) >= self.max_size:
+            self.dropped += 1
+            annotate_request(None, "mc.writebehind.dropped", 1)
+            self._wakeup.set()
+            return None
+        entry = self._items[key] = [_NO_VALUE, 0, 0]
+        return entry
+
+    def get_stats(self):
+        """Get a dict of counters describing the buffer's activity.
+
+        The "pending" counter is the number of keys currently buffered,
+        "coalesced" counts writes merged into an already-buffered key, and
+        "failed" counts buffered writes that could not be sent.
+        """
+        with self._lock:
+            return {
+                "pending": len(self._items),
+                "writes": self.writes,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "flushed": self.flushed,
+                "failed": self.failed,
+            }
+
+    def flush(self):
+        """Send all buffered writes to memcached."""
+        with self._lock:
+            items = self._items
+            self._items = {}
+        if not items:
+            return
+        sets_by_ttl = {}
+        increments = []
+        for key, (value, delta, ttl) in items.iteritems():
+            if value is not _NO_VALUE:
+                sets_by_ttl.setdefault(ttl, {})[key] = value
+            if delta:
+                increments.append((key, delta))
+        flushed = failed = 0
+        for ttl, batch in sets_by_ttl.iteritems():
+            try:
+                results = self.client.set_multi(batch, ttl)
+            except BackendError:
+                logger.error(traceback.format_exc())
+                failed += len(batch)
+            else:
+                stored = sum(1 for ok in results.itervalues() if ok)
+                flushed += stored
+                failed += len(batch) - stored
+        for key, delta in increments:
+            try:
+                if self._apply_increment(key, delta):
+                    flushed += 1
+                else:
+                    failed += 1
+            except (BackendError, ValueError):
+                logger.error(traceback.format_exc())
+                failed += 1
+        with self._lock:
+            self.flushed += flushed
+            self.failed += failed
+
+    def _apply_increment(self, key, delta):
+        """Apply a summed increment, returning True if it succeeded."""
+        if delta < 0:
+            return self.client.decr(key, -delta) is not None
+        if self.client.incr(key, delta) is not None:
+            return True
+        # There's no value yet, so initialize it.  If somebody else beat
+        # us to it, then our increment can be applied to their value.
+        if self.client.add(key, delta):
+            return True
+        return self.client.incr(key, delta) is not None
+
+    def close(self):
+        """Stop the flusher thread, and flush any remaining writes."""
+        self.closed = True
+        self._wakeup.set()
+        self.flush()
+
+
+class ConsistentHashRing(object):
+    """Ketama-style consistent hash ring for mapping keys to servers.
+
+    This class assigns keys to servers using a scheme modelled on the
+    "ketama" consistent hashing algorithm used by libmemcached and many
+    other memcached clients.  Each server is hashed onto a number of points
+    around a circle, and each key is assigned to the server whose point
+    follows the hash of the key.
+
+    The big advantage of this scheme is that adding or removing a server
+    will only remap around 1/N of the keys, rather than re-shuffling them
+    all as would happen with a simple hash-modulo-N scheme.
+    """
+
+    def __init__(self, servers, points_per_server=160):
+        self.servers = list(servers)
+        points = []
+        for server in self.servers:
+            # Each md5 digest gives us four 32-bit points on the ring.
+            for i in xrange(points_per_server // 4):
+                digest = md5("%s-%d" % (server, i)).digest()
+                for offset in (0, 4, 8, 12):
+                    points.append((self._unpack_hash(digest, offset), server))
+        points.sort()
+        self._points = [p[0] for p in points]
+        self._servers = [p[1] for p in points]
+
+    def get_server(self, key):
+        """Get the server to which the given key is assigned."""
+        return self.get_servers(key, 1)[0]
+
+    def get_servers(self, key, count):
+        """Get the first "count" distinct servers following the given key.
+
+        This is used to choose servers for replicas of a key.  The first
+        server in the list is always the one returned by get_server().
+        """
+        if not self._points:
+            raise ValueError("no servers in the hash ring")
+        count = min(count, len(set(self.servers)))
+        point = self._unpack_hash(md5(key).digest())
+        idx = bisect.bisect(self._points, point)
+        servers = []
+        while len(servers) < count:
+            # Wrap around to the start of the ring if necessary.
+            if idx == len(self._points):
+                idx = 0
+            if self._servers[idx] not in servers:
+                servers.append(self._servers[idx])
+            idx += 1
+        return servers
+
+    @staticmethod
+    def _unpack_hash(digest, offset=0):
+        return struct.unpack_from("<I", digest, offset)[0]
+
+
+class CircuitBreaker(object):
+    """Circuit-breaker for tracking the health of a single server.
+
+    The breaker starts out "closed", allowing requests through as normal.
+    After "threshold" consecutive failures it becomes "open", and callers
+    should fail fast rather than sending requests to the server.  Once the
+    "timeout" has passed it becomes "half-open", and a single trial request
+    is allowed through.  If the trial succeeds the breaker closes again,
+    and if it fails the breaker re-opens for another timeout period.
+
+    Callers should use check() before each request, which returns None if
+    the request should proceed or the number of seconds after which to retry
+    if it should not, and then record_success() or record_failure() once the
+    request is complete.  If the request ends in a way that says nothing
+    about the server's health, they should call release() instead.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 timeout=DEFAULT_BREAKER_TIMEOUT, get_time=None, name=""):
+        self.name = name
+        self.threshold = threshold
+        self.timeout = timeout
+        self.get_time = get_time or monotonic_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        # Counters for reporting purposes.
+        self.trips = 0
+        self.rejected = 0
+
+    def check(self):
+        """Check whether a request should be allowed through."""
+        if self.state == self.CLOSED:
+            return None
+        now = self.get_time()
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.timeout - now
+            if remaining > 0:
+                self.rejected += 1
+                return max(1, int(math.ceil(remaining)))
+            self.state = self.HALF_OPEN
+            self.trial_started_at = None
+        # We're half-open, so let through a single trial request.  If that
+        # request never reports back, let through another after a timeout.
+        trial_started_at = self.trial_started_at
+        if trial_started_at is None or trial_started_at + self.timeout <= now:
+            self.trial_started_at = now
+            return None
+        self.rejected += 1
+        return max(1, int(math.ceil(trial_started_at + self.timeout - now)))
+
+    def record_success(self):
+        """Record a successful request, closing the breaker."""
+        if self.state != self.CLOSED:
+            logger.info("circuit-breaker for %s closed", self.name)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_started_at = None
+
+    def record_failure(self):
+        """Record a failed request, opening the breaker if necessary."""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                logger.warn("circuit-breaker for %s opened after %d failures",
+                            self.name, self.failures)
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = self.get_time()
+            self.trial_started_at = None
+
+    def release(self):
+        """Record a request that neither succeeded nor failed.
+
+        This leaves the breaker's state unchanged, but if it's half-open
+        then another trial request is allowed straight away.
+        """
+        self.trial_started_at = None
+
+    def get_stats(self):
+        """Get a dict of metrics describing the state of the breaker."""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
 
 # Sentinel used to mark an empty slot in the MCClientPool queue.
 # Using sys.maxint as the timestamp ensures that empty slots will always
@@ -223,16 +1964,19 @@ EMPTY_SLOT = (sys.maxint, None)
 
 
 class MCClientPool(object):
-    """Pool of umemcache.Client objects, with periodic purging of connections.
+    """Pool of memcached Client objects, with periodic purging of connections.
 
-    This class implements a simple pool of umemcache Client objects, with
+    This class implements a simple pool of memcached Client objects, with
     periodically closing and refreshing of the pooled Client objects.  This
     seems to work around some occasional hangs that were occurring with
     long-lived clients.
 
     To initialise the pool you must provide the server address to access.
     You may also specify the maximum size of the pool and the time after
-    which old connections will be recycled.
+    which old connections will be recycled.  The Client objects are created
+    by calling "factory" with the server address; by default they are
+    umemcache.Client objects if that module is available, or otherwise
+    pure-python mcprotocol.Connection objects.
 
     To obtain a Client object from the pool, call reserve() as a context
     manager like this::
@@ -241,23 +1985,71 @@ class MCClientPool(object):
             mc.set("hello", "world")
             assert ms.get("hello") == "world"
 
+    By default the pool hands out the oldest connection first, which spreads
+    requests evenly over all the connections.  If "lifo" is true it hands out
+    the most recently used connection first instead, so that connections not
+    needed under the current load are left idle and can be recycled.
+
+    If "prewarm" is true then the pool opens its connections up front, rather
+    than when first needed.  If "reap_interval" is given then a background
+    thread will check the pool every that many seconds, closing any idle
+    connections that are stale so that requests do not have to wait while
+    they are replaced.  Fresh connections are opened in their place, except
+    in LIFO mode where the pool is instead allowed to shrink.
+
+    If the pool has a maxsize and "checkout_timeout" is given, then callers
+    will wait at most that many seconds for a connection to become available
+    before failing with BackendTimeoutError.
+
+    The pool keeps counters of its activity, which can be read by calling
+    get_stats().  Checkout wait times, new and recycled connections, and
+    timeouts are also added to the metrics of the current request under
+    the "mc.pool.*" keys.
     """
 
-    def __init__(self, server, maxsize=None, timeout=60):
+    def __init__(self, server, maxsize=None, timeout=60, lifo=False,
+                 prewarm=False, reap_interval=None, checkout_timeout=None,
+                 factory=None):
+        if factory is None:
+            if umemcache is not None:
+                factory = umemcache.Client
+            else:
+                factory = mcprotocol.Connection
         self.server = server
+        self.factory = factory
         self.maxsize = maxsize
         self.timeout = timeout
+        self.lifo = lifo
+        self.checkout_timeout = checkout_timeout
+        # Counters for reporting purposes.
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_wait_time = 0
+        self.checkout_wait_max = 0
+        self.connections_created = 0
+        self.connections_recycled = 0
+        self.in_use = 0
+        self.in_use_high_water = 0
+        self.timeouts = 0
         # Use a synchronized Queue class to hold the active client objects.
         # It will contain tuples (connection_timestamp, client).
         # Using a PriorityQueue ensures that the oldest connection is always
         # used first, allowing them to be closed out when stale.  It also means
         # that a no-maxsize pool can grow and shink according to demand, as old
         # connections are expired and not replaced.
-        self.clients = Queue.PriorityQueue(maxsize)
+        if lifo:
+            self.clients = _LifoClientQueue(maxsize)
+        else:
+            self.clients = Queue.PriorityQueue(maxsize)
         # If there is a maxsize, prime the queue with empty slots.
         if maxsize is not None:
             for _ in xrange(maxsize):
                 self.clients.put(EMPTY_SLOT)
+        if prewarm:
+            self.warm()
+        self._reaper_stopped = None
+        if reap_interval:
+            self._start_reaper(reap_interval)
 
     @contextlib.contextmanager
     def reserve(self):
@@ -268,12 +2060,135 @@ class MCClientPool(object):
         finally:
             self._checkin_client(ts, client)
 
+    def warm(self):
+        """Open connections to fill the pool ahead of time.
+
+        This fills all the empty slots in the pool, or opens a single
+        connection if the pool has no maxsize.
+        """
+        if self.maxsize is None:
+            slots = [EMPTY_SLOT]
+        else:
+            slots = self._take_from_queue(lambda item: item[1] is None)
+        try:
+            while slots:
+                client = self._new_client()
+                slots.pop()
+                self.clients.put((monotonic_time(), client))
+        finally:
+            if self.maxsize is not None:
+                for slot in slots:
+                    self.clients.put(slot)
+
+    def reap(self):
+        """Close any idle connections that have become stale.
+
+        Each stale connection is replaced with a fresh one, except in LIFO
+        mode where it is replaced with an empty slot so the pool can shrink.
+        This is called periodically by the reaper thread, if there is one.
+        """
+        now = monotonic_time()
+
+        def is_stale(item):
+            return item[1] is not None and item[0] + self.timeout <= now
+
+        for ts, client in self._take_from_queue(is_stale):
+            self._recycle_client(client)
+            if not self.lifo:
+                try:
+                    client = self._new_client()
+                except (EnvironmentError, RuntimeError):
+                    logger.error(traceback.format_exc())
+                else:
+                    self.clients.put((monotonic_time(), client))
+                    continue
+            if self.maxsize is not None:
+                self.clients.put(EMPTY_SLOT)
+
+    def close(self):
+        """Stop the reaper thread, and close all idle connections."""
+        if self._reaper_stopped is not None:
+            self._reaper_stopped.set()
+            self._reaper_stopped = None
+        for ts, client in self._take_from_queue(lambda i: i[1] is not None):
+            client.disconnect()
+            if self.maxsize is not None:
+                self.clients.put(EMPTY_SLOT)
+
+    def _take_from_queue(self, predicate):
+        """Remove and return all items in the queue matching a predicate."""
+        with self.clients.mutex:
+            items = self.clients.queue
+            taken = [item for item in items if predicate(item)]
+            if taken:
+                items[:] = [item for item in items if not predicate(item)]
+                if not self.lifo:
+                    heapq.heapify(items)
+        return taken
+
+    def _start_reaper(self, interval):
+        """Start a background thread to periodically reap the pool.
+
+        The thread holds only a weak reference to the pool, and will exit
+        once the pool is closed or garbage-collected.
+        """
+        stopped = self._reaper_stopped = threading.Event()
+        reaper = threading.Thread(target=_run_reaper,
+                                  args=(weakref.ref(self), interval, stopped))
+        reaper.daemon = True
+        reaper.start()
+
+    def get_stats(self):
+        """Get a dict of counters describing the pool's activity.
+
+        Wait times are in seconds.  The "in_use_high_water" counter is the
+        largest number of connections that have been in use at once.
+        """
+        with self._stats_lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_wait_time": self.checkout_wait_time,
+                "checkout_wait_max": self.checkout_wait_max,
+                "connections_created": self.connections_created,
+                "connections_recycled": self.connections_recycled,
+                "in_use": self.in_use,
+                "in_use_high_water": self.in_use_high_water,
+                "timeouts": self.timeouts,
+            }
+
     def _create_client(self):
         """Create a new Client object."""
-        client = umemcache.Client(self.server)
+        client = self.factory(self.server)
         client.connect()
         return client
 
+    def _new_client(self):
+        """Create a new Client object, recording it in the metrics."""
+        client = self._create_client()
+        with self._stats_lock:
+            self.connections_created += 1
+        annotate_request(None, "mc.pool.created", 1)
+        return client
+
+    def _recycle_client(self, client):
+        """Close a stale Client object, recording it in the metrics."""
+        client.disconnect()
+        with self._stats_lock:
+            self.connections_recycled += 1
+        annotate_request(None, "mc.pool.recycled", 1)
+
+    def _record_checkout(self, start_time):
+        """Record the successful checkout of a Client object."""
+        wait_time = monotonic_time() - start_time
+        with self._stats_lock:
+            self.checkouts += 1
+            self.checkout_wait_time += wait_time
+            self.checkout_wait_max = max(self.checkout_wait_max, wait_time)
+            self.in_use += 1
+            if self.in_use > self.in_use_high_water:
+                self.in_use_high_water = self.in_use
+        annotate_request(None, "mc.pool.wait", wait_time)
+
     def _checkout_client(self):
         """Checkout a Client ojbect from the pool.
 
@@ -281,39 +2196,105 @@ class MCClientPool(object):
         one if necessary.  It will block if a maxsize has been set and there
         are no objects left in the pool
         """
+        start_time = monotonic_time()
         # If there's no maxsize, no need to block waiting for a connection.
         blocking = (self.maxsize is not None)
+        timeout = self.checkout_timeout
         # Loop until we get a non-stale connection, or we create a new one.
         while True:
             try:
-                ts, client = self.clients.get(blocking)
+                if timeout is None:
+                    ts, client = self.clients.get(blocking)
+                else:
+                    remaining = start_time + timeout - monotonic_time()
+                    ts, client = self.clients.get(blocking, max(remaining, 0))
             except Queue.Empty:
+                if blocking:
+                    with self._stats_lock:
+                        self.timeouts += 1
+                    annotate_request(None, "mc.pool.timeouts", 1)
+                    msg = "timed out waiting for a connection from the pool"
+                    raise BackendTimeoutError(msg, server=self.server)
                 # No maxsize and no free connections, create a new one.
-                # XXX TODO: we should be using a monotonic clock here.
-                now = int(time.time())
-                return now, self._create_client()
+                now = monotonic_time()
+                client = self._new_client()
+                self._record_checkout(start_time)
+                return now, client
             else:
-                now = int(time.time())
+                now = monotonic_time()
                 # If we got an empty slot placeholder, create a new connection.
                 if client is None:
-                    return now, self._create_client()
+                    try:
+                        client = self._new_client()
+                    except Exception:
+                        self.clients.put(EMPTY_SLOT)
+                        raise
+                    self._record_checkout(start_time)
+                    return now, client
                 # If the connection is not stale, go ahead and use it.
                 if ts + self.timeout > now:
+                    self._record_checkout(start_time)
                     return ts, client
                 # Otherwise, the connection is stale.
                 # Close it, push an empty slot onto the queue, and retry.
-                client.disconnect()
+                self._recycle_client(client)
                 self.clients.put(EMPTY_SLOT)
                 continue
 
     def _checkin_client(self, ts, client):
         """Return a Client object to the pool."""
-        # If the connection is now stale, don't return it to the pool.
-        # Push an empty slot instead so that it will be refreshed when needed.
+        with self._stats_lock:
+            self.in_use -= 1
+        # If the connection is now stale or broken, don't return it to the
+        # pool.  Push an empty slot instead so that it will be refreshed when
+        # needed.
         if client.is_connected():
-            now = int(time.time())
+            now = monotonic_time()
             if ts + self.timeout > now:
                 self.clients.put((ts, client))
-            else:
-                if self.maxsize is not None:
-                    self.clients.put(EMPTY_SLOT)
+                return
+            self._recycle_client(client)
+        if self.maxsize is not None:
+            self.clients.put(EMPTY_SLOT)
+
+
+class _LifoClientQueue(Queue.LifoQueue):
+    """LifoQueue for MCClientPool, which keeps empty slots at the bottom.
+
+    This ensures that existing connections are always used in preference to
+    filling an empty slot with a new connection.
+    """
+
+    def _put(self, item):
+        if item[1] is None:
+            self.queue.insert(0, item)
+        else:
+            self.queue.append(item)
+
+
+def _run_flusher(buffer_ref, interval, wakeup):
+    """Main loop for the WriteBehindBuffer flusher thread."""
+    while True:
+        wakeup.wait(interval)
+        wakeup.clear()
+        buffer = buffer_ref()
+        if buffer is None or buffer.closed:
+            break
+        try:
+            buffer.flush()
+        except Exception:
+            logger.error(traceback.format_exc())
+        del buffer
+
+
+def _run_reaper(pool_ref, interval, stopped):
+    """Main loop for the MCClientPool reaper thread."""
+    while not stopped.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            break
+        try:
+            pool.reap()
+        except Exception:
+            logger.error(traceback.format_exc())
+        del pool
@@ -0,0 +1,322 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Low-level helpers for speaking the memcached text protocol.
+
+This module contains a small implementation of the memcached text protocol.
+It lets us do things that umemcache doesn't support, such as sending a whole
+batch of commands in a single network write and then reading back all the
+replies, and provides pure-python connection classes that can be used in
+place of umemcache.
+"""
+
+import re
+import socket
+
+
+DEFAULT_PORT = 11211
+DEFAULT_IO_TIMEOUT = 5
+
+# Keys may not contain whitespace or control characters, else they
+# could be used to inject arbitrary commands into the request stream.
+INVALID_KEY_CHARS = re.compile(r"[\x00-\x20\x7f]")
+
+
+class ProtocolError(RuntimeError):
+    """Raised when memcached sends a reply we cannot understand.
+
+    After this error is raised the state of the connection is unknown,
+    and it should be discarded.
+    """
+    pass
+
+
+def check_key(key):
+    """Check that the given key is valid for use in the text protocol."""
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    if not key or INVALID_KEY_CHARS.search(key):
+        raise ValueError("invalid memcached key: %r" % (key,))
+    return key
+
+
+def parse_server(server):
+    """Parse a "host:port" server address into a (host, port) tuple."""
+    host, _, port = server.rpartition(":")
+    if not host:
+        host, port = port, DEFAULT_PORT
+    return host, int(port)
+
+
+def format_storage_command(command, key, data, flags=0, exptime=0,
+                           casid=None, noreply=False):
+    """Format a set/add/replace/cas command for sending to memcached."""
+    key = check_key(key)
+    if casid is None:
+        line = "%s %s %d %d %d" % (command, key, flags, exptime, len(data))
+    else:
+        line = "%s %s %d %d %d %d" % (command, key, flags, exptime,
+                                      len(data), casid)
+    if noreply:
+        line += " noreply"
+    return "%s\r\n%s\r\n" % (line, data)
+
+
+def format_retrieval_command(command, keys):
+    """Format a get/gets command for sending to memcached."""
+    return "%s %s\r\n" % (command, " ".join(check_key(k) for k in keys))
+
+
+def format_arith_command(command, key, delta, noreply=False):
+    """Format an incr/decr command for sending to memcached."""
+    line = "%s %s %d" % (command, check_key(key), delta)
+    if noreply:
+        line += " noreply"
+    return line + "\r\n"
+
+
+def format_delete_command(key, noreply=False):
+    """Format a delete command for sending to memcached."""
+    line = "delete " + check_key(key)
+    if noreply:
+        line += " noreply"
+    return line + "\r\n"
+
+
+class ReplyReader(object):
+    """Buffered reader for parsing replies from a memcached socket."""
+
+    def __init__(self, sock, bufsize=64 * 1024):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buffer = ""
+
+    def _fill_buffer(self):
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise ProtocolError("connection closed by server")
+        self.buffer += data
+
+    def read_line(self):
+        """Read a single line of reply, without its trailing newline."""
+        while True:
+            idx = self.buffer.find("\r\n")
+            if idx >= 0:
+                line = self.buffer[:idx]
+                self.buffer = self.buffer[idx + 2:]
+                return line
+            self._fill_buffer()
+
+    def read_bytes(self, size):
+        """Read exactly the given number of bytes of reply."""
+        while len(self.buffer) < size:
+            self._fill_buffer()
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def read_values(self):
+        """Read the list of values returned by a get/gets command.
+
+        This method returns a list of (key, data, flags, casid) tuples, one
+        for each value found by the server.  The casid will be None unless
+        the values were fetched with "gets".
+        """
+        values = []
+        while True:
+            line = self.read_line()
+            if line == "END":
+                return values
+            parts = line.split()
+            if len(parts) not in (4, 5) or parts[0] != "VALUE":
+                raise ProtocolError(line)
+            try:
+                flags = int(parts[2])
+                size = int(parts[3])
+                casid = int(parts[4]) if len(parts) == 5 else None
+            except ValueError:
+                raise ProtocolError(line)
+            data = self.read_bytes(size + 2)
+            if data[-2:] != "\r\n":
+                raise ProtocolError("value not terminated correctly")
+            values.append((parts[1], data[:-2], flags, casid))
+
+    def read_status(self):
+        """Read a single-line status reply such as "STORED" or "DELETED".
+
+        Server-side failures such as "SERVER_ERROR out of memory" leave the
+        connection in a consistent state, so they are returned to the caller
+        like any other status.  Generic errors indicate that we may have
+        lost track of the request stream, and so raise ProtocolError.
+        """
+        line = self.read_line()
+        if line == "ERROR" or line.startswith("CLIENT_ERROR"):
+            raise ProtocolError(line)
+        return line
+
+    def read_arith_status(self):
+        """Read the reply to an incr or decr command.
+
+        This is like read_status(), except that "CLIENT_ERROR" is returned
+        to the caller.  Memcached sends it when the stored value is not a
+        number, after having consumed the whole command, so the connection
+        is still in a consistent state.
+        """
+        line = self.read_line()
+        if line == "ERROR":
+            raise ProtocolError(line)
+        return line
+
+
+def pipeline(sock, commands):
+    """Send a batch of commands in one write and read back their replies.
+
+    The commands must be pre-formatted strings, each of which produces
+    a single-line status reply.  The list of status replies is returned
+    in the same order as the commands.
+    """
+    if not commands:
+        return []
+    sock.sendall("".join(commands))
+    reader = ReplyReader(sock)
+    return [reader.read_status() for _ in commands]
+
+
+class BaseConnection(object):
+    """Base class for pure-python connections to a memcached server.
+
+    This class implements the command methods of umemcache.Client in terms
+    of a single abstract method, _execute(), which must send a list of
+    formatted commands to the server and return their parsed replies.
+    Subclasses implement _execute() with different I/O strategies.
+
+    Replies are returned in the same format as umemcache: tuples of (data,
+    flags) or (data, flags, casid) for retrievals, and the raw status line
+    for everything else.
+    """
+
+    def _execute(self, requests):
+        """Execute a list of commands, returning the parsed replies.
+
+        The requests must be given as a list of (command, parser) pairs,
+        where each parser is a function taking a ReplyReader and returning
+        the parsed reply.  A parser of None indicates that the command was
+        sent with "noreply" and so produces no reply.
+        """
+        raise NotImplementedError  # pragma: nocover
+
+    def _execute_one(self, command, parser):
+        return self._execute([(command, parser)])[0]
+
+    def get(self, key):
+        values = self.get_multi([key])
+        return values.get(key)
+
+    def gets(self, key):
+        command = format_retrieval_command("gets", [key])
+        values = self._execute_one(command, ReplyReader.read_values)
+        for (_, data, flags, casid) in values:
+            return data, flags, casid
+        return None
+
+    def get_multi(self, keys):
+        if not keys:
+            return {}
+        command = format_retrieval_command("get", keys)
+        values = self._execute_one(command, ReplyReader.read_values)
+        return dict((key, (data, flags)) for (key, data, flags, _) in values)
+
+    def _store(self, command, key, data, exptime, flags, casid=None,
+               noreply=False):
+        command = format_storage_command(command, key, data, flags, exptime,
+                                         casid, noreply)
+        return self._execute_one(command, _status_parser(noreply))
+
+    def set(self, key, data, exptime=0, flags=0, noreply=False):
+        return self._store("set", key, data, exptime, flags, None, noreply)
+
+    def add(self, key, data, exptime=0, flags=0, noreply=False):
+        return self._store("add", key, data, exptime, flags, None, noreply)
+
+    def replace(self, key, data, exptime=0, flags=0, noreply=False):
+        return self._store("replace", key, data, exptime, flags, None,
+                           noreply)
+
+    def cas(self, key, data, casid, exptime=0, flags=0, noreply=False):
+        return self._store("cas", key, data, exptime, flags, casid, noreply)
+
+    def delete(self, key, noreply=False):
+        command = format_delete_command(key, noreply)
+        return self._execute_one(command, _status_parser(noreply))
+
+    def incr(self, key, delta, noreply=False):
+        command = format_arith_command("incr", key, delta, noreply)
+        return self._execute_one(command, _arith_parser(noreply))
+
+    def decr(self, key, delta, noreply=False):
+        command = format_arith_command("decr", key, delta, noreply)
+        return self._execute_one(command, _arith_parser(noreply))
+
+    def pipeline(self, commands):
+        """Send a batch of commands, returning their status replies."""
+        return self._execute([(c, ReplyReader.read_status) for c in commands])
+
+
+class Connection(BaseConnection):
+    """Blocking pure-python connection to a memcached server.
+
+    This class is a drop-in replacement for umemcache.Client.  Like that
+    class it must only be used by one thread at a time, but all the commands
+    passed to each call of _execute() are sent in a single network write,
+    so batches of commands are pipelined.  It uses the standard socket
+    module and so cooperates with gevent if that module is monkey-patched.
+    """
+
+    def __init__(self, server, timeout=DEFAULT_IO_TIMEOUT):
+        self.server = server
+        self.timeout = timeout
+        self._address = parse_server(server)
+        self._sock = None
+        self._reader = None
+
+    def connect(self):
+        """Connect the socket, if not already connected."""
+        if self._sock is None:
+            sock = socket.create_connection(self._address, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            self._reader = ReplyReader(sock)
+
+    def is_connected(self):
+        return self._sock is not None
+
+    def disconnect(self):
+        """Close the connection, if it is open."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._reader = None
+
+    def _execute(self, requests):
+        self.connect()
+        try:
+            self._sock.sendall("".join(cmd for (cmd, _) in requests))
+            return [parser(self._reader) if parser is not None else None
+                    for (_, parser) in requests]
+        except (EnvironmentError, RuntimeError):
+            # We may have lost our place in the reply stream.
+            self.disconnect()
+            raise
+
+
+def _status_parser(noreply):
+    if noreply:
+        return None
+    return ReplyReader.read_status
+
+
+def _arith_parser(noreply):
+    if noreply:
+        return None
+    return ReplyReader.read_arith_status
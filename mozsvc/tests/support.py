@@ -4,8 +4,13 @@
 
 import os
 import sys
+import time
+import random
+import socket
+import threading
 import unittest2
 import urlparse
+import SocketServer
 
 from pyramid.request import Request
 from pyramid.interfaces import IRequestFactory
@@ -128,3 +133,235 @@ class FunctionalTestCase(TestCase):
             "REMOTE_ADDR": "127.0.0.1",
             "SCRIPT_NAME": host_url.path,
         })
+
+
+class StandInMemcachedServer(SocketServer.ThreadingTCPServer):
+    """Minimal in-process memcached server, for use in tests and benchmarks.
+
+    This class implements enough of the memcached text protocol to exercise
+    our client code without needing a real memcached install: the get, gets,
+    set, add, replace, cas, delete, incr, decr and flush_all commands, along
+    with expiry times.  Items are never evicted.
+
+    To help simulate misbehaving servers, each command can be delayed by
+    "latency" seconds, and a random "failure_rate" fraction of commands will
+    cause the connection to be dropped without reply.  Both can be changed
+    while the server is running.  Expiry times are checked against the
+    "get_time" function, so tests can control the passing of time.
+
+    Call start() to begin serving in a background thread on the given port,
+    or on a random free port by default, and stop() to shut it down again.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, failure_rate=0,
+                 get_time=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port),
+                                                 _StandInMemcachedHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.get_time = get_time or time.time
+        self.items = {}
+        self.lock = threading.Lock()
+        self.next_casid = 1
+        self.connections = set()
+        self.total_connections = 0
+        self.total_commands = 0
+        self._thread = None
+
+    @property
+    def address(self):
+        """The "host:port" address of the server, for use by clients."""
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        """Start serving requests in a background thread."""
+        # Poll frequently for shutdown, so that stop() returns promptly.
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(0.01,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests, and drop any open connections."""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _StandInMemcachedHandler(SocketServer.StreamRequestHandler):
+    """Request handler for a single StandInMemcachedServer connection."""
+
+    STORAGE_COMMANDS = ("set", "add", "replace", "cas")
+
+    def setup(self):
+        # Like the real memcached, don't delay small writes.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.StreamRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+            self.server.total_connections += 1
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                return
+            if not line.endswith("\r\n"):
+                return
+            args = line.split()
+            if not args:
+                self._write("ERROR\r\n")
+                continue
+            command = args.pop(0)
+            data = None
+            if command in self.STORAGE_COMMANDS:
+                try:
+                    size = int(args[3])
+                except (IndexError, ValueError):
+                    self._write("CLIENT_ERROR bad command line format\r\n")
+                    continue
+                data = self.rfile.read(size + 2)
+                if len(data) != size + 2:
+                    return
+                data = data[:-2]
+            if server.latency:
+                time.sleep(server.latency)
+            if server.failure_rate and random.random() < server.failure_rate:
+                return
+            noreply = (args and args[-1] == "noreply")
+            if noreply:
+                args.pop()
+            handler = getattr(self, "do_" + command, None)
+            if handler is None:
+                reply = "ERROR\r\n"
+            else:
+                with server.lock:
+                    server.total_commands += 1
+                    try:
+                        reply = handler(args, data)
+                    except (IndexError, ValueError):
+                        reply = "CLIENT_ERROR bad command line format\r\n"
+            if not noreply:
+                try:
+                    self._write(reply)
+                except socket.error:
+                    return
+
+    def _write(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def _get_item(self, key):
+        item = self.server.items.get(key)
+        if item is not None:
+            exptime = item[2]
+            if exptime and exptime <= self.server.get_time():
+                del self.server.items[key]
+                item = None
+        return item
+
+    def _store_item(self, key, data, flags, exptime):
+        exptime = int(exptime)
+        if exptime < 0:
+            self.server.items.pop(key, None)
+            return
+        # Small values are relative times, large ones are absolute.
+        if 0 < exptime <= 60 * 60 * 24 * 30:
+            exptime += self.server.get_time()
+        casid = self.server.next_casid
+        self.server.next_casid += 1
+        self.server.items[key] = (data, int(flags), exptime, casid)
+
+    def do_get(self, keys, data, with_casid=False):
+        lines = []
+        for key in keys:
+            item = self._get_item(key)
+            if item is not None:
+                value, flags, _, casid = item
+                if with_casid:
+                    lines.append("VALUE %s %d %d %d\r\n"
+                                 % (key, flags, len(value), casid))
+                else:
+                    lines.append("VALUE %s %d %d\r\n"
+                                 % (key, flags, len(value)))
+                lines.append(value + "\r\n")
+        lines.append("END\r\n")
+        return "".join(lines)
+
+    def do_gets(self, keys, data):
+        return self.do_get(keys, data, with_casid=True)
+
+    def do_set(self, args, data):
+        self._store_item(args[0], data, args[1], args[2])
+        return "STORED\r\n"
+
+    def do_add(self, args, data):
+        if self._get_item(args[0]) is not None:
+            return "NOT_STORED\r\n"
+        return self.do_set(args, data)
+
+    def do_replace(self, args, data):
+        if self._get_item(args[0]) is None:
+            return "NOT_STORED\r\n"
+        return self.do_set(args, data)
+
+    def do_cas(self, args, data):
+        item = self._get_item(args[0])
+        if item is None:
+            return "NOT_FOUND\r\n"
+        if item[3] != int(args[4]):
+            return "EXISTS\r\n"
+        return self.do_set(args, data)
+
+    def do_delete(self, args, data):
+        if self._get_item(args[0]) is None:
+            return "NOT_FOUND\r\n"
+        del self.server.items[args[0]]
+        return "DELETED\r\n"
+
+    def do_incr(self, args, data, sign=1):
+        item = self._get_item(args[0])
+        if item is None:
+            return "NOT_FOUND\r\n"
+        try:
+            value = int(item[0])
+        except ValueError:
+            return ("CLIENT_ERROR cannot increment or decrement "
+                    "non-numeric value\r\n")
+        # Increments wrap around at 64 bits, decrements stop at zero.
+        value = max(value + sign * int(args[1]), 0) % 2 ** 64
+        self.server.items[args[0]] = (str(value),) + item[1:]
+        return "%d\r\n" % (value,)
+
+    def do_decr(self, args, data):
+        return self.do_incr(args, data, sign=-1)
+
+    def do_flush_all(self, args, data):
+        self.server.items.clear()
+        return "OK\r\n"
+
+    def do_version(self, args, data):
+        return "VERSION 1.4.0-mozsvc-standin\r\n"
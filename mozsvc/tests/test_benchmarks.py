@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest2
+
+from mozsvc.tests.support import StandInMemcachedServer
+
+try:
+    from mozsvc.benchmarks import mcclient as mcbench
+except ImportError:
+    mcbench = None
+
+
+class TestMemcachedClientBenchmark(unittest2.TestCase):
+
+    def setUp(self):
+        if mcbench is None:
+            raise unittest2.SkipTest("Unable to import required modules.")
+        self.memcached = StandInMemcachedServer().start()
+
+    def tearDown(self):
+        self.memcached.stop()
+
+    def test_run_benchmark(self):
+        result = mcbench.run_benchmark(self.memcached.address, pool_size=2,
+                                       value_size=100, concurrency=4,
+                                       duration=0.1, num_keys=20)
+        # The results must be serializable for comparison between runs.
+        result = json.loads(json.dumps(result))
+        self.assertTrue(result["operations"] > 0)
+        self.assertEquals(result["errors"], 0)
+        self.assertEquals(sorted(result["latency"].keys()),
+                          ["cas", "get", "get_multi", "set"])
+        self.assertEquals(result["latency_all"]["count"],
+                          result["operations"])
+        for key in ("count", "mean", "max", "p50", "p99"):
+            self.assertTrue(key in result["pool_wait"])
+        self.assertTrue(1 <= result["connections"] <= 2)
+        self.assertEquals(len(self.memcached.items), 20)
+
+    def test_run_benchmark_with_each_backend(self):
+        for backend in ("python", "pipelined"):
+            result = mcbench.run_benchmark(self.memcached.address,
+                                           pool_size=2, value_size=100,
+                                           concurrency=4, duration=0.1,
+                                           num_keys=20, backend=backend)
+            self.assertEquals(result["backend"], backend)
+            self.assertTrue(result["operations"] > 0)
+            self.assertEquals(result["errors"], 0)
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import socket
+import unittest2
+
+from mozsvc.exceptions import BackendError
+
+import mozsvc.tests.test_mcclient as mctests
+
+try:
+    import gevent
+    from mozsvc.storage.mcasync import AsyncMemcachedClient
+except ImportError:
+    gevent = None
+
+
+class TestAsyncMemcachedClient(mctests.TestMemcachedClient):
+    """Run the standard MemcachedClient tests against AsyncMemcachedClient.
+
+    This also adds some tests specific to the pipelined connections.
+    """
+
+    def setUp(self):
+        if gevent is None:
+            raise unittest2.SkipTest("Unable to import required modules.")
+        super(TestAsyncMemcachedClient, self).setUp()
+        self.client_class = AsyncMemcachedClient
+
+    def spawn(self, func, *args):
+        return gevent.spawn(func, *args)
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def test_concurrent_requests_share_a_single_connection(self):
+        mc = self.make_client(pool_size=1)
+        keys = ["test%d" % (i,) for i in xrange(50)]
+
+        def setget(i):
+            key = keys[i]
+            assert mc.set(key, i)
+            value, casid = mc.gets(key)
+            assert mc.cas(key, value * 2, casid)
+            return mc.get(key)
+
+        greenlets = [gevent.spawn(setget, i) for i in xrange(len(keys))]
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEquals([g.value for g in greenlets],
+                          [i * 2 for i in xrange(len(keys))])
+        self.assertEquals(len(mc.pool._connections), 1)
+        self.assertEquals(mc.get_multi(keys[:3]),
+                          {"test0": 0, "test1": 2, "test2": 4})
+
+    def test_connection_errors_are_reported_and_recovered(self):
+        mc = self.make_client()
+        mc.set("test1", 1)
+        conn = mc.pool._get_connection()
+        # Break the connection underneath the client.
+        conn._sock.shutdown(socket.SHUT_RDWR)
+        self.assertRaises(BackendError, mc.get, "test1")
+        self.assertFalse(conn.is_connected())
+        # The next request gets a fresh connection.
+        self.assertEquals(mc.get("test1"), 1)
+
+    def test_connecting_to_a_missing_server(self):
+        mc = AsyncMemcachedClient("127.0.0.1:1")
+        self.assertRaises(BackendError, mc.get, "test1")
@@ -0,0 +1,1076 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import socket
+import unittest2
+import threading
+
+import pyramid.threadlocal
+from testfixtures import LogCapture
+
+from mozsvc.exceptions import BackendError, BackendTimeoutError
+from mozsvc.tests.support import StandInMemcachedServer
+
+try:
+    from mozsvc.storage.mcclient import (MemcachedClient, ConsistentHashRing,
+                                         CircuitBreaker, MCClientPool,
+                                         HotKeySampler,
+                                         FLAG_COMPRESSED, FLAG_MARSHAL,
+                                         FLAG_RAW, register_codec)
+    from mozsvc.storage import mcclient, mcprotocol
+    MEMCACHED = True
+except ImportError:
+    MEMCACHED = False
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+
+class TestConsistentHashRing(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("Unable to import required modules.")
+        self.keys = ["key%d" % (i,) for i in xrange(10000)]
+
+    def _assign(self, ring):
+        return dict((key, ring.get_server(key)) for key in self.keys)
+
+    def test_keys_are_spread_over_all_servers(self):
+        servers = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        assignments = self._assign(ConsistentHashRing(servers))
+        counts = dict((server, 0) for server in servers)
+        for server in assignments.itervalues():
+            counts[server] += 1
+        for count in counts.itervalues():
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def test_assignment_is_stable(self):
+        servers = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        assignments1 = self._assign(ConsistentHashRing(servers))
+        assignments2 = self._assign(ConsistentHashRing(reversed(servers)))
+        self.assertEquals(assignments1, assignments2)
+
+    def test_adding_a_server_remaps_few_keys(self):
+        servers = ["10.0.0.%d:11211" % (i,) for i in xrange(5)]
+        before = self._assign(ConsistentHashRing(servers[:4]))
+        after = self._assign(ConsistentHashRing(servers))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # Around 1/5 of keys should move, and only onto the new server.
+        self.assertTrue(0.1 < len(moved) / float(len(self.keys)) < 0.3)
+        for key in moved:
+            self.assertEquals(after[key], servers[4])
+
+    def test_removing_a_server_remaps_only_its_keys(self):
+        servers = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        before = self._assign(ConsistentHashRing(servers))
+        after = self._assign(ConsistentHashRing(servers[1:]))
+        for key in self.keys:
+            if before[key] != servers[0]:
+                self.assertEquals(before[key], after[key])
+
+    def test_replicas_are_distinct_servers_following_the_primary(self):
+        servers = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        ring = ConsistentHashRing(servers)
+        for key in self.keys[:1000]:
+            replicas = ring.get_servers(key, 2)
+            self.assertEquals(len(set(replicas)), 2)
+            self.assertEquals(replicas[0], ring.get_server(key))
+        self.assertEquals(len(ring.get_servers("key", 10)), 4)
+        # If the primary is removed, its first replica takes over.
+        smaller_ring = ConsistentHashRing(servers[1:])
+        for key in self.keys[:1000]:
+            replicas = ring.get_servers(key, 2)
+            if replicas[0] == servers[0]:
+                self.assertEquals(smaller_ring.get_server(key), replicas[1])
+
+
+class TestValueEncoding(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("Unable to import required modules.")
+
+    def test_values_are_decoded_according_to_their_flags(self):
+        json_mc = MemcachedClient()
+        marshal_mc = MemcachedClient(codec="marshal")
+        raw_mc = MemcachedClient(codec="raw")
+        value = {"hello": ["world", 42]}
+        data, flags = json_mc._encode_value(value)
+        self.assertEquals(flags, 0)
+        self.assertEquals(data, '{"hello": ["world", 42]}')
+        self.assertEquals(marshal_mc._decode_value(data, flags), value)
+        data, flags = marshal_mc._encode_value(value)
+        self.assertEquals(flags, FLAG_MARSHAL)
+        self.assertEquals(json_mc._decode_value(data, flags), value)
+        data, flags = raw_mc._encode_value("\x00\xff")
+        self.assertEquals((data, flags), ("\x00\xff", FLAG_RAW))
+        self.assertEquals(json_mc._decode_value(data, flags), "\x00\xff")
+        self.assertRaises(ValueError, raw_mc._encode_value, value)
+        self.assertRaises(ValueError, json_mc._decode_value, data, 99)
+        self.assertRaises(ValueError, MemcachedClient, codec="pickle")
+
+    def test_large_values_are_compressed(self):
+        mc = MemcachedClient(compress_threshold=100)
+        # Small values are not compressed.
+        data, flags = mc._encode_value("x" * 10)
+        self.assertEquals(flags, 0)
+        # Large values are.
+        data, flags = mc._encode_value("x" * 1000)
+        self.assertEquals(flags, FLAG_COMPRESSED)
+        self.assertTrue(len(data) < 100)
+        self.assertEquals(mc._decode_value(data, flags), "x" * 1000)
+        # Unless compression doesn't make them any smaller.
+        value = os.urandom(1000)
+        data, flags = MemcachedClient(compress_threshold=100,
+                                      codec="raw")._encode_value(value)
+        self.assertEquals(flags, FLAG_RAW)
+
+    def test_custom_codecs(self):
+        register_codec("reversed", 200, lambda v: v[::-1], lambda v: v[::-1])
+        mc = MemcachedClient(codec="reversed")
+        self.assertEquals(mc._encode_value("hello"), ("olleh", 200))
+        self.assertEquals(mc._decode_value("olleh", 200), "hello")
+        # Flags can't be re-used, or be out of range.
+        self.assertRaises(ValueError, register_codec, "other", 200, str, str)
+        self.assertRaises(ValueError, register_codec, "other", 256, str, str)
+
+
+class TestCircuitBreaker(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("Unable to import required modules.")
+
+    def test_state_transitions(self):
+        now = [1000]
+        breaker = CircuitBreaker(3, 10, get_time=lambda: now[0])
+        # It stays closed until we get enough consecutive failures.
+        self.assertEquals(breaker.check(), None)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEquals(breaker.state, "closed")
+        self.assertEquals(breaker.check(), None)
+        breaker.record_failure()
+        self.assertEquals(breaker.state, "open")
+        # While open, requests are rejected with a retry-after time.
+        self.assertEquals(breaker.check(), 10)
+        now[0] += 7.5
+        self.assertEquals(breaker.check(), 3)
+        # After the timeout, a single trial request is let through.
+        now[0] += 2.5
+        self.assertEquals(breaker.check(), None)
+        self.assertEquals(breaker.state, "half-open")
+        self.assertEquals(breaker.check(), 10)
+        # If it fails, the breaker re-opens.
+        breaker.record_failure()
+        self.assertEquals(breaker.state, "open")
+        self.assertEquals(breaker.check(), 10)
+        # If the trial never reports back, another is eventually allowed.
+        now[0] += 10
+        self.assertEquals(breaker.check(), None)
+        self.assertEquals(breaker.check(), 10)
+        now[0] += 10
+        self.assertEquals(breaker.check(), None)
+        # If the trial is released without a result, another is allowed.
+        breaker.release()
+        self.assertEquals(breaker.state, "half-open")
+        self.assertEquals(breaker.check(), None)
+        # If the trial succeeds, the breaker closes.
+        breaker.record_success()
+        self.assertEquals(breaker.state, "closed")
+        self.assertEquals(breaker.check(), None)
+        self.assertEquals(breaker.get_stats(), {
+            "state": "closed",
+            "failures": 0,
+            "trips": 2,
+            "rejected": 5,
+        })
+
+    def test_client_fails_fast_when_breaker_is_open(self):
+        mc = MemcachedClient("127.0.0.1:1", breaker_threshold=2)
+        connect_attempts = []
+        orig_create_client = mc.pool._create_client
+
+        def create_client():
+            connect_attempts.append(True)
+            return orig_create_client()
+
+        mc.pool._create_client = create_client
+        self.assertRaises(BackendError, mc.get, "test1")
+        self.assertRaises(BackendError, mc.get, "test1")
+        self.assertEquals(len(connect_attempts), 2)
+        with self.assertRaises(BackendError) as cm:
+            mc.get("test1")
+        self.assertTrue(0 < cm.exception.retry_after <= 10)
+        self.assertEquals(len(connect_attempts), 2)
+        stats = mc.get_breaker_stats()["127.0.0.1:1"]
+        self.assertEquals(stats["state"], "open")
+        self.assertEquals(stats["rejected"], 1)
+
+
+class MemcachedTestCase(unittest2.TestCase):
+    """TestCase that runs a pair of stand-in memcached servers for each test.
+
+    The servers' addresses are available as self.servers, and make_client()
+    creates a client connected to the first of them by default.
+    """
+
+    # Subclasses can override this to test other client implementations.
+    client_class = None
+
+    def setUp(self):
+        if not MEMCACHED:
+            raise unittest2.SkipTest("Unable to import required modules.")
+        self.memcached = [StandInMemcachedServer().start() for _ in xrange(2)]
+        self.servers = [server.address for server in self.memcached]
+
+    def tearDown(self):
+        for server in self.memcached:
+            server.stop()
+
+    def make_client(self, *args, **kwds):
+        if not args and "server" not in kwds and "servers" not in kwds:
+            kwds["server"] = self.servers[0]
+        client_class = self.client_class or MemcachedClient
+        return client_class(*args, **kwds)
+
+    # Subclasses can override these to run concurrent code in greenlets.
+
+    def spawn(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.start()
+        return thread
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class TestStandInMemcachedServer(MemcachedTestCase):
+
+    def test_items_expire_after_their_ttl(self):
+        now = [1000000]
+        self.memcached[0].get_time = lambda: now[0]
+        mc = self.make_client()
+        mc.set("test1", 1, time=10)
+        mc.set("test2", 2)
+        now[0] += 9
+        self.assertEquals(mc.get_multi(["test1", "test2"]),
+                          {"test1": 1, "test2": 2})
+        now[0] += 1
+        self.assertEquals(mc.get_multi(["test1", "test2"]), {"test2": 2})
+        self.assertTrue(mc.add("test1", 3))
+
+    def test_injected_failures_and_latency(self):
+        server = self.memcached[0]
+        mc = self.make_client(breaker_threshold=0)
+        mc.set("test1", 1)
+        server.failure_rate = 1
+        self.assertRaises(BackendError, mc.get, "test1")
+        server.failure_rate = 0
+        self.assertEquals(mc.get("test1"), 1)
+        server.latency = 0.1
+        start = time.time()
+        self.assertEquals(mc.get("test1"), 1)
+        self.assertTrue(time.time() - start >= 0.1)
+
+
+class TestMCClientPool(MemcachedTestCase):
+
+    def _get_idle_clients(self, pool):
+        return [client for (_, client) in pool.clients.queue if client]
+
+    def test_prewarm_fills_the_pool(self):
+        pool = MCClientPool(self.servers[0], 3, prewarm=True)
+        self.assertEquals(len(self._get_idle_clients(pool)), 3)
+        with pool.reserve() as mc:
+            self.assertTrue(mc.is_connected())
+        pool.close()
+        self.assertEquals(len(self._get_idle_clients(pool)), 0)
+        self.assertEquals(pool.clients.qsize(), 3)
+        # Clients can pre-warm all of their pools at once.
+        mc = self.make_client(servers=self.servers, pool_size=2,
+                              pool_prewarm=True)
+        for pool in mc.pools.itervalues():
+            self.assertEquals(pool.clients.qsize(), 2)
+            self.assertEquals(len(self._get_idle_clients(pool)), 2)
+
+    def test_fifo_and_lifo_modes(self):
+        for lifo in (False, True):
+            pool = MCClientPool(self.servers[0], 3, lifo=lifo)
+            ts1, client1 = pool._checkout_client()
+            ts2, client2 = pool._checkout_client()
+            pool._checkin_client(ts1, client1)
+            pool._checkin_client(ts2, client2)
+            # Existing connections are preferred to opening new ones.
+            ts, client = pool._checkout_client()
+            if lifo:
+                self.assertTrue(client is client2)
+            else:
+                self.assertTrue(client is client1)
+            pool._checkin_client(ts, client)
+            self.assertEquals(len(self._get_idle_clients(pool)), 2)
+
+    def test_reaping_stale_connections(self):
+        for lifo in (False, True):
+            pool = MCClientPool(self.servers[0], 2, timeout=60, lifo=lifo,
+                                prewarm=True)
+            old_clients = self._get_idle_clients(pool)
+            pool.reap()
+            self.assertEquals(self._get_idle_clients(pool), old_clients)
+            pool.timeout = 0
+            pool.reap()
+            for client in old_clients:
+                self.assertFalse(client.is_connected())
+            new_clients = self._get_idle_clients(pool)
+            if lifo:
+                self.assertEquals(new_clients, [])
+            else:
+                self.assertEquals(len(new_clients), 2)
+            self.assertEquals(pool.clients.qsize(), 2)
+
+    def test_background_reaper(self):
+        pool = MCClientPool(self.servers[0], 2, timeout=0.05,
+                            prewarm=True, reap_interval=0.01)
+        old_clients = self._get_idle_clients(pool)
+        time.sleep(0.2)
+        new_clients = self._get_idle_clients(pool)
+        self.assertEquals(len(new_clients), 2)
+        for client in old_clients:
+            self.assertFalse(client in new_clients)
+        pool.close()
+
+    def test_checkout_timeout(self):
+        mc = self.make_client(pool_size=1, pool_checkout_timeout=0.05)
+        mc.set("test1", 1)
+        with mc.pool.reserve():
+            start = time.time()
+            self.assertRaises(BackendTimeoutError, mc.get, "test1")
+            self.assertTrue(time.time() - start >= 0.05)
+        self.assertEquals(mc.get("test1"), 1)
+        self.assertEquals(mc.get_pool_stats()[self.servers[0]]["timeouts"], 1)
+        # Exhaustion of the pool doesn't count against the server.
+        breaker_stats = mc.get_breaker_stats()[self.servers[0]]
+        self.assertEquals(breaker_stats["failures"], 0)
+
+    def test_pool_metrics(self):
+        request = type("FakeRequest", (object,), {"metrics": {}})()
+        pyramid.threadlocal.manager.push({"request": request})
+        try:
+            pool = MCClientPool(self.servers[0], 2, timeout=60)
+            with pool.reserve():
+                with pool.reserve():
+                    pass
+            with pool.reserve() as mc:
+                pool.timeout = 0
+            pool.timeout = 60
+            # This re-uses the remaining connection rather than making one.
+            with pool.reserve():
+                pass
+        finally:
+            pyramid.threadlocal.manager.pop()
+        stats = pool.get_stats()
+        self.assertEquals(stats["checkouts"], 4)
+        self.assertEquals(stats["connections_created"], 2)
+        self.assertEquals(stats["connections_recycled"], 1)
+        self.assertEquals(stats["in_use"], 0)
+        self.assertEquals(stats["in_use_high_water"], 2)
+        self.assertEquals(stats["timeouts"], 0)
+        self.assertTrue(stats["checkout_wait_time"] >= 0)
+        self.assertTrue(stats["checkout_wait_max"] >= 0)
+        self.assertFalse(mc.is_connected())
+        self.assertEquals(request.metrics["mc.pool.created"], 2)
+        self.assertEquals(request.metrics["mc.pool.recycled"], 1)
+        self.assertTrue(request.metrics["mc.pool.wait"] >= 0)
+
+    def test_failed_connections_do_not_leak_slots(self):
+        pool = MCClientPool(self.servers[0], 1)
+        with pool.reserve() as mc:
+            mc.disconnect()
+        self.assertEquals(pool.clients.qsize(), 1)
+        self.memcached[0].stop()
+        for _ in xrange(3):
+            with self.assertRaises(EnvironmentError):
+                with pool.reserve():
+                    pass
+        self.assertEquals(pool.clients.qsize(), 1)
+
+
+class TestWriteBehindBuffer(MemcachedTestCase):
+
+    def test_writes_are_coalesced_and_flushed_in_batches(self):
+        mc = self.make_client(write_behind_size=10, write_behind_interval=60)
+        mc.set("test3", 100)
+        self.assertTrue(mc.set_later("test1", 1))
+        self.assertTrue(mc.set_later("test1", 2))
+        self.assertTrue(mc.incr_later("test2"))
+        self.assertTrue(mc.incr_later("test2", 4))
+        self.assertTrue(mc.incr_later("test3", 5))
+        mc.set_later("test4", "value", time=60)
+        mc.set_later("test4", "newvalue", time=60)
+        mc.incr_later("test4", 0)
+        # A set followed by increments sets the value, then increments it.
+        mc.set_later("test5", 10)
+        mc.incr_later("test5", 2)
+        mc.incr_later("test5", -5)
+        self.assertEquals(mc.get("test1"), None)
+        commands = self.memcached[0].total_commands
+        mc.write_buffer.flush()
+        self.assertEquals(mc.get_multi(["test%d" % i for i in xrange(1, 6)]),
+                          {"test1": 2, "test2": 5, "test3": 105,
+                           "test4": "newvalue", "test5": 7})
+        # Three sets, three increments, an add to initialize the missing
+        # counter, and then our get_multi.
+        self.assertEquals(self.memcached[0].total_commands - commands,
+                          3 + 3 + 1 + 1)
+        self.assertEquals(mc.write_buffer.get_stats(), {
+            "pending": 0, "writes": 11, "coalesced": 6, "dropped": 0,
+            "flushed": 6, "failed": 0,
+        })
+
+    def test_writes_are_dropped_when_the_buffer_is_full(self):
+        mc = self.make_client(write_behind_size=2, write_behind_interval=60)
+        self.assertTrue(mc.set_later("test1", 1))
+        self.assertTrue(mc.incr_later("test2"))
+        self.assertFalse(mc.set_later("test3", 3))
+        # Writes to keys that are already buffered are still accepted.
+        self.assertTrue(mc.set_later("test1", 4))
+        mc.write_buffer.flush()
+        self.assertEquals(mc.get_multi(["test1", "test2", "test3"]),
+                          {"test1": 4, "test2": 1})
+        stats = mc.write_buffer.get_stats()
+        self.assertEquals(stats["dropped"], 1)
+        self.assertEquals(stats["flushed"], 2)
+
+    def test_failed_writes_are_counted(self):
+        mc = self.make_client(write_behind_size=10, write_behind_interval=60,
+                              breaker_threshold=0)
+        mc.set_later("test1", 1)
+        mc.incr_later("test2")
+        self.memcached[0].failure_rate = 1
+        mc.write_buffer.flush()
+        self.assertEquals(mc.write_buffer.get_stats()["failed"], 2)
+        self.memcached[0].failure_rate = 0
+        self.assertEquals(mc.get("test1"), None)
+
+    def test_non_numeric_increments_are_counted_as_failed(self):
+        mc = self.make_client(write_behind_size=10, write_behind_interval=60)
+        mc.set("test1", "abc")
+        mc.incr_later("test1")
+        mc.incr_later("test2")
+        mc.write_buffer.flush()
+        stats = mc.write_buffer.get_stats()
+        self.assertEquals(stats["failed"], 1)
+        self.assertEquals(stats["flushed"], 1)
+        self.assertEquals(mc.get_multi(["test1", "test2"]),
+                          {"test1": "abc", "test2": 1})
+
+    def test_writes_are_flushed_in_the_background(self):
+        mc = self.make_client(write_behind_size=10,
+                              write_behind_interval=0.01)
+        mc.set_later("test1", 1)
+        time.sleep(0.2)
+        self.assertEquals(mc.get("test1"), 1)
+        # Closing the client flushes any remaining writes.
+        mc.write_buffer.interval = 60
+        mc.set_later("test2", 2)
+        mc.close()
+        self.assertEquals(mc.get("test2"), 2)
+
+    def test_writes_are_synchronous_if_not_enabled(self):
+        mc = self.make_client()
+        self.assertTrue(mc.set_later("test1", 1))
+        self.assertEquals(mc.incr_later("test1", 2), 3)
+        self.assertEquals(mc.get("test1"), 3)
+
+
+class TestMemcachedClient(MemcachedTestCase):
+
+    def test_basic_operations(self):
+        mc = self.make_client()
+        self.assertEquals(mc.get("test1"), None)
+        self.assertTrue(mc.set("test1", {"hello": "world"}))
+        self.assertEquals(mc.get("test1"), {"hello": "world"})
+        self.assertFalse(mc.add("test1", "other"))
+        self.assertTrue(mc.replace("test1", "other"))
+        value, casid = mc.gets("test1")
+        self.assertEquals(value, "other")
+        self.assertTrue(mc.cas("test1", "newer", casid))
+        self.assertFalse(mc.cas("test1", "newest", casid))
+        self.assertEquals(mc.get("test1"), "newer")
+        self.assertTrue(mc.delete("test1"))
+        self.assertFalse(mc.delete("test1"))
+
+    def test_get_multi_across_several_servers(self):
+        servers = self.servers
+        mc = self.make_client(servers=servers)
+        keys = ["test%d" % (i,) for i in xrange(20)]
+        # The keys should be split between the two servers.
+        used_servers = set(mc._get_server(mc._encode_key(k)) for k in keys)
+        self.assertEquals(used_servers, set(servers))
+        for i, key in enumerate(keys):
+            mc.set(key, i)
+        for server in self.memcached:
+            self.assertTrue(0 < len(server.items) < len(keys))
+        items = mc.get_multi(keys + ["missing"])
+        self.assertEquals(items, dict((k, i) for i, k in enumerate(keys)))
+
+    def test_servers_can_be_given_as_a_string(self):
+        mc = MemcachedClient(servers="127.0.0.1:11211 localhost:11211")
+        self.assertEquals(mc.servers, ["127.0.0.1:11211", "localhost:11211"])
+        self.assertRaises(AttributeError, getattr, mc, "pool")
+        mc = MemcachedClient("127.0.0.1:11211")
+        self.assertEquals(mc.servers, ["127.0.0.1:11211"])
+        self.assertTrue(mc.pool is mc.pools["127.0.0.1:11211"])
+        self.assertRaises(ValueError, MemcachedClient,
+                          server="127.0.0.1:11211", servers=["localhost"])
+
+    def test_bulk_write_operations(self):
+        mc = self.make_client(servers=self.servers)
+        items = dict(("test%d" % (i,), i) for i in xrange(20))
+        self.assertEquals(mc.set_multi(items),
+                          dict((key, True) for key in items))
+        self.assertEquals(mc.get_multi(items.keys()), items)
+        # Adding only succeeds for the keys that don't already exist.
+        res = mc.add_multi({"test0": "zero", "newkey": "new"})
+        self.assertEquals(res, {"test0": False, "newkey": True})
+        self.assertEquals(mc.get("test0"), 0)
+        self.assertEquals(mc.get("newkey"), "new")
+        # Deleting only succeeds for the keys that exist.
+        res = mc.delete_multi(["test0", "test1", "missing"])
+        self.assertEquals(res, {"test0": True, "test1": True,
+                                "missing": False})
+        self.assertEquals(mc.get_multi(["test0", "test1", "test2"]),
+                          {"test2": 2})
+        # The connection should still be usable after pipelining.
+        self.assertEquals(mc.get("test3"), 3)
+        self.assertEquals(mc.set_multi({}), {})
+
+    def test_replicated_keys_survive_a_dead_server(self):
+        self.memcached[1].stop()
+        servers = self.servers
+        mc = self.make_client(servers=servers, replicas=2)
+        keys = ["test%d" % (i,) for i in xrange(20)]
+        # Some keys should have the stopped server as their primary.
+        primaries = set(mc._get_server(mc._encode_key(k)) for k in keys)
+        self.assertEquals(primaries, set(servers))
+        for i, key in enumerate(keys):
+            self.assertTrue(mc.add(key, i))
+            self.assertFalse(mc.add(key, i))
+            self.assertEquals(mc.get(key), i)
+            value, casid = mc.gets(key)
+            self.assertTrue(mc.cas(key, value + 1, casid))
+        items = mc.get_multi(keys)
+        self.assertEquals(items, dict((k, i + 1) for i, k in enumerate(keys)))
+        res = mc.set_multi(dict((k, "new") for k in keys))
+        self.assertEquals(res, dict((k, True) for k in keys))
+        self.assertTrue(mc.delete(keys[0]))
+        self.assertEquals(len(mc.get_multi(keys)), len(keys) - 1)
+        # The values should be found on the running server by other clients.
+        mc2 = MemcachedClient(servers[0])
+        self.assertEquals(mc2.get(mc._encode_key(keys[1])), "new")
+        # Without any live replicas, operations fail as normal.
+        self.memcached[0].stop()
+        mc = MemcachedClient(servers=servers, replicas=2)
+        self.assertRaises(BackendError, mc.get, "test1")
+        self.assertRaises(BackendError, mc.set, "test1", 1)
+        self.assertRaises(BackendError, mc.get_multi, ["test1"])
+        self.assertRaises(BackendError, mc.set_multi, {"test1": 1})
+
+    def test_add_fails_if_any_replica_has_the_key(self):
+        mc = self.make_client(servers=self.servers, replicas=2)
+        # Use keys whose primary is the first server.
+        keys = [k for k in ("test%d" % (i,) for i in xrange(20))
+                if mc._get_server(mc._encode_key(k)) == self.servers[0]]
+        self.assertTrue(mc.add(keys[0], 0))
+        self.assertEquals(mc.add_multi({keys[1]: 1, keys[2]: 2}),
+                          {keys[1]: True, keys[2]: True})
+        # Simulate the primary losing its data, e.g. through a restart.
+        self.memcached[0].items.clear()
+        # A replay must still be refused, thanks to the other replica.
+        self.assertFalse(mc.add(keys[0], 0))
+        self.assertFalse(mc.cas(keys[0], 0, None))
+        self.assertEquals(mc.add_multi({keys[1]: 1, keys[2]: 2}),
+                          {keys[1]: False, keys[2]: False})
+        # Unconditional writes still succeed.
+        self.assertTrue(mc.set(keys[0], 3))
+        self.assertEquals(mc.get(keys[0]), 3)
+
+    def test_large_values_are_chunked(self):
+        mc = self.make_client(servers=self.servers, codec="raw",
+                              chunk_size=1000)
+        value = os.urandom(49500)
+        self.assertTrue(mc.set("test1", value))
+        self.assertTrue(mc.set("test2", "small"))
+        # The value is stored in fifty chunks, spread across the servers.
+        chunk_counts = []
+        for server in self.memcached:
+            chunk_keys = [k for k in server.items if k.startswith("chunk:")]
+            chunk_counts.append(len(chunk_keys))
+        self.assertEquals(sum(chunk_counts), 50)
+        self.assertTrue(0 not in chunk_counts)
+        self.assertEquals(mc.get("test1"), value)
+        self.assertEquals(mc.get_multi(["test1", "test2", "test3"]),
+                          {"test1": value, "test2": "small"})
+        # Replacing it writes a fresh set of chunks.
+        stored_value, casid = mc.gets("test1")
+        self.assertEquals(stored_value, value)
+        value = os.urandom(2500)
+        self.assertTrue(mc.cas("test1", value, casid))
+        self.assertEquals(mc.get("test1"), value)
+        self.assertTrue(mc.set_multi({"test2": value * 2}))
+        self.assertEquals(mc.get_multi(["test1", "test2"]),
+                          {"test1": value, "test2": value * 2})
+
+    def test_torn_chunked_values_are_treated_as_missing(self):
+        server = self.memcached[0]
+        mc = self.make_client(codec="raw", chunk_size=1000)
+        self.assertTrue(mc.set("test1", os.urandom(5500)))
+        self.assertTrue(mc.set("test2", os.urandom(5500)))
+        manifest = server.items["test1"][0]
+        version = manifest.split()[0]
+        # Corrupt one chunk of the first value.
+        chunk_key = "chunk:%s:3" % (version,)
+        data = server.items[chunk_key][0]
+        corrupted = data[:-1] + chr((ord(data[-1]) + 1) % 256)
+        server.items[chunk_key] = (corrupted,) + server.items[chunk_key][1:]
+        self.assertEquals(mc.get("test1"), None)
+        self.assertEquals(mc.gets("test1"), (None, None))
+        # Evict one chunk of the second value.
+        version = server.items["test2"][0].split()[0]
+        del server.items["chunk:%s:0" % (version,)]
+        self.assertEquals(mc.get("test2"), None)
+        self.assertEquals(mc.get_multi(["test1", "test2"]), {})
+        # Storing a new value makes it readable again.
+        self.assertTrue(mc.set("test1", "x" * 2000))
+        self.assertEquals(mc.get_multi(["test1", "test2"]),
+                          {"test1": "x" * 2000})
+
+    def test_bulk_operations_reject_invalid_keys(self):
+        mc = self.make_client()
+        self.assertRaises(ValueError, mc.set_multi, {"bad key": 1})
+        self.assertRaises(ValueError, mc.delete_multi, ["bad\r\nkey"])
+
+    def test_local_cache(self):
+        mc = self.make_client(local_cache_size=10)
+        other = self.make_client()
+        mc.set("test1", {"hello": "world"})
+        self.assertEquals(mc.get("test1"), {"hello": "world"})
+        self.assertEquals(mc.local_cache.misses, 1)
+        # Repeated reads are served from the local cache,
+        # even if the value is changed by another client.
+        other.set("test1", "changed")
+        self.assertEquals(mc.get("test1"), {"hello": "world"})
+        self.assertEquals(mc.get_multi(["test1"]),
+                          {"test1": {"hello": "world"}})
+        self.assertEquals(mc.local_cache.hits, 2)
+        # Local writes invalidate the cached value.
+        mc.set("test1", "mine")
+        self.assertEquals(mc.get("test1"), "mine")
+        value, casid = mc.gets("test1")
+        mc.cas("test1", "cassed", casid)
+        self.assertEquals(mc.get_multi(["test1", "test2"]),
+                          {"test1": "cassed"})
+        mc.delete("test1")
+        self.assertEquals(mc.get("test1"), None)
+        mc.set_multi({"test1": 1, "test2": 2})
+        self.assertEquals(mc.get_multi(["test1", "test2"]),
+                          {"test1": 1, "test2": 2})
+        mc.delete_multi(["test1"])
+        self.assertEquals(mc.get("test1"), None)
+
+    def test_local_cache_is_not_filled_by_gets_racing_with_writes(self):
+        mc = self.make_client(local_cache_size=10)
+        mc.set("test1", "old")
+        mc.set("test2", "old")
+        self.memcached[0].latency = 0.1
+        # Start gets which will read the old values, then overwrite them
+        # before the gets have finished.
+        readers = [self.spawn(mc.get, "test1"),
+                   self.spawn(mc.get_multi, ["test2"])]
+        self.sleep(0.05)
+        self.assertTrue(mc.set("test1", "new"))
+        self.assertEquals(mc.set_multi({"test2": "new"}), {"test2": True})
+        for reader in readers:
+            reader.join()
+        self.memcached[0].latency = 0
+        self.assertEquals(mc.get("test1"), "new")
+        self.assertEquals(mc.get_multi(["test2"]), {"test2": "new"})
+        self.assertEquals(mc._local_cache_fills, {})
+
+    def test_mixed_codecs_can_share_keys(self):
+        json_mc = self.make_client()
+        marshal_mc = self.make_client(codec="marshal",
+                                      compress_threshold=100)
+        json_mc.set("test1", ["json", 1])
+        marshal_mc.set("test2", ["marshal", 2])
+        marshal_mc.set("test3", ["marshal"] * 100)
+        expected = {
+            "test1": ["json", 1],
+            "test2": ["marshal", 2],
+            "test3": ["marshal"] * 100,
+        }
+        for mc in (json_mc, marshal_mc):
+            self.assertEquals(mc.get_multi(expected.keys()), expected)
+            for key, value in expected.iteritems():
+                self.assertEquals(mc.get(key), value)
+
+    def test_get_or_compute(self):
+        mc = self.make_client()
+        calls = []
+
+        def compute():
+            calls.append(True)
+            return len(calls)
+
+        # Initially missing, so it's computed and stored.
+        self.assertEquals(mc.get_or_compute("test1", compute, 60), 1)
+        # Subsequently it's read from the cache.
+        self.assertEquals(mc.get_or_compute("test1", compute, 60), 1)
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(mc.get("test1.recompute-lock"), None)
+        # Make it stale, and pretend that someone else is recomputing it.
+        # We should keep serving the stale value.
+        mc.set("test1", {"value": "stale", "expires": time.time() - 1})
+        mc.add("test1.recompute-lock", 1)
+        self.assertEquals(mc.get_or_compute("test1", compute, 60), "stale")
+        self.assertEquals(len(calls), 1)
+        # Once they're done, the next caller will recompute it.
+        mc.delete("test1.recompute-lock")
+        self.assertEquals(mc.get_or_compute("test1", compute, 60), 2)
+        self.assertEquals(mc.get_or_compute("test1", compute, 60), 2)
+
+    def test_get_or_compute_waits_for_missing_values(self):
+        mc = self.make_client()
+        mc.add("test1.recompute-lock", 1)
+        # If nobody stores a value in time, we compute it ourselves.
+        start = time.time()
+        value = mc.get_or_compute("test1", lambda: 1, 60, lock_wait=0.2)
+        self.assertEquals(value, 1)
+        self.assertTrue(time.time() - start >= 0.2)
+        # But if the lock-holder stores it, we'll use their value.
+        real_sleep = time.sleep
+
+        def sleep_and_store(secs):
+            real_sleep(secs)
+            mc.set("test1", {"value": 2, "expires": time.time() + 10})
+
+        time.sleep = sleep_and_store
+        try:
+            value = mc.get_or_compute("test1", lambda: 3, 60)
+        finally:
+            time.sleep = real_sleep
+        self.assertEquals(value, 2)
+
+    def test_get_or_compute_serves_stale_value_if_compute_fails(self):
+        mc = self.make_client()
+
+        def compute():
+            raise RuntimeError("oops")
+
+        mc.set("test1", {"value": "stale", "expires": time.time() - 1})
+        with LogCapture() as logs:
+            self.assertEquals(mc.get_or_compute("test1", compute, 60),
+                              "stale")
+        self.assertTrue("oops" in str(logs))
+        # The lock is released, so the next caller will try again.
+        self.assertEquals(mc.get("test1.recompute-lock"), None)
+        self.assertEquals(mc.get_or_compute("test1", lambda: 1, 60), 1)
+        # Without a stale value, the error is raised.
+        self.assertRaises(RuntimeError, mc.get_or_compute, "test2",
+                          compute, 60)
+        self.assertEquals(mc.get("test2.recompute-lock"), None)
+
+    def test_get_or_compute_caps_expiry_at_thirty_days(self):
+        mc = self.make_client()
+        ttl = 60 * 60 * 24 * 20
+        self.assertEquals(mc.get_or_compute("test1", lambda: 1, ttl), 1)
+        # Otherwise memcached would take it as a timestamp in the past.
+        self.assertEquals(mc.get("test1")["value"], 1)
+
+    def test_get_or_compute_applies_jitter_to_ttl(self):
+        mc = self.make_client()
+        for i in xrange(10):
+            key = "test%d" % (i,)
+            mc.get_or_compute(key, lambda: i, 100, jitter=0.5)
+            expires = mc.get(key)["expires"] - time.time()
+            self.assertTrue(49 < expires <= 100)
+
+    def test_batch_gets_combines_and_deduplicates_concurrent_gets(self):
+        if gevent is None:
+            raise unittest2.SkipTest("gevent is not available")
+        mc = self.make_client(batch_gets=True)
+        mc.set_multi({"test1": 1, "test2": 2})
+        keys = ["test1", "test2", "test1", "test3", "test2", "test1"]
+        commands = self.memcached[0].total_commands
+        greenlets = [gevent.spawn(mc.get, key) for key in keys]
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEquals([g.value for g in greenlets],
+                          [1, 2, 1, None, 2, 1])
+        self.assertEquals(self.memcached[0].total_commands, commands + 1)
+        self.assertEquals(mc.loader.get_stats(),
+                          {"gets": 6, "batches": 1, "deduplicated": 3})
+        # Gets made one after the other are sent separately.
+        self.assertEquals(mc.get("test1"), 1)
+        self.assertEquals(mc.get("test3"), None)
+        self.assertEquals(mc.loader.get_stats()["batches"], 3)
+        self.assertRaises(ValueError, mc.get, "bad key")
+
+    def test_batch_gets_do_not_join_fetches_from_before_a_write(self):
+        if gevent is None:
+            raise unittest2.SkipTest("gevent is not available")
+        mc = self.make_client(batch_gets=True)
+        mc.set("test1", 1)
+        real_get_multi = mc.get_multi
+
+        def slow_get_multi(keys):
+            items = real_get_multi(keys)
+            gevent.sleep(0.1)
+            return items
+
+        mc.get_multi = slow_get_multi
+        old_get = gevent.spawn(mc.get, "test1")
+        gevent.sleep(0.01)
+        # The first get has read the old value, but not yet returned it.
+        self.assertTrue(mc.set("test1", 2))
+        new_get = gevent.spawn(mc.get, "test1")
+        gevent.joinall([old_get, new_get], raise_error=True)
+        self.assertEquals(old_get.value, 1)
+        self.assertEquals(new_get.value, 2)
+        self.assertEquals(mc.loader.get_stats()["batches"], 2)
+
+    def test_batch_gets_reports_errors_to_all_waiters(self):
+        if gevent is None:
+            raise unittest2.SkipTest("gevent is not available")
+        mc = self.make_client(batch_gets=True, breaker_threshold=0)
+        self.memcached[0].failure_rate = 1
+        greenlets = [gevent.spawn(mc.get, "test%d" % (i,)) for i in xrange(3)]
+        gevent.joinall(greenlets)
+        for greenlet in greenlets:
+            self.assertTrue(isinstance(greenlet.exception, BackendError))
+        self.assertEquals(mc.loader.get_stats()["batches"], 1)
+        self.memcached[0].failure_rate = 0
+        self.assertEquals(mc.get("test1"), None)
+
+    def test_iter_multi_fetches_keys_in_batches(self):
+        mc = self.make_client()
+        items = dict(("test%d" % (i,), i) for i in xrange(10))
+        mc.set_multi(items)
+        keys = ("test%d" % (i,) for i in xrange(12))
+        commands = self.memcached[0].total_commands
+        iterator = mc.iter_multi(keys, batch_size=3)
+        self.assertEquals(self.memcached[0].total_commands, commands)
+        self.assertEquals(dict(iterator), items)
+        self.assertEquals(self.memcached[0].total_commands, commands + 4)
+        # The caller can stop early, and can pass a plain list of keys.
+        iterator = mc.iter_multi(sorted(items), batch_size=2)
+        self.assertTrue(next(iterator)[0] in ("test0", "test1"))
+        iterator.close()
+        self.assertEquals(list(mc.iter_multi([])), [])
+        self.assertRaises(ValueError, list, mc.iter_multi(["test0"], 0))
+
+    def test_iter_multi_reports_errors(self):
+        mc = self.make_client(breaker_threshold=0)
+        mc.set_multi({"test1": 1, "test2": 2})
+        self.memcached[0].failure_rate = 1
+        self.assertRaises(BackendError, list,
+                          mc.iter_multi(["test1", "test2"], batch_size=1))
+
+    def test_incr_and_decr(self):
+        mc = self.make_client(servers=self.servers, replicas=2)
+        self.assertEquals(mc.incr("test1"), None)
+        mc.set("test1", 5)
+        self.assertEquals(mc.incr("test1"), 6)
+        self.assertEquals(mc.incr("test1", 10), 16)
+        self.assertEquals(mc.decr("test1", 3), 13)
+        self.assertEquals(mc.decr("test1", 20), 0)
+        self.assertEquals(mc.get("test1"), 0)
+        self.assertEquals(mc.decr("test2"), None)
+
+    def test_incr_of_non_numeric_value_raises_value_error(self):
+        mc = self.make_client(breaker_threshold=1)
+        mc.set("test1", "abc")
+        self.assertRaises(ValueError, mc.incr, "test1")
+        self.assertRaises(ValueError, mc.decr, "test1")
+        # The connection and the server's breaker are unaffected.
+        self.assertEquals(mc.get("test1"), "abc")
+        breaker_stats = mc.get_breaker_stats()[self.servers[0]]
+        self.assertEquals(breaker_stats["state"], "closed")
+        self.assertEquals(breaker_stats["failures"], 0)
+
+    def test_namespaces_can_be_invalidated_in_one_operation(self):
+        mc = self.make_client(servers=self.servers, local_cache_size=10)
+        mc.set(("user1", "test1"), 1)
+        mc.set_multi({("user1", "test2"): 2, ("user2", "test1"): 3})
+        self.assertEquals(mc.get(("user1", "test1")), 1)
+        self.assertEquals(mc.get("test1"), None)
+        self.assertEquals(mc.get_multi([("user1", "test2"), "test2"]),
+                          {("user1", "test2"): 2})
+        mc.invalidate_namespace("user1")
+        self.assertEquals(mc.get(("user1", "test1")), None)
+        self.assertEquals(mc.get_multi([("user1", "test2"),
+                                        ("user2", "test1")]),
+                          {("user2", "test1"): 3})
+        mc.set(("user1", "test1"), 4)
+        self.assertEquals(mc.get(("user1", "test1")), 4)
+        # Other clients see the invalidation once their cache expires.
+        mc2 = self.make_client(servers=self.servers, namespace_cache_ttl=0.1)
+        self.assertEquals(mc2.get(("user1", "test1")), 4)
+        mc.invalidate_namespace("user1")
+        self.assertEquals(mc2.get(("user1", "test1")), 4)
+        time.sleep(0.1)
+        self.assertEquals(mc2.get(("user1", "test1")), None)
+
+    def test_namespace_generations_survive_eviction(self):
+        mc = self.make_client()
+        mc.set(("user1", "test1"), 1)
+        gen_key = mc._get_generation_key("user1")
+        for server in self.memcached:
+            with server.lock:
+                server.items.pop(gen_key, None)
+        # A fresh generation is created, and the old keys aren't reachable.
+        mc.invalidate_namespace("user1")
+        self.assertEquals(mc.get(("user1", "test1")), None)
+        self.assertEquals(mc.get_or_compute(("user1", "test1"),
+                                            lambda: 2, 60), 2)
+        self.assertEquals(mc.get_or_compute(("user1", "test1"),
+                                            lambda: 3, 60), 2)
+
+    def test_hot_key_sampling(self):
+        mc = self.make_client(key_prefix="pfx:", codec="raw",
+                              hot_key_sample_rate=1, hot_key_capacity=5)
+        self.assertEquals(mc.get_hot_keys(), {})
+        for i in xrange(10):
+            mc.set("hot", "x" * 100)
+            mc.get("hot")
+            mc.set("cold%d" % (i,), "x")
+        mc.get_multi(["hot", "missing"])
+        hot_keys = mc.get_hot_keys(2)
+        self.assertEquals(hot_keys["set"][0], ("pfx:hot", 10, 1000, 0))
+        self.assertEquals(len(hot_keys["set"]), 2)
+        self.assertEquals(hot_keys["get"], [("pfx:hot", 11, 1100, 0),
+                                            ("pfx:missing", 1, 0, 0)])
+        # Sampling is disabled by default.
+        self.assertEquals(self.make_client().get_hot_keys(), {})
+
+    def test_hot_keys_are_logged_periodically(self):
+        now = [0]
+        sampler = HotKeySampler(1, log_interval=10, get_time=lambda: now[0])
+        with LogCapture() as logs:
+            sampler.record("get", "key1", 10)
+            sampler.record("get", "key1", 10)
+            now[0] += 9
+            sampler.record("get", "key2", 20)
+            self.assertEquals(len(logs.records), 0)
+            now[0] += 1
+            sampler.record("set", "key1", 30)
+        self.assertEquals([r.getMessage() for r in logs.records], [
+            "hot memcached keys for get: key1 (count=2, bytes=20), "
+            "key2 (count=1, bytes=20)",
+            "hot memcached keys for set: key1 (count=1, bytes=30)",
+        ])
+        # The counts are reset after logging.
+        self.assertEquals(sampler.get_hot_keys(), {"get": [], "set": []})
+
+    def test_hot_key_counts_are_scaled_by_sample_rate(self):
+        sampler = HotKeySampler(0.5)
+        for _ in xrange(4000):
+            sampler.record("get", "key1", 10)
+        [(key, count, size, error)] = sampler.get_hot_keys()["get"]
+        self.assertTrue(3400 < count < 4600, count)
+        self.assertEquals(size, count * 10)
+        self.assertRaises(ValueError, HotKeySampler, 0)
+
+    def test_latency_stats_and_request_annotations(self):
+        mc = self.make_client(servers=self.servers)
+        request = type("FakeRequest", (object,), {"metrics": {}})()
+        pyramid.threadlocal.manager.push({"request": request})
+        try:
+            mc.set("test1", 1)
+            mc.get("test1")
+            mc.get("test2")
+            mc.get_multi(["test1", "test2"])
+        finally:
+            pyramid.threadlocal.manager.pop()
+        self.assertEquals(request.metrics["mc.set.count"], 1)
+        self.assertEquals(request.metrics["mc.get.count"], 2)
+        self.assertEquals(request.metrics["mc.get_multi.count"], 1)
+        self.assertTrue(request.metrics["mc.get.time"] > 0)
+        stats = mc.get_latency_stats()
+        self.assertEquals(sorted(stats["operations"]),
+                          ["get", "get_multi", "set"])
+        self.assertEquals(stats["operations"]["get"]["count"], 2)
+        self.assertEquals(request.metrics["mc.get.time"],
+                          stats["operations"]["get"]["total"])
+        self.assertEquals(sorted(stats["servers"]), sorted(self.servers))
+        # The get_multi makes one request to each server that has a key.
+        requests = sum(s["count"] for s in stats["servers"].itervalues())
+        self.assertTrue(4 <= requests <= 5)
+
+    def test_backend_selection(self):
+        self.assertRaises(ValueError, self.make_client, backend="unknown")
+        backends = ["python"]
+        if mcclient.umemcache is not None:
+            backends.append("umemcache")
+        else:
+            self.assertRaises(ValueError, self.make_client,
+                              backend="umemcache")
+        for backend in backends:
+            mc = self.make_client(backend=backend)
+            self.assertEquals(mc.backend, backend)
+            self.assertTrue(mc.set("test1", backend))
+            self.assertEquals(mc.get("test1"), backend)
+            with mc.pool.reserve() as conn:
+                if backend == "python":
+                    self.assertTrue(isinstance(conn, mcprotocol.Connection))
+                else:
+                    self.assertFalse(isinstance(conn, mcprotocol.Connection))
+
+
+class TestPythonBackend(TestMemcachedClient):
+    """Run the standard MemcachedClient tests with the pure-python backend."""
+
+    def make_client(self, *args, **kwds):
+        kwds.setdefault("backend", "python")
+        return super(TestPythonBackend, self).make_client(*args, **kwds)
+
+    def test_commands_are_pipelined_on_a_single_connection(self):
+        mc = self.make_client(pool_size=1)
+        items = dict(("test%d" % (i,), i) for i in xrange(10))
+        self.assertEquals(mc.set_multi(items),
+                          dict((key, True) for key in items))
+        self.assertEquals(mc.get_multi(items.keys()), items)
+        stats = mc.get_pool_stats()[self.servers[0]]
+        self.assertEquals(stats["checkouts"], 2)
+        self.assertEquals(stats["connections_created"], 1)
+
+    def test_errors_from_a_trial_request_release_the_breaker(self):
+        now = [1000]
+        mc = self.make_client()
+        breaker = CircuitBreaker(1, 10, get_time=lambda: now[0])
+        mc.breakers[self.servers[0]] = breaker
+        mc.set("test1", 1)
+        breaker.record_failure()
+        now[0] += 10
+        # The invalid key fails the trial request without an answer from
+        # the server, so the next request is let through as a new trial.
+        self.assertRaises(ValueError, mc.get, "bad key")
+        self.assertEquals(breaker.state, "half-open")
+        self.assertEquals(mc.get("test1"), 1)
+        self.assertEquals(breaker.state, "closed")
+
+    def test_broken_connections_are_replaced(self):
+        mc = self.make_client(breaker_threshold=0)
+        mc.set("test1", 1)
+        with mc.pool.reserve() as conn:
+            conn._sock.shutdown(socket.SHUT_RDWR)
+        self.assertRaises(BackendError, mc.get, "test1")
+        self.assertEquals(mc.get("test1"), 1)
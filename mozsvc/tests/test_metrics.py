@@ -9,7 +9,8 @@ from webtest import TestApp
 from testfixtures import LogCapture
 import pyramid.testing
 
-from mozsvc.metrics import metrics_timer, initialize_request_metrics
+from mozsvc.metrics import (metrics_timer, initialize_request_metrics,
+                            LatencyHistogram)
 
 from cornice import Service
 from cornice.pyramidhook import register_service_views
@@ -152,3 +153,21 @@ class TestMetrics(unittest2.TestCase):
             app.get("/impl_forbidden", status=403)
             r = self.logs.records[-1]
             self.assertEquals(r.code, 403)
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram(min_latency=0.001, num_buckets=4)
+        self.assertEquals(histogram.get_stats()["p99"], 0)
+        for latency in [0.0005] * 50 + [0.003] * 40 + [0.006] * 9 + [1]:
+            histogram.record(latency)
+        stats = histogram.get_stats()
+        self.assertEquals(stats["count"], 100)
+        self.assertAlmostEqual(stats["total"], 1.199)
+        self.assertAlmostEqual(stats["mean"], 0.01199)
+        self.assertEquals(stats["max"], 1)
+        self.assertEquals(stats["p50"], 0.001)
+        self.assertEquals(stats["p90"], 0.004)
+        self.assertEquals(stats["p99"], 0.008)
+        self.assertEquals(stats["buckets"], [(0.001, 50), (0.004, 40),
+                                             (0.008, 9), (None, 1)])
+        histogram.record(2)
+        self.assertEquals(histogram.get_stats()["p99"], 2)
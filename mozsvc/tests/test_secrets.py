@@ -92,3 +92,19 @@ class TestSecrets(unittest2.TestCase):
             self.assertEquals(len(derived), len(master_secrets))
             for d, m in zip(derived, master_secrets):
                 self.assertEquals(len(d), len(m))
+
+    def test_derived_secrets_cache(self):
+        master_secrets = ['abcdef', '1234567890']
+        secrets = DerivedSecrets(master_secrets, cache_size="2")
+        uncached = DerivedSecrets(master_secrets, cache_size=0)
+        derived1 = secrets.get('phx123')
+        self.assertEquals(derived1, uncached.get('phx123'))
+        # Callers can't corrupt the cached secrets.
+        derived1.append('junk')
+        self.assertEquals(secrets.get('phx123'), uncached.get('phx123'))
+        self.assertEquals(secrets._cache.hits, 1)
+        # The cache is bounded, discarding least-recently-used nodes.
+        for node in ('phx234', 'phx345', 'phx123'):
+            self.assertEquals(secrets.get(node), uncached.get(node))
+        self.assertEquals(len(secrets._cache), 2)
+        self.assertEquals(secrets._cache.hits, 1)
@@ -5,6 +5,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+import os
 import time
 import unittest2
 import tempfile
@@ -20,20 +21,23 @@ import tokenlib
 import hawkauthlib
 
 from mozsvc.exceptions import BackendError
-from mozsvc.tests.support import TestCase
-from mozsvc.secrets import DerivedSecrets
+from mozsvc.tests.support import TestCase, StandInMemcachedServer
+from mozsvc.secrets import DerivedSecrets, FixedSecrets
+from mozsvc.user.bloomnoncecache import BloomFilterNonceCache
 from mozsvc.user.permissivenoncecache import PermissiveNonceCache
 from mozsvc.user import TokenServerAuthenticationPolicy
 
 try:
-    from mozsvc.storage.mcclient import MemcachedClient
-    from mozsvc.user.noncecache import MemcachedNonceCache
-    # We'll test for a live memcached server when we actually run the tests.
-    MEMCACHED = None
-except (ImportError, BackendError) as err:
+    from mozsvc.user.noncecache import (MemcachedNonceCache,
+                                        TimeBucketedNonceSet)
+    MEMCACHED = True
+except ImportError:
     MEMCACHED = False
 
-TEST_MEMCACHE_KEY = 'mozsvc_unittest'
+try:
+    import gevent
+except ImportError:
+    gevent = None
 
 
 class ExpandoRequest(object):
@@ -301,64 +305,216 @@ class UserTestCase(TestCase):
         with self.assertRaises(HTTPUnauthorized):
             req.authenticated_userid
 
+    def test_that_node_name_is_cached_in_the_request(self):
+        req = self.make_request(environ={"HTTP_HOST": "host1.com:80"})
+        self.assertEquals(self.policy._get_node_name(req), "http://host1.com")
+        self.assertEquals(req.environ["mozsvc.user.node_name"],
+                          "http://host1.com")
+        req.environ["mozsvc.user.node_name"] = "http://host2.com"
+        self.assertEquals(self.policy._get_node_name(req), "http://host2.com")
+
+    def test_that_decoded_tokens_are_cached(self):
+        policy = TokenServerAuthenticationPolicy(secrets="secret1",
+                                                 token_cache_size=2)
+        req = self.make_request(environ={"HTTP_HOST": "host1.com"})
+        req.metrics = {}
+        tokenid, key = policy.encode_hawk_id(req, 42)
+        self.assertEquals(policy.decode_hawk_id(req, tokenid), (42, key))
+        self.assertEquals(policy.decode_hawk_id(req, tokenid), (42, key))
+        self.assertEquals(req.metrics, {"tokencache.miss": 1,
+                                        "tokencache.hit": 1})
+        self.assertEquals(policy.get_token_cache_stats(),
+                          {"size": 1, "hits": 1, "misses": 1})
+        # Tokens are not cached for other nodes.
+        req2 = self.make_request(environ={"HTTP_HOST": "host2.com"})
+        self.assertRaises(ValueError, policy.decode_hawk_id, req2, tokenid)
+        # Cached tokens are dropped when they expire.
+        expired_id = tokenlib.make_token({"uid": 7, "node": req.host_url,
+                                          "expires": time.time() + 0.1},
+                                         secret="secret1")
+        policy.decode_hawk_id(req, expired_id)
+        time.sleep(0.2)
+        self.assertRaises(ValueError, policy.decode_hawk_id, req, expired_id)
+        # The cache is flushed when the secrets change.
+        policy.secrets = FixedSecrets("secret1 secret2")
+        self.assertEquals(policy.decode_hawk_id(req, tokenid), (42, key))
+        self.assertEquals(policy.get_token_cache_stats()["misses"], 5)
+        policy.secrets = FixedSecrets("secret2")
+        self.assertRaises(ValueError, policy.decode_hawk_id, req, tokenid)
+        self.assertEquals(len(policy.token_cache), 0)
+        # The cache can be disabled.
+        policy = TokenServerAuthenticationPolicy(secrets="secret1",
+                                                 token_cache_size=0)
+        self.assertEquals(policy.decode_hawk_id(req, tokenid), (42, key))
+        self.assertTrue(policy.token_cache is None)
+
+    def test_that_secrets_are_tried_in_order_of_likely_success(self):
+        policy = TokenServerAuthenticationPolicy(secrets="old new",
+                                                 token_cache_size=0)
+        req = self.make_request(environ={"HTTP_HOST": "host1.com"})
+        node_name = policy._get_node_name(req)
+        # The newest secret is tried first by default.
+        self.assertEquals(policy._order_token_secrets(node_name,
+                                                      ["old", "new"]),
+                          ["new", "old"])
+        # But the last secret that worked for the node is tried first.
+        old_id = tokenlib.make_token({"uid": 42, "node": node_name},
+                                     secret="old")
+        old_key = tokenlib.get_derived_secret(old_id, secret="old")
+        self.assertEquals(policy.decode_hawk_id(req, old_id), (42, old_key))
+        self.assertEquals(policy._order_token_secrets(node_name,
+                                                      ["old", "new"]),
+                          ["old", "new"])
+        new_id, new_key = policy.encode_hawk_id(req, 7)
+        self.assertEquals(policy.decode_hawk_id(req, new_id), (7, new_key))
+        self.assertEquals(policy._secret_hints[node_name], "new")
+        # Hints for secrets that are no longer in use are ignored.
+        self.assertEquals(policy._order_token_secrets(node_name,
+                                                      ["newer", "newest"]),
+                          ["newest", "newer"])
+
+    def test_that_token_managers_are_cached(self):
+        policy = TokenServerAuthenticationPolicy(secrets="secret1")
+        manager = policy._get_token_manager("secret1")
+        self.assertTrue(policy._get_token_manager("secret1") is manager)
+        data = {"uid": 42, "node": "http://host1.com"}
+        tokenid = tokenlib.make_token(data, secret="secret1")
+        self.assertEquals(manager.parse_token(tokenid)["uid"], 42)
+        tokenid = manager.make_token(data)
+        self.assertEquals(manager.parse_token(tokenid)["uid"], 42)
+        self.assertEquals(tokenlib.parse_token(tokenid, secret="secret1"),
+                          manager.parse_token(tokenid))
+        tokenid = tokenlib.make_token(data, secret="secret2")
+        self.assertRaises(ValueError, manager.parse_token, tokenid)
+
+    def test_that_token_cache_size_can_be_configured(self):
+        config2 = pyramid.testing.setUp()
+        config2.add_settings({
+            "hawkauth.secret": "secret1",
+            "hawkauth.token_cache_size": "10",
+        })
+        config2.include("mozsvc.user")
+        policy2 = config2.registry.queryUtility(IAuthenticationPolicy)
+        self.assertEquals(policy2.token_cache.max_size, 10)
+
 
 class TestMemcachedNonceCache(unittest2.TestCase):
 
     def setUp(self):
-        global MEMCACHED
-        if MEMCACHED is None:
-            try:
-                client = MemcachedClient()
-            except BackendError as err:
-                raise unittest2.SkipTest(
-                    "Got backend error ({!r}) instantiating client".format(err)
-                )
-            else:
-                try:
-                    client.set(TEST_MEMCACHE_KEY, "some unimportant value")
-                    client.get(TEST_MEMCACHE_KEY)
-                except BackendError as err:
-                    raise unittest2.SkipTest(
-                        "Unable to interact with memcached ({!r})".format(err)
-                    )
-                finally:
-                    client.delete(TEST_MEMCACHE_KEY)
-
-                MEMCACHED = True
-
         if not MEMCACHED:
             raise unittest2.SkipTest("Unable to import required modules.")
-
-        self.nc = None
-        self.keys_to_delete = set()
+        self.memcached = [StandInMemcachedServer().start() for _ in xrange(2)]
 
     def tearDown(self):
-        if self.nc is not None:
-            for key in self.keys_to_delete:
-                self.nc.mcclient.delete(key)
-
-    def _monkeypatch_mcclient(self, mcclient):
-        # Ultramemcache has no API for clearing all keys.
-        # Monkeypatch it to remember any keys we use,
-        # so we can delete them during cleanup.
-        orig_add = mcclient.add
+        for server in self.memcached:
+            server.stop()
 
-        def add_and_remember(key, *args, **kwds):
-            self.keys_to_delete.add(key)
-            return orig_add(key, *args, **kwds)
+    def test_operation(self, now=lambda: int(time.time())):
+        window = 5
+        nc = MemcachedNonceCache(window=window,
+                                 cache_server=self.memcached[0].address)
+        # Initially nothing is cached, so all nonces as fresh.
+        ts = now()
+        self.assertTrue(nc.check_nonce(ts, "abc"))
+        # After that check, the (ts, nonce) pair should be stale.
+        # Changing either the ts or the nonce will make it fresh.
+        self.assertFalse(nc.check_nonce(ts, "abc"))
+        self.assertTrue(nc.check_nonce(ts, "xyz"))
+        self.assertTrue(nc.check_nonce(ts + 1, "abc"))
+        # Timestamps outside the configured window are rejected.
+        self.assertFalse(nc.check_nonce(now() - window - 1, "abc"))
+        self.assertFalse(nc.check_nonce(now() + window + 1, "abc"))
 
-        mcclient.add = add_and_remember
+    def test_replicated_nonces_survive_a_dead_server(self):
+        servers = " ".join(server.address for server in self.memcached)
+        nc = MemcachedNonceCache(cache_server=servers, cache_replicas="2")
+        ts = int(time.time())
+        nonces = ["nonce%d" % (i,) for i in xrange(10)]
+        for nonce in nonces:
+            self.assertTrue(nc.check_nonce(ts, nonce))
+        self.memcached[0].stop()
+        for nonce in nonces:
+            self.assertFalse(nc.check_nonce(ts, nonce))
+        self.assertTrue(nc.check_nonce(ts, "fresh"))
+        self.assertFalse(nc.check_nonce(ts, "fresh"))
+
+    def test_local_prefilter_rejects_replays_without_memcached(self):
+        server = self.memcached[0]
+        nc = MemcachedNonceCache(cache_server=server.address,
+                                 local_prefilter="true")
+        ts = int(time.time())
+        self.assertTrue(nc.check_nonce(ts, "abc"))
+        commands = server.total_commands
+        self.assertFalse(nc.check_nonce(ts, "abc"))
+        self.assertEquals(server.total_commands, commands)
+        # Memcached is still the authority for nonces not seen locally.
+        nc2 = MemcachedNonceCache(cache_server=server.address,
+                                  local_prefilter=True)
+        self.assertFalse(nc2.check_nonce(ts, "abc"))
+        self.assertFalse(nc2.check_nonce(ts, "abc"))
+        # Nonces aren't remembered if they couldn't be checked.
+        server.stop()
+        self.assertRaises(BackendError, nc2.check_nonce, ts, "xyz")
+        self.assertEquals(len(nc2.local_nonces), 1)
+
+    def test_time_bucketed_nonce_set(self):
+        nonces = TimeBucketedNonceSet(window=10)
+        self.assertTrue(nonces.add(100, "abc", now=100))
+        self.assertFalse(nonces.add(100, "abc", now=100))
+        self.assertTrue(nonces.add(101, "abc", now=100))
+        self.assertTrue(nonces.add(95, "xyz", now=100))
+        self.assertEquals(len(nonces), 3)
+        # Whole buckets are expired as they fall out of the window.
+        nonces.add(110, "def", now=105)
+        self.assertEquals(sorted(nonces._buckets), [95, 100, 101, 110])
+        nonces.add(110, "ghi", now=106)
+        self.assertEquals(len(nonces), 4)
+        self.assertEquals(sorted(nonces._buckets), [100, 101, 110])
+        self.assertTrue(nonces.add(995, "def", now=1000))
+        self.assertEquals(len(nonces), 1)
+        nonces.discard(995, "def")
+        self.assertEquals(len(nonces), 0)
+        # Timestamps from expired buckets are rejected.
+        self.assertFalse(nonces.add(112, "def", now=1000))
+        self.assertEquals(len(nonces), 0)
+        # Non-integer timestamps go in the bucket for their whole second,
+        # and are expired along with it.
+        nonces = TimeBucketedNonceSet(window=10)
+        self.assertTrue(nonces.add(90.7, "abc", now=100.5))
+        self.assertFalse(nonces.add(90.2, "abc", now=100.5))
+        self.assertFalse(nonces.add(80.5, "xyz", now=100.5))
+        now = 100.5
+        while now < 200:
+            now += 0.5
+            nonces.add(now, "abc", now=now)
+        self.assertTrue(min(nonces._buckets) > 180)
+        self.assertTrue(len(nonces) <= 24)
+
+    def test_batched_adds(self):
+        if gevent is None:
+            raise unittest2.SkipTest("gevent is not available")
+        nc = MemcachedNonceCache(cache_server=self.memcached[0].address,
+                                 batch_adds=True)
+        ts = int(time.time())
+        self.assertTrue(nc.check_nonce(ts, "old"))
+        nonces = ["old", "abc", "xyz", "abc"]
+        greenlets = [gevent.spawn(nc.check_nonce, ts, nonce)
+                     for nonce in nonces]
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEquals([g.value for g in greenlets],
+                          [False, True, True, False])
+        stats = nc.mcclient.get_pool_stats()[self.memcached[0].address]
+        self.assertEquals(stats["checkouts"], 2)
+
+
+class TestBloomFilterNonceCache(unittest2.TestCase):
 
     def test_operation(self, now=lambda: int(time.time())):
         window = 5
-        nc = self.nc = MemcachedNonceCache(window=window)
-        self._monkeypatch_mcclient(nc.mcclient)
+        nc = BloomFilterNonceCache(window=window)
         # Initially nothing is cached, so all nonces as fresh.
         ts = now()
-        try:
-            self.assertTrue(nc.check_nonce(ts, "abc"))
-        except BackendError:
-            raise unittest2.SkipTest("no memcache")
+        self.assertTrue(nc.check_nonce(ts, "abc"))
         # After that check, the (ts, nonce) pair should be stale.
         # Changing either the ts or the nonce will make it fresh.
         self.assertFalse(nc.check_nonce(ts, "abc"))
@@ -368,6 +524,69 @@ class TestMemcachedNonceCache(unittest2.TestCase):
         self.assertFalse(nc.check_nonce(now() - window - 1, "abc"))
         self.assertFalse(nc.check_nonce(now() + window + 1, "abc"))
 
+    def test_nonces_are_remembered_for_the_whole_window(self):
+        now = [1000.0]
+        nc = BloomFilterNonceCache(window=10, slices=5,
+                                   get_time=lambda: now[0])
+        self.assertTrue(nc.check_nonce(1009, "abc"))
+        # Checking other nonces rotates the filters as time passes,
+        # but the nonce is still rejected while its timestamp is valid.
+        for i in xrange(38):
+            now[0] += 0.5
+            self.assertTrue(nc.check_nonce(int(now[0]), "other%d" % (i,)))
+            self.assertFalse(nc.check_nonce(1009, "abc"))
+        # Once its slice has expired, the filter is re-used for a new one.
+        now[0] = 1030
+        self.assertTrue(nc.check_nonce(1031, "abc"))
+        self.assertFalse(nc.check_nonce(1031, "abc"))
+        self.assertEquals(nc.size, nc.num_filters * nc.slot_size)
+
+    def test_false_positive_rate(self):
+        nc = BloomFilterNonceCache(capacity=2000, error_rate=0.01)
+        now = int(time.time())
+        # Spread the nonces over a window's worth of timestamps, so that
+        # after checking the fresh ones the filters are filled to capacity.
+        for i in xrange(1000):
+            nc.check_nonce(now - 30 + i % 60, "seen%d" % (i,))
+        rejected = 0
+        for i in xrange(1000):
+            if not nc.check_nonce(now - 30 + i % 60, "fresh%d" % (i,)):
+                rejected += 1
+        self.assertTrue(rejected < 1000 * 0.01 * 2, rejected)
+
+    def test_sizing(self):
+        small = BloomFilterNonceCache(capacity=1000, error_rate=0.01)
+        large = BloomFilterNonceCache(capacity=100000, error_rate=0.01)
+        accurate = BloomFilterNonceCache(capacity=1000, error_rate=0.0001)
+        self.assertTrue(small.size < accurate.size < large.size)
+        self.assertEquals(small.size, len(small._data))
+        # Settings are accepted as strings.
+        nc = BloomFilterNonceCache(window="10", capacity="1000",
+                                   error_rate="0.01", slices="2")
+        self.assertEquals(nc.num_filters, 5)
+        self.assertRaises(ValueError, BloomFilterNonceCache, slices=0)
+        self.assertRaises(ValueError, BloomFilterNonceCache, error_rate=0)
+        self.assertRaises(ValueError, BloomFilterNonceCache, error_rate=1)
+
+    def test_shared_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+        nc1 = BloomFilterNonceCache(capacity=1000, shared_file=filename)
+        nc2 = BloomFilterNonceCache(capacity=1000, shared_file=filename)
+        self.addCleanup(nc1.close)
+        self.addCleanup(nc2.close)
+        self.assertEquals(os.path.getsize(filename), nc1.size)
+        ts = int(time.time())
+        self.assertTrue(nc1.check_nonce(ts, "abc"))
+        self.assertFalse(nc2.check_nonce(ts, "abc"))
+        self.assertTrue(nc2.check_nonce(ts, "xyz"))
+        self.assertFalse(nc1.check_nonce(ts, "xyz"))
+        # Opening it with different settings starts afresh.
+        nc3 = BloomFilterNonceCache(capacity=2000, shared_file=filename)
+        self.addCleanup(nc3.close)
+        self.assertTrue(nc3.check_nonce(ts, "abc"))
+
 
 class TestPermissiveNonceCache(unittest2.TestCase):
 
@@ -23,7 +23,8 @@ import tokenlib
 
 import mozsvc
 import mozsvc.secrets
-from mozsvc.util import resolve_name
+from mozsvc.util import resolve_name, LRUCache
+from mozsvc.metrics import annotate_request
 from mozsvc.user.permissivenoncecache import PermissiveNonceCache
 
 import logging
@@ -31,6 +32,10 @@ logger = logging.getLogger("mozsvc.user")
 
 
 ENVIRON_KEY_IDENTITY = "mozsvc.user.identity"
+ENVIRON_KEY_NODE_NAME = "mozsvc.user.node_name"
+
+DEFAULT_TOKEN_CACHE_SIZE = 1000
+DEFAULT_TOKEN_MANAGER_CACHE_SIZE = 1000
 
 
 class RequestWithUser(Request):
@@ -84,11 +89,17 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
     single fixed secret (via the argument 'secret') or a file mapping
     node hostnames to secrets (via the argument 'secrets_file').  The
     two arguments are mutually exclusive.
+
+    Successfully-decoded token ids are remembered in an LRU cache of size
+    'token_cache_size', so that the tokens are only verified once rather
+    than on every request.  Cached tokens are dropped when they expire, and
+    the whole cache is flushed when the secrets for a node change.  Use a
+    size of zero to disable the cache.
     """
 
     implements(IAuthenticationPolicy)
 
-    def __init__(self, secrets=None, **kwds):
+    def __init__(self, secrets=None, token_cache_size=None, **kwds):
         if not secrets:
             # Using secret=None will cause tokenlib to use a randomly-generated
             # secret.  This is useful for getting started without having to
@@ -105,6 +116,18 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
         elif isinstance(secrets, dict):
             secrets = resolve_name(secrets.pop("backend"))(**secrets)
         self.secrets = secrets
+        if token_cache_size is None:
+            token_cache_size = DEFAULT_TOKEN_CACHE_SIZE
+        if token_cache_size > 0:
+            self.token_cache = LRUCache(token_cache_size)
+        else:
+            self.token_cache = None
+        # The secrets in use for each node when its tokens were cached.
+        self._token_cache_secrets = {}
+        # A TokenManager for each recently-used secret, and the secret that
+        # last successfully verified a token for each node.
+        self._token_managers = LRUCache(DEFAULT_TOKEN_MANAGER_CACHE_SIZE)
+        self._secret_hints = {}
         if kwds.get("nonce_cache") is None:
             kwds["nonce_cache"] = PermissiveNonceCache()
         super(TokenServerAuthenticationPolicy, self).__init__(**kwds)
@@ -130,6 +153,8 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
             if name.startswith(secrets_prefix):
                 secrets[name[len(secrets_prefix):]] = settings.pop(name)
         kwds['secrets'] = secrets
+        if "token_cache_size" in settings:
+            kwds["token_cache_size"] = int(settings.pop("token_cache_size"))
         return kwds
 
     def _check_signature(self, request, key):
@@ -157,28 +182,80 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
         token.
 
         If the id is invalid then ValueError will be raised.
+
+        Valid ids are cached until their expiry time, so that repeated
+        requests with the same id can skip the verification.
         """
+        node_name = self._get_node_name(request)
+        secrets = self._get_token_secrets(node_name)
+        if self.token_cache is not None:
+            cached = self._get_cached_token(request, node_name, tokenid,
+                                            secrets)
+            if cached is not None:
+                return cached
         # There might be multiple secrets in use, if we're in the
         # process of transitioning from one to another.  Try each
         # until we find one that works.
-        node_name = self._get_node_name(request)
-        secrets = self._get_token_secrets(node_name)
-        for secret in secrets:
+        for secret in self._order_token_secrets(node_name, secrets):
+            manager = self._get_token_manager(secret)
             try:
-                data = tokenlib.parse_token(tokenid, secret=secret)
+                data = manager.parse_token(tokenid)
                 userid = data["uid"]
                 token_node_name = data["node"]
                 if token_node_name != node_name:
                     raise ValueError("incorrect node for this token")
-                key = tokenlib.get_derived_secret(tokenid, secret=secret)
+                key = manager.get_derived_secret(tokenid)
                 break
             except (ValueError, KeyError):
                 pass
         else:
             logger.warn("Authentication Failed: invalid hawk id")
             raise ValueError("invalid Hawk id")
+        self._secret_hints[node_name] = secret
+        if self.token_cache is not None:
+            self._token_cache_secrets[node_name] = tuple(secrets)
+            self.token_cache.set((node_name, tokenid), (userid, key),
+                                 expires=data["expires"])
         return userid, key
 
+    def _get_cached_token(self, request, node_name, tokenid, secrets):
+        """Get the cached (userid, key) for a token id, or None if missing.
+
+        If the node's secrets have changed since its tokens were cached,
+        then the entire cache is flushed.  Hits and misses are recorded
+        in the request metrics.
+        """
+        cached_secrets = self._token_cache_secrets.get(node_name)
+        if cached_secrets is not None and cached_secrets != tuple(secrets):
+            self.flush_token_cache()
+        cached = self.token_cache.get((node_name, tokenid))
+        if cached is None:
+            annotate_request(request, "tokencache.miss", 1)
+        else:
+            annotate_request(request, "tokencache.hit", 1)
+        return cached
+
+    def flush_token_cache(self):
+        """Discard all cached token ids.
+
+        This happens automatically when the secrets in use for a node are
+        changed, but can also be called explicitly e.g. when revoking
+        secrets.
+        """
+        self._token_cache_secrets = {}
+        if self.token_cache is not None:
+            self.token_cache.clear()
+
+    def get_token_cache_stats(self):
+        """Get a dict of counters describing the token cache's activity."""
+        if self.token_cache is None:
+            return {"size": 0, "hits": 0, "misses": 0}
+        return {
+            "size": len(self.token_cache),
+            "hits": self.token_cache.hits,
+            "misses": self.token_cache.misses,
+        }
+
     def encode_hawk_id(self, request, userid):
         """Encode the given userid into a Hawk id and secret key.
 
@@ -191,13 +268,54 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
         # process of transitioning from one to another.  Always use
         # the last one aka the "most recent" secret.
         secret = self._get_token_secrets(node_name)[-1]
+        manager = self._get_token_manager(secret)
         data = {"uid": userid, "node": node_name}
-        tokenid = tokenlib.make_token(data, secret=secret)
-        key = tokenlib.get_derived_secret(tokenid, secret=secret)
+        tokenid = manager.make_token(data)
+        key = manager.get_derived_secret(tokenid)
         return tokenid, key
 
+    def _order_token_secrets(self, node_name, secrets):
+        """Order the possible secrets for a node by their chance of success.
+
+        Most tokens will have been signed with the newest secret, so that is
+        tried first, unless a different secret was the last to succeed for
+        the node.  This means that while secrets are being rotated, most
+        tokens are still verified at the first attempt.
+        """
+        if len(secrets) == 1:
+            return secrets
+        ordered = secrets[::-1]
+        hint = self._secret_hints.get(node_name)
+        if hint is not None and hint != ordered[0] and hint in ordered:
+            ordered.remove(hint)
+            ordered.insert(0, hint)
+        return ordered
+
+    def _get_token_manager(self, secret):
+        """Get a TokenManager for signing and verifying with a secret.
+
+        Managers are cached since creating one involves deriving its
+        signing key with HKDF, which costs more than checking a signature.
+        """
+        manager = self._token_managers.get(secret)
+        if manager is None:
+            manager = tokenlib.TokenManager(secret=secret)
+            self._token_managers.set(secret, manager)
+        return manager
+
     def _get_node_name(self, request):
-        """Get the canonical node name for the given request."""
+        """Get the canonical node name for the given request.
+
+        The node name is cached in the request environ, so it's only
+        calculated once per request.
+        """
+        node_name = request.environ.get(ENVIRON_KEY_NODE_NAME)
+        if node_name is None:
+            node_name = self._calculate_node_name(request)
+            request.environ[ENVIRON_KEY_NODE_NAME] = node_name
+        return node_name
+
+    def _calculate_node_name(self, request):
         # Secrets are looked up by hostname.
         # We need to normalize some port information for this work right.
         node_name = request.host_url
@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Class for storing hawkauth nonces in rotating in-memory Bloom filters.
+
+"""
+
+import os
+import math
+import time
+import mmap
+import struct
+import threading
+import contextlib
+from hashlib import md5
+
+
+DEFAULT_TIMESTAMP_WINDOW = 60
+DEFAULT_CAPACITY = 100000
+DEFAULT_ERROR_RATE = 0.001
+DEFAULT_SLICES = 4
+
+# Each filter is preceded by a header giving the index of its time slice.
+HEADER = struct.Struct("<q")
+
+
+class BloomFilterNonceCache(object):
+    """Object for managing a cache of used nonce values in Bloom filters.
+
+    This class implements the timestamp/nonce checking interface required
+    by hawkauthlib using a fixed amount of memory, without any external
+    dependencies.  It is intended for single-host deployments.
+
+    The time window is divided into "slices", and nonces are recorded in a
+    separate Bloom filter for each slice according to their timestamp.  A
+    nonce need only be checked against the filter for its own slice, and
+    it is remembered for as long as its timestamp is within the window of
+    the current time.  Once a slice has fallen out of the window its filter
+    is cleared and re-used for a new slice.
+
+    The filters are sized to hold "capacity" nonces per window with a
+    false-positive rate of at most "error_rate", i.e. the chance that a
+    fresh nonce will be wrongly rejected.  The total memory used is given
+    by the "size" attribute.  If more than "capacity" nonces arrive within
+    a window then they will still be remembered, but false positives will
+    become more likely.  More slices waste less memory on expired nonces,
+    at the cost of some fixed overhead for each filter.
+
+    If "shared_file" is given then the filters are kept in a memory-mapped
+    file at that path, so that all the worker processes on a host that use
+    the same path share the same nonces.  Access to the file is serialized
+    by locking it with fcntl, so this is only supported on Unix.
+    """
+
+    def __init__(self, window=None, get_time=None, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE, slices=DEFAULT_SLICES,
+                 shared_file=None):
+        if window is None:
+            window = DEFAULT_TIMESTAMP_WINDOW
+        self.window = float(window)
+        self.get_time = get_time or time.time
+        self.slices = int(slices)
+        if self.slices < 1:
+            raise ValueError("slices must be at least one")
+        error_rate = float(error_rate)
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        # Valid timestamps can be up to a window either side of the current
+        # time, so we need a filter for every slice within that range.
+        self.slice_length = self.window / self.slices
+        self.num_filters = 2 * self.slices + 1
+        per_filter_capacity = max(int(math.ceil(float(capacity) /
+                                                self.slices)), 1)
+        num_bits = -per_filter_capacity * math.log(error_rate)
+        num_bits = int(math.ceil(num_bits / math.log(2) ** 2))
+        self.filter_bytes = (num_bits + 7) // 8
+        self.num_bits = self.filter_bytes * 8
+        self.num_hashes = max(int(round(float(self.num_bits) /
+                                        per_filter_capacity * math.log(2))), 1)
+        self.slot_size = HEADER.size + self.filter_bytes
+        self.size = self.slot_size * self.num_filters
+        self._lock = threading.Lock()
+        self._file = None
+        if shared_file is None:
+            self._data = bytearray(self.size)
+        else:
+            self._data = self._map_file(shared_file)
+        # Zeroed slots look like slice 0, so mark them as never used.
+        empty_slot = "\x00" * self.slot_size
+        with self._locked():
+            for slot in xrange(self.num_filters):
+                offset = slot * self.slot_size
+                if self._data[offset:offset + self.slot_size] == empty_slot:
+                    HEADER.pack_into(self._data, offset, -1)
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _map_file(self, filename):
+        """Open and memory-map the file in which to share the filters."""
+        # Imported here since it's only available on Unix.
+        import fcntl
+        self._flock = fcntl.flock
+        self._lock_ex = fcntl.LOCK_EX
+        self._lock_un = fcntl.LOCK_UN
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            self._flock(fd, self._lock_ex)
+            try:
+                if os.fstat(fd).st_size != self.size:
+                    # It's new, or was created with different settings.
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.size)
+            finally:
+                self._flock(fd, self._lock_un)
+            data = mmap.mmap(fd, self.size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._file = fd
+        return data
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Context-manager to lock the filters against concurrent access."""
+        with self._lock:
+            if self._file is None:
+                yield
+            else:
+                self._flock(self._file, self._lock_ex)
+                try:
+                    yield
+                finally:
+                    self._flock(self._file, self._lock_un)
+
+    def check_nonce(self, timestamp, nonce):
+        """Check if the given timestamp+nonce is fresh.
+
+        This method checks that the given timestamp is within the configured
+        time window, and that the given nonce has not previously been seen
+        with that timestamp.  It returns True if the nonce is fresh and False
+        if it is stale.
+
+        Fresh nonces are recorded so that subsequent checks of the same
+        nonce will return False.
+        """
+        now = self.get_time()
+        # Check if the timestamp is within the configured window.
+        if not now - self.window < timestamp < now + self.window:
+            return False
+        positions = self._get_bit_positions("%d:%s" % (timestamp, nonce))
+        slice_index = int(timestamp // self.slice_length)
+        # The slices within the window all map to different slots, so any
+        # other slice found in this slot must have expired.
+        offset = (slice_index % self.num_filters) * self.slot_size
+        with self._locked():
+            if HEADER.unpack_from(self._data, offset)[0] != slice_index:
+                self._clear(offset, slice_index)
+            elif self._contains(offset + HEADER.size, positions):
+                return False
+            self._add(offset + HEADER.size, positions)
+        return True
+
+    def _get_bit_positions(self, item):
+        """Get the positions of the bits to set for the given item.
+
+        This uses double hashing to derive all the positions from a single
+        digest of the item.
+        """
+        h1, h2 = struct.unpack("<QQ", md5(item).digest())
+        return [(h1 + i * h2) % self.num_bits
+                for i in xrange(self.num_hashes)]
+
+    def _contains(self, start, positions):
+        data = self._data
+        for pos in positions:
+            offset = start + (pos >> 3)
+            if not ord(data[offset:offset + 1]) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _add(self, start, positions):
+        data = self._data
+        for pos in positions:
+            offset = start + (pos >> 3)
+            byte = ord(data[offset:offset + 1]) | (1 << (pos & 7))
+            data[offset:offset + 1] = chr(byte)
+
+    def _clear(self, offset, slice_index):
+        HEADER.pack_into(self._data, offset, slice_index)
+        start = offset + HEADER.size
+        end = start + self.filter_bytes
+        self._data[start:end] = "\x00" * self.filter_bytes
+
+    def close(self):
+        """Release the shared file, if any."""
+        if self._file is not None:
+            self._data.close()
+            os.close(self._file)
+            self._file = None
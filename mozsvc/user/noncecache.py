@@ -7,11 +7,21 @@ Class for storing hawkauth nonces in memcached.
 
 """
 
+import sys
 import time
 import math
+import threading
 from hashlib import sha1
 from base64 import urlsafe_b64encode
 
+from pyramid.settings import asbool
+
+try:
+    import gevent
+    import gevent.event
+except ImportError:
+    gevent = None
+
 from mozsvc.storage.mcclient import MemcachedClient
 
 
@@ -27,11 +37,25 @@ class MemcachedNonceCache(object):
     It stores the nonces in memcached so that they can be shared between
     different webserver processes.  Each timestamp+nonce combo is stored
     under a key sha1(<timestamp>:<nonce>).
+
+    If several servers are given in "cache_server", setting "cache_replicas"
+    will store each nonce on that many of them, so that losing a single
+    memcached node does not disable replay protection.
+
+    If "local_prefilter" is true then each process also remembers the nonces
+    that it has seen, bucketed by timestamp, so that replays seen by the same
+    process are rejected without a network round-trip.  Memcached remains
+    the authority for nonces that have not been seen locally.
+
+    If "batch_adds" is true then nonces checked by different greenlets at
+    the same time are added to memcached in a single add_multi request.
+    This requires gevent.
     """
 
     def __init__(self, window=None, get_time=None, cache_server=None,
                  cache_key_prefix="noncecache:", cache_pool_size=None,
-                 cache_pool_timeout=60, **kwds):
+                 cache_pool_timeout=60, cache_replicas=1,
+                 local_prefilter=False, batch_adds=False, **kwds):
         # Memcached ttls are in integer seconds, so round up to the nearest.
         if window is None:
             window = DEFAULT_TIMESTAMP_WINDOW
@@ -40,7 +64,18 @@ class MemcachedNonceCache(object):
         self.window = window
         self.get_time = get_time or time.time
         self.mcclient = MemcachedClient(cache_server, cache_key_prefix,
-                                        cache_pool_size, cache_pool_timeout)
+                                        cache_pool_size, cache_pool_timeout,
+                                        replicas=cache_replicas)
+        if asbool(local_prefilter):
+            self.local_nonces = TimeBucketedNonceSet(window)
+        else:
+            self.local_nonces = None
+        if asbool(batch_adds):
+            if gevent is None:
+                raise ValueError("batch_adds requires gevent")
+            self._batcher = _BatchingAdder(self.mcclient, window)
+        else:
+            self._batcher = None
 
     def __len__(self):
         raise NotImplementedError
@@ -62,14 +97,133 @@ class MemcachedNonceCache(object):
         ts_max = now + self.window
         if not ts_min < timestamp < ts_max:
             return False
+        # Check if we've already seen it locally.  If not, it's marked as
+        # seen straight away so that concurrent checks of it will fail.
+        if self.local_nonces is not None:
+            if not self.local_nonces.add(timestamp, nonce, now):
+                return False
         # Check if it's in memcached, adding it if not.
         # Fortunately memcached 'add' has precisely the right semantics
         # of "create if not exists"
         key = urlsafe_b64encode(sha1("%d:%s" % (timestamp, nonce)).digest())
         try:
-            if not self.mcclient.add(key, 1, time=self.window):
-                return False
+            if self._batcher is not None:
+                added = self._batcher.add(key)
+            else:
+                added = self.mcclient.add(key, 1, time=self.window)
         except ValueError:
             return False
+        except Exception:
+            # It wasn't really checked, so don't remember it locally.
+            if self.local_nonces is not None:
+                self.local_nonces.discard(timestamp, nonce)
+            raise
+        if not added:
+            return False
         # Successfully added, the nonce must be fresh.
         return True
+
+
+class TimeBucketedNonceSet(object):
+    """Set of recently-seen nonces, bucketed by their integer timestamp.
+
+    Each nonce is stored in a bucket for its timestamp.  Once a timestamp
+    falls out of the window, its whole bucket is discarded in a single
+    operation, so expiring old nonces costs O(1) per second of time passed
+    rather than per nonce.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._buckets = {}
+        # All buckets older than this timestamp have been discarded.
+        self._min_timestamp = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.itervalues())
+
+    def add(self, timestamp, nonce, now):
+        """Add a nonce to the set, returning False if it was already there.
+
+        Timestamps whose bucket has already been expired are also rejected,
+        since they must be outside the window.
+        """
+        timestamp = int(math.floor(timestamp))
+        with self._lock:
+            self._expire(now)
+            if timestamp < self._min_timestamp:
+                return False
+            bucket = self._buckets.get(timestamp)
+            if bucket is None:
+                bucket = self._buckets[timestamp] = set()
+            elif nonce in bucket:
+                return False
+            bucket.add(nonce)
+            return True
+
+    def discard(self, timestamp, nonce):
+        """Remove a nonce from the set, if present."""
+        with self._lock:
+            bucket = self._buckets.get(int(math.floor(timestamp)))
+            if bucket is not None:
+                bucket.discard(nonce)
+
+    def _expire(self, now):
+        # Buckets at or before the cutoff hold only timestamps that are no
+        # longer in the window.  The bucket containing the start of the
+        # window may still hold valid non-integer timestamps, so is kept.
+        cutoff = int(math.floor(now - self.window)) - 1
+        if self._min_timestamp is None:
+            self._min_timestamp = cutoff + 1
+        elif cutoff - self._min_timestamp > len(self._buckets):
+            # A lot of time has passed, so it's quicker to check them all.
+            for timestamp in self._buckets.keys():
+                if timestamp <= cutoff:
+                    del self._buckets[timestamp]
+            self._min_timestamp = cutoff + 1
+        else:
+            while self._min_timestamp <= cutoff:
+                self._buckets.pop(self._min_timestamp, None)
+                self._min_timestamp += 1
+
+
+class _BatchingAdder(object):
+    """Helper for combining concurrent memcached adds into one add_multi.
+
+    When a greenlet calls add(), the key is added to a pending batch and the
+    greenlet waits for the result.  The batch is sent once all the greenlets
+    that are ready to run have had a chance to add their own keys.  Unlike
+    the BatchingLoader for gets, greenlets adding the same key must not
+    share a result, so any duplicate keys in a batch fail immediately.
+    """
+
+    def __init__(self, mcclient, ttl):
+        self.mcclient = mcclient
+        self.ttl = ttl
+        self._pending = {}
+        self._flush_scheduled = False
+
+    def add(self, key):
+        """Add the key to memcached, returning False if already present."""
+        if key in self._pending:
+            return False
+        result = self._pending[key] = gevent.event.AsyncResult()
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            gevent.spawn(self._flush)
+        return result.get()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        batch = self._pending
+        self._pending = {}
+        try:
+            added = self.mcclient.add_multi(dict.fromkeys(batch, 1), self.ttl)
+        except Exception:
+            exc_info = sys.exc_info()
+            for result in batch.itervalues():
+                result.set_exception(exc_info[1], exc_info)
+        else:
+            for key, result in batch.iteritems():
+                result.set(added.get(key, False))
@@ -5,14 +5,17 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+import sys
 import json
 import time
 import socket
 import urllib
 import logging
 import urlparse
+import threading
 import traceback
 from datetime import datetime
+from collections import OrderedDict
 from decimal import Decimal, InvalidOperation
 
 from pyramid.util import DottedNameResolver
@@ -165,3 +168,225 @@ def safer_format_traceback(exc_typ, exc_val, exc_tb):
     lines.append("%r\n" % (exc_typ,))
     lines.append("%r\n" % (exc_val,))
     return "".join(lines)
+
+
+def _get_monotonic_clock():
+    """Find the best available function for reading a monotonic clock.
+
+    Python 2 has no time.monotonic(), but on Linux we can get the same thing
+    by calling clock_gettime(CLOCK_MONOTONIC) via ctypes.  If that's not
+    possible, we fall back to the (non-monotonic) wall-clock time.
+    """
+    monotonic = getattr(time, "monotonic", None)
+    if monotonic is not None:
+        return monotonic
+    if not sys.platform.startswith("linux"):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    clock_gettime = None
+    # Older versions of glibc only provide clock_gettime in librt.
+    for libname in ("c", "rt"):
+        path = ctypes.util.find_library(libname)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        break
+    if clock_gettime is None:
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+
+_monotonic_clock = _get_monotonic_clock()
+
+
+def monotonic_time():
+    """Get the current time from a monotonic clock.
+
+    The returned value is a number of seconds since some arbitrary point, so
+    it is only useful for measuring intervals.  Unlike time.time() it will
+    never go backwards, even if the system clock is changed.
+    """
+    return _monotonic_clock()
+
+
+class LRUCache(object):
+    """Bounded in-memory cache with least-recently-used eviction.
+
+    This class provides a simple dict-like cache that holds at most
+    "max_size" items, discarding the least-recently-used item when full.
+    Items may also be given an expiry time, either explicitly when they are
+    stored or via a default "ttl" in seconds; expired items are treated as
+    missing.  Counts of cache hits and misses are kept for reporting.
+    """
+
+    def __init__(self, max_size, ttl=None, get_time=None):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.get_time = get_time or time.time
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        sentinel = object()
+        with self._lock:
+            return self._get(key, sentinel) is not sentinel
+
+    def get(self, key, default=None):
+        """Get the item stored under the given key, or the default."""
+        sentinel = object()
+        with self._lock:
+            value = self._get(key, sentinel)
+            if value is sentinel:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def _get(self, key, default):
+        try:
+            expires, value = self._items.pop(key)
+        except KeyError:
+            return default
+        if expires is not None and expires <= self.get_time():
+            return default
+        # Re-insert it to mark it as most-recently-used.
+        self._items[key] = (expires, value)
+        return value
+
+    def set(self, key, value, expires=None):
+        """Store an item under the given key.
+
+        If given, "expires" is the absolute time at which the item should
+        expire.  Otherwise it will expire after the default ttl, if any.
+        """
+        if expires is None and self.ttl is not None:
+            expires = self.get_time() + self.ttl
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove and return the item stored under the given key."""
+        with self._lock:
+            try:
+                return self._items.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        """Remove all items from the cache."""
+        with self._lock:
+            self._items.clear()
+
+
+class SpaceSavingCounter(object):
+    """Bounded approximate counter for finding the most frequent items.
+
+    This class implements the "space-saving" heavy-hitters algorithm.  It
+    tracks at most "capacity" items; when a new item arrives and the counter
+    is full, the item with the lowest count is replaced and the new item
+    inherits its count.  This means that counts may be over-estimated by up
+    to the inherited amount, which is reported as the item's error.  Any
+    item occurring more than 1/capacity of the time is guaranteed to be
+    tracked.  Each item also accumulates a total of the sizes added for it.
+
+    Items are kept in a "stream summary" as described in the paper, i.e.
+    grouped into buckets by their count, so that both incrementing an item
+    and finding the item to replace take constant time.  Among items with
+    the lowest count, the one that has had that count for longest is the
+    one replaced.
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        # Maps each item to a list of [count, error, size].
+        self._items = {}
+        # Maps each count to the items having that count, in the order
+        # in which they reached it.
+        self._buckets = {}
+        self._min_count = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item, size=0):
+        """Count an occurrence of the given item, of the given size."""
+        entry = self._items.get(item)
+        if entry is not None:
+            self._unlink(item, entry[0])
+        elif len(self._items) < self.capacity:
+            entry = self._items[item] = [0, 0, 0]
+        else:
+            victim = next(iter(self._buckets[self._min_count]))
+            count = self._items.pop(victim)[0]
+            self._unlink(victim, count)
+            entry = self._items[item] = [count, count, 0]
+        count = entry[0]
+        if count == 0:
+            self._min_count = 1
+        elif count == self._min_count and count not in self._buckets:
+            self._min_count = count + 1
+        entry[0] = count + 1
+        entry[2] += size
+        bucket = self._buckets.get(count + 1)
+        if bucket is None:
+            bucket = self._buckets[count + 1] = OrderedDict()
+        bucket[item] = None
+
+    def _unlink(self, item, count):
+        bucket = self._buckets[count]
+        del bucket[item]
+        if not bucket:
+            del self._buckets[count]
+
+    def top(self, n=None):
+        """Get the n most frequent items, most frequent first.
+
+        This returns a list of (item, count, error, size) tuples.
+        """
+        items = []
+        for count in sorted(self._buckets, reverse=True):
+            for item in self._buckets[count]:
+                if n is not None and len(items) >= n:
+                    return items
+                _, error, size = self._items[item]
+                items.append((item, count, error, size))
+        return items
+
+    def clear(self):
+        """Forget all counted items."""
+        self._items.clear()
+        self._buckets.clear()
+        self._min_count = 0